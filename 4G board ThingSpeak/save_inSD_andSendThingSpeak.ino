@@ -21,9 +21,33 @@ String ApikeyNode5 = "YOUR_API_KEY_NODE_5";
 #define CS_PIN 4  // SD card selection pin
 
 String receivedData = "";
-bool dataReceived = false;
+volatile bool dataReceived = false;
+
+// Framed I2C transfers: each chunk of at most 32 bytes (the Wire buffer) is
+// data length, transfer id, chunk index, chunk count, data and a CRC16
+#define CHUNK_SIZE 32
+#define CHUNK_HEADER_SIZE 4
+#define MAX_TRANSFER 512
+
+// Status register read back by the receiver: status, transfer id, chunks received
+#define STATUS_IDLE 0
+#define STATUS_RECEIVING 1
+#define STATUS_COMPLETE 2
+#define STATUS_CRC_ERROR 3
+#define STATUS_SEQUENCE_ERROR 4
+#define STATUS_BUSY 5
+#define STATUS_OVERFLOW 6
+
+uint8_t transferBuffer[MAX_TRANSFER];
+volatile int transferLength = 0;
+volatile uint8_t statusRegister[3] = {STATUS_IDLE, 0, 0};
 const int maxRetries = 15;
 
+// Records uploaded per modem session, a transfer holds fewer of them
+#define MAX_RECORDS 16
+// ThingSpeak drops updates closer than 15 s on a free channel, in milliseconds
+#define UPDATE_INTERVAL_MS 15000
+
 File dataFile;
 
 /**
@@ -62,6 +86,7 @@ void setup() {
     
     Wire.begin(0x08); // Initialize as slave with address 0x08
     Wire.onReceive(receiveEvent); // Attach receiveEvent function
+    Wire.onRequest(requestEvent); // Attach requestEvent function for the status register
     
     // Attach wake interrupt
     //attachInterrupt(digitalPinToInterrupt(WAKE_PIN), wakeUp, LOW);
@@ -76,189 +101,276 @@ void setup() {
 
 /**
  * The main loop function that runs repeatedly.
- * It checks if data has been received, parses the received data,
- * saves the data to an SD card, and sends the data to ThingSpeak.
+ * It checks if a transfer has been received, and processes each record of
+ * the transfer, one CSV line per record. Lines starting with "S," are link
+ * statistics of a node. The records of a transfer are then uploaded to
+ * ThingSpeak in a single modem session.
  * If no data is received, it enters sleep mode.
  */
 void loop() {
     if (dataReceived) {
+        // Take the transfer and let the receiver send the next one, the
+        // buffer is left alone by receiveEvent() until dataReceived is cleared
+        receivedData = "";
+        receivedData.reserve(transferLength);
+        for (int i = 0; i < transferLength; i++) {
+            receivedData += (char)transferBuffer[i];
+        }
         dataReceived = false;
 
-        // Create a mutable copy of the received data
-        char receivedDataCopy[receivedData.length() + 1];
-        strcpy(receivedDataCopy, receivedData.c_str());
-
-        // Parse the received data for node number, date, time, temperature, humidity, pressure, and dendrometer
-        int node = 0;
-        int year = 0;
-        int month = 0;
-        int day = 0;
-        int hour = 0;
-        int minute = 0;
-        int second = 0;
-        char *token;
-        float t = 0.0;
-        float h = 0.0;
-        float p = 0.0;
-        float d0 = 0.0;
-        float d1 = 0.0;
-        float d2 = 0.0;
-        float d3 = 0.0;
-        float m = 0.0;
-
-        token = strtok(receivedDataCopy, ",");
-        node = atoi(token); // The first field is the node number
-
-        token = strtok(NULL, ",");
-        year = atoi(token);
-
-        token = strtok(NULL, ",");
-        month = atoi(token);
-
-        token = strtok(NULL, ",");
-        day = atoi(token);
-
-        token = strtok(NULL, ",");
-        hour = atoi(token);
-
-        token = strtok(NULL, ",");
-        minute = atoi(token);
-
-        token = strtok(NULL, ",");
-        second = atoi(token);
-
-        String datetime = String(year) + "-" + String(month) + "-" + String(day) + " " + String(hour) + ":" + String(minute) + ":" + String(second);
-
-        token = strtok(NULL, ",");
-        t = atof(token);
-
-        token = strtok(NULL, ",");
-        h = atof(token);
-
-        token = strtok(NULL, ",");
-        p = atof(token);
-
-        token = strtok(NULL, ",");
-        d0 = atof(token);
-
-        token = strtok(NULL, ",");
-        d1 = atof(token);
-
-        token = strtok(NULL, ",");
-        d2 = atof(token);
-
-        token = strtok(NULL, ",");
-        d3 = atof(token);
-
-        token = strtok(NULL, ",");
-        m = atof(token);
-
-        // Debugging: print out the parsed values
-        SerialUSB.print("Parsed values: DateTime=");
-        SerialUSB.print(datetime);
-        SerialUSB.print(", Node=");
-        SerialUSB.print(node);
-        SerialUSB.print(", Temp=");
-        SerialUSB.print(t);
-        SerialUSB.print(", Hum=");
-        SerialUSB.print(h);
-        SerialUSB.print(", Press=");
-        SerialUSB.print(p);
-        SerialUSB.print(", Dendro0=");
-        SerialUSB.print(d0);
-        SerialUSB.print(", Dendro1=");
-        SerialUSB.print(d1);
-        SerialUSB.print(", Dendro2=");
-        SerialUSB.print(d2);
-        SerialUSB.print(", Dendro3=");
-        SerialUSB.print(d3);
-        SerialUSB.print(", Moisture=");
-        SerialUSB.println(m);
-
-        // Save data to SD card in a CSV file per node
-        String fileName = "Node" + String(node) + ".csv";
-        dataFile = SD.open(fileName, FILE_WRITE);
-        if (dataFile) {
-            if (dataFile.size() == 0) {
-                // Write header if file is empty
-                dataFile.println("Datetime,Node,Temp,Hum,Press,Dendro,Moisture");
+        String requests[MAX_RECORDS];
+        int requestCount = 0;
+        int start = 0;
+        while (start < (int)receivedData.length()) {
+            int end = receivedData.indexOf('\n', start);
+            if (end < 0) {
+                end = receivedData.length();
             }
-            dataFile.print(datetime);
-            dataFile.print(",");
-            dataFile.print(node);
-            dataFile.print(",");
-            dataFile.print(t, 4);
-            dataFile.print(",");
-            dataFile.print(h, 4);
-            dataFile.print(",");
-            dataFile.print(p, 4);
-            dataFile.print(",");
-            dataFile.print(d0, 4);
-            dataFile.print(",");
-            dataFile.print(d1, 4);
-            dataFile.print(",");
-            dataFile.print(d2, 4);
-            dataFile.print(",");
-            dataFile.print(d3, 4);
-            dataFile.print(",");
-            dataFile.println(m, 4);
-            dataFile.close();
-            SerialUSB.println("Data saved to " + fileName);
-        } else {
-            SerialUSB.println("Error opening file " + fileName);
+            if (end > start) {
+                String record = receivedData.substring(start, end);
+                if (record.startsWith("S,")) {
+                    saveStats(record.substring(2));
+                } else {
+                    String request = processRecord(record);
+                    if (request.length() > 0) {
+                        if (requestCount == MAX_RECORDS) {
+                            uploadRecords(requests, requestCount);
+                            requestCount = 0;
+                        }
+                        requests[requestCount++] = request;
+                    }
+                }
+            }
+            start = end + 1;
+        }
+        if (requestCount > 0) {
+            uploadRecords(requests, requestCount);
+        }
+    } else {
+        //enterSleepMode();
+    }
+}
+
+/**
+ * Saves the link statistics of a node to the SD card.
+ *
+ * @param stats The CSV line after "S,": node number, packets, duplicates, errors,
+ *              frames lost, loss in percent, mean and min RSSI, mean and min SNR
+ *              and mean time between packets in seconds.
+ */
+void saveStats(String stats) {
+    SerialUSB.println("Link statistics: " + stats);
+    dataFile = SD.open("Stats.csv", FILE_WRITE);
+    if (dataFile) {
+        if (dataFile.size() == 0) {
+            // Write header if file is empty
+            dataFile.println("Node,Packets,Duplicates,Errors,Lost,Loss(%),RSSI mean,RSSI min,SNR mean,SNR min,Interval(s)");
         }
+        dataFile.println(stats);
+        dataFile.close();
+    } else {
+        SerialUSB.println("Error opening file Stats.csv");
+    }
+}
 
-        // Convert floats to strings
-        String t_str = String(t, 4);
-        String h_str = String(h, 4);
-        String p_str = String(p, 4);
-        String d0_str = String(d0, 4);
-        String d1_str = String(d1, 4);
-        String d2_str = String(d2, 4);
-        String d3_str = String(d3, 4);
-        String m_str = String(m, 4);
-
-        // Set appropriate API key based on node
-        String Apikey;
-        switch (node) {
-            case 2:
-                Apikey = ApikeyNode2;
-                break;
-            case 3:
-                Apikey = ApikeyNode3;
-                break;
-            case 4:
-                Apikey = ApikeyNode4;
-                break;
-            case 5:
-                Apikey = ApikeyNode5;
-                break;
-            default:
-                SerialUSB.println("Unknown node, no API key available.");
-                return; // Exit function if node is unknown
+/**
+ * Parses one record and saves it to the SD card.
+ *
+ * @param record The CSV line: node number, date, time, temperature, humidity,
+ *               pressure, the four dendrometers and moisture.
+ * @return The AT command setting the ThingSpeak URL of the record, or an
+ *         empty String if the node has no API key.
+ */
+String processRecord(String record) {
+    // Create a mutable copy of the received data
+    char receivedDataCopy[record.length() + 1];
+    strcpy(receivedDataCopy, record.c_str());
+
+    // Parse the received data for node number, date, time, temperature, humidity, pressure, and dendrometer
+    int node = 0;
+    int year = 0;
+    int month = 0;
+    int day = 0;
+    int hour = 0;
+    int minute = 0;
+    int second = 0;
+    char *token;
+    float t = 0.0;
+    float h = 0.0;
+    float p = 0.0;
+    float d0 = 0.0;
+    float d1 = 0.0;
+    float d2 = 0.0;
+    float d3 = 0.0;
+    float m = 0.0;
+
+    token = strtok(receivedDataCopy, ",");
+    node = atoi(token); // The first field is the node number
+
+    token = strtok(NULL, ",");
+    year = atoi(token);
+
+    token = strtok(NULL, ",");
+    month = atoi(token);
+
+    token = strtok(NULL, ",");
+    day = atoi(token);
+
+    token = strtok(NULL, ",");
+    hour = atoi(token);
+
+    token = strtok(NULL, ",");
+    minute = atoi(token);
+
+    token = strtok(NULL, ",");
+    second = atoi(token);
+
+    String datetime = String(year) + "-" + String(month) + "-" + String(day) + " " + String(hour) + ":" + String(minute) + ":" + String(second);
+
+    token = strtok(NULL, ",");
+    t = atof(token);
+
+    token = strtok(NULL, ",");
+    h = atof(token);
+
+    token = strtok(NULL, ",");
+    p = atof(token);
+
+    token = strtok(NULL, ",");
+    d0 = atof(token);
+
+    token = strtok(NULL, ",");
+    d1 = atof(token);
+
+    token = strtok(NULL, ",");
+    d2 = atof(token);
+
+    token = strtok(NULL, ",");
+    d3 = atof(token);
+
+    token = strtok(NULL, ",");
+    m = atof(token);
+
+    // Debugging: print out the parsed values
+    SerialUSB.print("Parsed values: DateTime=");
+    SerialUSB.print(datetime);
+    SerialUSB.print(", Node=");
+    SerialUSB.print(node);
+    SerialUSB.print(", Temp=");
+    SerialUSB.print(t);
+    SerialUSB.print(", Hum=");
+    SerialUSB.print(h);
+    SerialUSB.print(", Press=");
+    SerialUSB.print(p);
+    SerialUSB.print(", Dendro0=");
+    SerialUSB.print(d0);
+    SerialUSB.print(", Dendro1=");
+    SerialUSB.print(d1);
+    SerialUSB.print(", Dendro2=");
+    SerialUSB.print(d2);
+    SerialUSB.print(", Dendro3=");
+    SerialUSB.print(d3);
+    SerialUSB.print(", Moisture=");
+    SerialUSB.println(m);
+
+    // Save data to SD card in a CSV file per node
+    String fileName = "Node" + String(node) + ".csv";
+    dataFile = SD.open(fileName, FILE_WRITE);
+    if (dataFile) {
+        if (dataFile.size() == 0) {
+            // Write header if file is empty
+            dataFile.println("Datetime,Node,Temp,Hum,Press,Dendro,Moisture");
         }
+        dataFile.print(datetime);
+        dataFile.print(",");
+        dataFile.print(node);
+        dataFile.print(",");
+        dataFile.print(t, 4);
+        dataFile.print(",");
+        dataFile.print(h, 4);
+        dataFile.print(",");
+        dataFile.print(p, 4);
+        dataFile.print(",");
+        dataFile.print(d0, 4);
+        dataFile.print(",");
+        dataFile.print(d1, 4);
+        dataFile.print(",");
+        dataFile.print(d2, 4);
+        dataFile.print(",");
+        dataFile.print(d3, 4);
+        dataFile.print(",");
+        dataFile.println(m, 4);
+        dataFile.close();
+        SerialUSB.println("Data saved to " + fileName);
+    } else {
+        SerialUSB.println("Error opening file " + fileName);
+    }
+
+    // Convert floats to strings
+    String t_str = String(t, 4);
+    String h_str = String(h, 4);
+    String p_str = String(p, 4);
+    String d0_str = String(d0, 4);
+    String d1_str = String(d1, 4);
+    String d2_str = String(d2, 4);
+    String d3_str = String(d3, 4);
+    String m_str = String(m, 4);
+
+    // Set appropriate API key based on node
+    String Apikey;
+    switch (node) {
+        case 2:
+            Apikey = ApikeyNode2;
+            break;
+        case 3:
+            Apikey = ApikeyNode3;
+            break;
+        case 4:
+            Apikey = ApikeyNode4;
+            break;
+        case 5:
+            Apikey = ApikeyNode5;
+            break;
+        default:
+            SerialUSB.println("Unknown node, no API key available.");
+            return ""; // Nothing to upload if node is unknown
+    }
 
-        // Build URL with all fields except date and time
-        String http_str = "AT+HTTPPARA=\"URL\",\"https://api.thingspeak.com/update?api_key=" + Apikey + "&field1=" + t_str + "&field2=" + h_str + "&field3=" + p_str + "&field4=" + d0_str + "&field5=" + m_str + "&field6=" + d1_str + "&field7=" + d2_str + "&field8=" + d3_str + "\"\r\n";
-        SerialUSB.println(http_str);
+    // Build URL with all fields except date and time
+    String http_str = "AT+HTTPPARA=\"URL\",\"https://api.thingspeak.com/update?api_key=" + Apikey + "&field1=" + t_str + "&field2=" + h_str + "&field3=" + p_str + "&field4=" + d0_str + "&field5=" + m_str + "&field6=" + d1_str + "&field7=" + d2_str + "&field8=" + d3_str + "\"\r\n";
+    SerialUSB.println(http_str);
+    return http_str;
+}
 
+/**
+ * Uploads records to ThingSpeak in one modem session.
+ *
+ * The SIM7600 is powered on once, with its boot delay, every record is sent
+ * with its own retries, and the module is powered off after the last one.
+ *
+ * @param requests The AT commands returned by processRecord().
+ * @param count The number of records.
+ */
+void uploadRecords(String requests[], int count) {
+    powerOnSIM7600();
+    delay(20000);
+
+    unsigned long lastUpdate = 0;
+    for (int i = 0; i < count; i++) {
+        if (i > 0 && millis() - lastUpdate < UPDATE_INTERVAL_MS) {
+            delay(UPDATE_INTERVAL_MS - (millis() - lastUpdate));
+        }
         int retryCount = 0;
         bool success = false;
-
-        powerOnSIM7600();
-        delay(20000);
-
         while (retryCount < maxRetries && !success) {
             sendData("AT+HTTPINIT\r\n", 2000, DEBUG);
-            String response = sendData(http_str, 2000, DEBUG);
+            String response = sendData(requests[i], 2000, DEBUG);
             String actionResponse = sendData("AT+HTTPACTION=0\r\n", 3000, DEBUG);
             sendData("AT+HTTPTERM\r\n", 3000, DEBUG);
 
             if (actionResponse.indexOf("200") >= 0) {
                 success = true;
                 SerialUSB.println("Data sent successfully!");
-                powerOffSIM7600();
-
             } else {
                 retryCount++;
                 SerialUSB.print("Retrying... (");
@@ -267,32 +379,118 @@ void loop() {
                 delay(1000); // Wait 1 second before retrying
             }
         }
+        lastUpdate = millis();
 
         if (!success) {
             SerialUSB.println("Failed to send data after maximum retries.");
         }
-    } else {
-        //enterSleepMode();
     }
+
+    powerOffSIM7600();
+}
+
+/**
+ * @brief Computes the CRC16-CCITT (polynomial 0x1021, initial value 0xFFFF).
+ *
+ * @param data The bytes.
+ * @param length The number of bytes.
+ * @return The CRC.
+ */
+uint16_t crc16(const uint8_t *data, int length) {
+    uint16_t crc = 0xFFFF;
+    for (int i = 0; i < length; i++) {
+        crc ^= (uint16_t)data[i] << 8;
+        for (int bit = 0; bit < 8; bit++) {
+            crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+        }
+    }
+    return crc;
+}
+
+/**
+ * @brief Sets the status register read back by the receiver.
+ *
+ * @param status The status of the current transfer.
+ */
+void setStatus(uint8_t status) {
+    statusRegister[0] = status;
 }
 
 /**
  * @brief Function to handle I2C receive event.
  * 
- * This function is called when data is received over I2C.
- * It reads the received data and sets the dataReceived flag to true.
+ * This function is called when a chunk is received over I2C.
+ * It checks the CRC and the order of the chunk, appends its data to the
+ * transfer, and sets the dataReceived flag to true once the last chunk of
+ * the transfer has arrived. The outcome is kept in the status register.
  * It also detaches the interrupt associated with the WAKE_PIN.
  * 
  * @param howMany The number of bytes received.
  */
 void receiveEvent(int howMany) {
-    receivedData = "";
+    uint8_t chunk[CHUNK_SIZE];
+    int length = 0;
     while (Wire.available()) {
-        char c = Wire.read();
-        receivedData += c;
+        uint8_t c = Wire.read();
+        if (length < CHUNK_SIZE) {
+            chunk[length++] = c;
+        }
     }
-    dataReceived = true;
     detachInterrupt(digitalPinToInterrupt(WAKE_PIN));
+
+    if (length < CHUNK_HEADER_SIZE + 2 || length != CHUNK_HEADER_SIZE + chunk[0] + 2) {
+        setStatus(STATUS_CRC_ERROR);
+        return;
+    }
+    uint16_t crc = chunk[length - 2] | (chunk[length - 1] << 8);
+    if (crc16(chunk, length - 2) != crc) {
+        setStatus(STATUS_CRC_ERROR);
+        return;
+    }
+
+    uint8_t dataLength = chunk[0];
+    uint8_t transferId = chunk[1];
+    uint8_t index = chunk[2];
+    uint8_t count = chunk[3];
+    if (dataReceived) {
+        // The previous transfer is still being processed
+        setStatus(STATUS_BUSY);
+        return;
+    }
+    if (index == 0) {
+        // A new transfer, or the receiver starting the current one again
+        transferLength = 0;
+        statusRegister[1] = transferId;
+        statusRegister[2] = 0;
+    } else if (transferId != statusRegister[1] || index != statusRegister[2]) {
+        setStatus(STATUS_SEQUENCE_ERROR);
+        return;
+    }
+    if (transferLength + dataLength > MAX_TRANSFER) {
+        setStatus(STATUS_OVERFLOW);
+        return;
+    }
+    memcpy(transferBuffer + transferLength, chunk + CHUNK_HEADER_SIZE, dataLength);
+    transferLength += dataLength;
+    statusRegister[2] = index + 1;
+
+    if (index + 1 == count) {
+        setStatus(STATUS_COMPLETE);
+        dataReceived = true;
+    } else {
+        setStatus(STATUS_RECEIVING);
+    }
+}
+
+/**
+ * @brief Function to handle I2C request event.
+ *
+ * This function is called when the receiver reads the status register:
+ * the status, the id of the current transfer and its chunks received.
+ */
+void requestEvent() {
+    uint8_t status[3] = {statusRegister[0], statusRegister[1], statusRegister[2]};
+    Wire.write(status, 3);
 }
 
 /**
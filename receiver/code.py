@@ -6,6 +6,21 @@ import busio
 import digitalio
 import adafruit_rfm9x
 import time
+import asyncio
+import os
+import rtc
+import microcontroller
+import supervisor
+import sys
+import payload
+import decoder
+import dedup
+import adr
+import slots
+import rxqueue
+import gateway
+import spool
+import linkstats
 
 # Define radio parameters
 RADIO_FREQ_MHZ = 915.0
@@ -15,14 +30,27 @@ CS = digitalio.DigitalInOut(board.RFM_CS)
 RESET = digitalio.DigitalInOut(board.RFM_RST)
 WAKE_PIN = digitalio.DigitalInOut(board.D5)  # Define a wake pin for Arduino
 
+# DIO0 goes high when the RFM9x has received a packet (RxDone)
+DIO0 = None
+if hasattr(board, "RFM_IO0"):
+    DIO0 = digitalio.DigitalInOut(board.RFM_IO0)
+    DIO0.direction = digitalio.Direction.INPUT
+
 # Initialize SPI bus
 spi = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
 
 # Initialize RFM radio
 rfm9x = adafruit_rfm9x.RFM9x(spi, CS, RESET, RADIO_FREQ_MHZ)
+rfm9x.enable_crc = True  # Drop packets with a bad CRC before they are queued
+
+# Set the radio profile, see settings.toml
+rfm9x.spreading_factor = os.getenv("LORA_SPREADING_FACTOR", 7)
+rfm9x.signal_bandwidth = os.getenv("LORA_BANDWIDTH", 125000)
+rfm9x.tx_power = os.getenv("LORA_TX_POWER", 23)
 
-# Set the transmit power
-rfm9x.tx_power = 23
+# Recommends the TX power of every sender node from the SNR of its frames
+data_rate_advisor = adr.DataRateAdvisor(rfm9x.spreading_factor, rfm9x.signal_bandwidth,
+                                        os.getenv("ADR_TARGET_MARGIN_DB", 10))
 
 # Set node addresses
 rfm9x.node = 1  # This node is now node 1 (receiver)
@@ -31,14 +59,19 @@ rfm9x.destination = 255  # Set to broadcast address to receive from any node
 print("Waiting for packets...")
 
 # Initialize I2C bus with retry mechanism for pull-up resistor check
-def initialize_i2c():
+def initialize_i2c(attempts=0):
     """
     Initializes the I2C bus and returns the I2C object.
 
+    Args:
+        attempts (int, optional): The number of attempts, 0 to retry until
+            it works. Default is 0.
+
     Returns:
-        i2c (busio.I2C): The initialized I2C object.
+        i2c (busio.I2C): The initialized I2C object, None if every attempt failed.
     """
     i2c = None
+    attempt = 0
     while i2c is None:
         try:
             i2c = busio.I2C(board.RX, board.TX)
@@ -47,81 +80,421 @@ def initialize_i2c():
             i2c.unlock()
             print("I2C bus initialized")
         except RuntimeError:
+            attempt += 1
+            if attempt == attempts:
+                print("I2C bus initialization failed")
+                return None
             print("I2C bus initialization failed, retrying in 10 seconds...")
             time.sleep(10)
     return i2c
 
-# Initialize I2C bus
-i2c = initialize_i2c()
+# Initialize I2C bus, a gateway that is down is retried by gateway_task()
+i2c = initialize_i2c(1)
 
 # I2C address of the Arduino Zero
 I2C_ADDRESS = 0x08
 
+# Framed transfers to the Arduino, which buffers 32 bytes per I2C write
+gateway_link = gateway.GatewayLink(i2c, I2C_ADDRESS)
+
 # Set the direction of the wake pin
 WAKE_PIN.direction = digitalio.Direction.OUTPUT
 
-while True:
-    # Receive packets from RFM radio
-    packet = rfm9x.receive(with_header=True)
-    if packet is not None:
-        # Extract packet information
-        packet_text = str(packet[4:], "utf-8")  # Exclude the first 4 bytes of the packet which are the header
-        sending_node = packet[1]  # The second byte in the header is the sender address
-        print(f"Received (raw payload) from node {sending_node}: {packet_text}")
+# Transmit slot of every sender node, see settings.toml
+slot_scheduler = slots.SlotScheduler(os.getenv("TDMA_PERIOD", 1800), os.getenv("TDMA_SLOT_S", 30))
+
+# Handle a command typed on the USB serial console
+def handle_serial_command(line):
+    """
+    Runs a command read from the USB serial console.
 
+    "time <epoch>" sets the clock, which the senders follow through the acks.
+    "stats" prints the link statistics of every node.
+
+    Args:
+        line (str): The command line.
+    """
+    words = line.split()
+    if len(words) == 2 and words[0] == "time":
         try:
-            # Parse the packet for date, time, dendrometer, pressure, temperature, humidity, and moisture data
-            components = packet_text.split(",")
-
-            # Extract date and time
-            date_time_str = components[0].strip()
-            date_str, time_str = date_time_str.split(" ")
-            date_components = date_str.split("/")
-            time_components = time_str.split(":")
-
-            year = int(date_components[0])
-            month = int(date_components[1])
-            day = int(date_components[2])
-            hour = int(time_components[0])
-            minute = int(time_components[1])
-            second = int(time_components[2])
-
-            # Extract values from the packet text
-            dendro0 = float(components[1].split(": ")[1])
-            dendro1 = float(components[2].split(": ")[1])
-            dendro2 = float(components[3].split(": ")[1])
-            dendro3 = float(components[4].split(": ")[1])
-            press = float(components[5].split(": ")[1])
-            temp = float(components[6].split(": ")[1])
-            hum = float(components[7].split(": ")[1])
-            moisture = float(components[8].split(": ")[1])
-
-            # Create a string with the parsed data
-            data_to_send = f"{sending_node},{year},{month},{day},{hour},{minute},{second},{temp},{hum},{press},{dendro0},{dendro1},{dendro2},{dendro3},{moisture}"
-            print(f"Parsed data: Node={sending_node}, Date={date_str}, Time={time_str}, Temp={temp}, Hum={hum}, Press={press}, Dendro={dendro0}, Dendro={dendro1}, Dendro={dendro2}, Dendro={dendro3}, Moisture={moisture}")
-
-            # Wake up the Arduino
-            WAKE_PIN.value = True
-            time.sleep(0.1)  # Wait for a short period to ensure the Arduino is awake
-
-            # Send data over I2C
-            try:
-                while not i2c.try_lock():
-                    pass
-                i2c.writeto(I2C_ADDRESS, bytes(data_to_send, 'utf-8'))
-                i2c.unlock()
-                print("Data sent over I2C")
-            except OSError:
-                print("I2C write failed. Reinitializing I2C bus.")
-                i2c = initialize_i2c()  # Reinitialize I2C bus if write fails
-            finally:
-                WAKE_PIN.value = False  # Set the wake pin to low after sending data
-
-        except (ValueError, IndexError) as e:
-            print(f"Received packet format error: {e}")
-
-        # Print the RSSI value
-        print("RSSI: {0} dB".format(rfm9x.rssi))
-
-        # Send acknowledgement
-        rfm9x.send(bytes(f"Acknowledgement from node {rfm9x.node} to node {sending_node}", "UTF-8"))
+            rtc.RTC().datetime = time.localtime(int(words[1]))
+            print(f"Clock set to {time.localtime()}")
+        except (ValueError, OverflowError) as e:
+            print(f"Invalid time: {e}")
+    elif words == ["stats"]:
+        link_stats.report()
+    elif words:
+        print(f"Unknown command: {line}")
+
+# Recent sequence numbers of every node, to drop retransmitted frames and
+# answer window requests, so it holds at least a full window
+duplicate_filter = dedup.DuplicateFilter(payload.MAX_WINDOW)
+
+# Link statistics of every node, see settings.toml
+link_stats = linkstats.LinkStats(os.getenv("STATS_NODES", 16))
+
+# Format one reading for the gateway
+def format_record(sending_node, fields):
+    """
+    Formats one reading as the CSV line the Arduino gateway expects.
+
+    Args:
+        sending_node (int): The address of the node that sent the reading.
+        fields (tuple): The fields returned by decoder.decode().
+
+    Returns:
+        str: The CSV line.
+    """
+    year, month, day, hour, minute, second, dendro0, dendro1, dendro2, dendro3, press, temp, hum, moisture = fields
+    date_str = f"{year}/{month}/{day}"
+    time_str = f"{hour}:{minute}:{second}"
+
+    # Create a string with the parsed data
+    data_to_send = f"{sending_node},{year},{month},{day},{hour},{minute},{second},{temp},{hum},{press},{dendro0},{dendro1},{dendro2},{dendro3},{moisture}"
+    print(f"Parsed data: Node={sending_node}, Date={date_str}, Time={time_str}, Temp={temp}, Hum={hum}, Press={press}, Dendro={dendro0}, Dendro={dendro1}, Dendro={dendro2}, Dendro={dendro3}, Moisture={moisture}")
+    return data_to_send
+
+# Forward readings to the gateway
+async def forward_to_gateway(lines):
+    """
+    Sends CSV lines to the Arduino gateway over I2C in one framed transfer.
+
+    Args:
+        lines (list): The CSV lines returned by format_record().
+
+    Returns:
+        int: The status of the gateway, gateway.STATUS_COMPLETE if it confirmed
+            the transfer, None if it did not answer on the bus.
+    """
+    global i2c
+    # Wake up the Arduino
+    WAKE_PIN.value = True
+    await asyncio.sleep(0.1)  # Wait for a short period to ensure the Arduino is awake
+
+    # Send data over I2C
+    try:
+        if i2c is None:
+            i2c = initialize_i2c(1)
+            gateway_link.i2c = i2c
+            if i2c is None:
+                return None
+        status = await gateway_link.send(bytes("\n".join(lines), "utf-8"))
+        if status == gateway.STATUS_COMPLETE:
+            print(f"{len(lines)} reading(s) sent over I2C")
+        return status
+    except OSError:
+        print("I2C write failed. Reinitializing I2C bus.")
+        i2c.deinit()
+        i2c = initialize_i2c(1)  # Reinitialize I2C bus if write fails, once so the receiver keeps running
+        gateway_link.i2c = i2c
+        return None
+    finally:
+        WAKE_PIN.value = False  # Set the wake pin to low after sending data
+
+# Readings acknowledged but not forwarded to the gateway yet, see settings.toml
+gateway_queue = []
+GATEWAY_QUEUE_SIZE = os.getenv("GATEWAY_QUEUE_SIZE", 64)
+# Readings sent per transfer, each gateway wake-up moves up to this many
+GATEWAY_BATCH = os.getenv("GATEWAY_BATCH", 4)
+# Longest wait between two attempts while the gateway is down, in seconds
+GATEWAY_RETRY_MAX_S = os.getenv("GATEWAY_RETRY_MAX_S", 60)
+# Wait before sending again while the gateway is busy with the last transfer, in seconds
+GATEWAY_BUSY_DELAY_S = os.getenv("GATEWAY_BUSY_DELAY_S", 5)
+
+# Readings kept on flash while the gateway is down, see settings.toml. The
+# spool head is the only use of the NVM on the receiver, written every few
+# forwarded readings.
+SPOOL_OFFSET = 0
+gateway_spool = spool.Spool("/spool.bin", microcontroller.nvm, SPOOL_OFFSET, os.getenv("SPOOL_SLOTS", 1024))
+gateway_spool.load()
+if gateway_spool.count:
+    print(f"{gateway_spool.count} reading(s) spooled for the gateway")
+gateway_down = False
+
+# Keep one reading on flash
+def spool_reading(line):
+    """
+    Adds a reading to the flash spool.
+
+    Args:
+        line (str): The CSV line.
+
+    Returns:
+        bool: False if the spool cannot take it, e.g. on a read-only filesystem.
+    """
+    return gateway_spool.append(bytes(line, "utf-8"))
+
+# Queue one reading for the gateway
+def queue_for_gateway(sending_node, fields):
+    """
+    Queues one reading for gateway_task().
+
+    Args:
+        sending_node (int): The address of the node that sent the reading.
+        fields (tuple): The fields returned by decoder.decode().
+    """
+    queue_line(format_record(sending_node, fields))
+
+# Queue one CSV line for the gateway
+def queue_line(line):
+    """
+    Queues one CSV line for gateway_task(). While the gateway is down, or
+    older lines are still spooled, the line goes to the flash spool so the
+    order is kept. Otherwise, or if the spool cannot take it, it goes to the
+    memory queue. A full memory queue, e.g. after a long busy spell of the
+    gateway, is moved to the spool, and the oldest line is dropped only if
+    the spool cannot take it either.
+
+    Args:
+        line (str): The CSV line.
+    """
+    if (gateway_down or gateway_spool.count) and spool_reading(line):
+        return
+    if len(gateway_queue) >= GATEWAY_QUEUE_SIZE:
+        spill_gateway_queue()
+        if not gateway_queue and spool_reading(line):
+            return
+    if len(gateway_queue) >= GATEWAY_QUEUE_SIZE:
+        print("Gateway queue full, oldest reading dropped")
+        gateway_queue.pop(0)
+    gateway_queue.append(line)
+
+# Move the memory queue to flash
+def spill_gateway_queue():
+    """
+    Moves the readings of the memory queue to the flash spool, after the
+    spooled ones, when the gateway stops answering or the queue is full.
+    """
+    while gateway_queue and spool_reading(gateway_queue[0]):
+        gateway_queue.pop(0)
+
+# Take the next readings that fit in one transfer
+def fit_transfer(lines):
+    """
+    Gives the first readings that fit in one transfer, at most GATEWAY_BATCH of them.
+
+    Args:
+        lines (list): The CSV lines, oldest first.
+
+    Returns:
+        list: The CSV lines.
+    """
+    batch = []
+    size = 0
+    for line in lines[:GATEWAY_BATCH]:
+        size += len(line) + (1 if batch else 0)
+        if batch and size > gateway.MAX_TRANSFER:
+            break
+        batch.append(line)
+    return batch
+
+# Forward the queued readings to the gateway
+async def gateway_task():
+    """
+    Forwards the readings queued by handle_packet() to the gateway, away from
+    the radio so a slow or missing gateway never delays an acknowledgement.
+    Spooled readings go first, back to back once the gateway answers again.
+    Readings stay queued until the gateway confirms them. While the gateway
+    is busy with the previous transfer they stay in memory and are sent again
+    after GATEWAY_BUSY_DELAY_S seconds. Only when it does not answer, or
+    rejects a transfer, are they moved to the flash spool, and the wait
+    between two attempts doubles while it is down.
+    """
+    global gateway_down
+    retry_delay = 1
+    while True:
+        if gateway_spool.count:
+            lines = fit_transfer([str(record, "utf-8") for record in gateway_spool.peek(GATEWAY_BATCH)])
+            source = gateway_spool
+        elif gateway_queue:
+            lines = fit_transfer(gateway_queue)
+            source = None
+        else:
+            await asyncio.sleep(0.05)
+            continue
+        try:
+            status = await forward_to_gateway(lines)
+        except ValueError as e:
+            # A line too long for a transfer would block the queue
+            print(f"Reading dropped: {e}")
+            status = gateway.STATUS_COMPLETE
+        if status == gateway.STATUS_BUSY:
+            # The gateway is handling the last transfer, e.g. powering up its modem
+            await asyncio.sleep(GATEWAY_BUSY_DELAY_S)
+        elif status == gateway.STATUS_COMPLETE:
+            if source is None:
+                del gateway_queue[:len(lines)]
+            else:
+                source.pop(len(lines))
+            if gateway_down:
+                print(f"Gateway back, {gateway_spool.count} spooled reading(s) left")
+            gateway_down = False
+            retry_delay = 1
+            await asyncio.sleep(0)
+        else:
+            if not gateway_down:
+                print("Gateway down, spooling readings to flash")
+            gateway_down = True
+            spill_gateway_queue()
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, GATEWAY_RETRY_MAX_S)
+
+# Send the link statistics to the gateway every STATS_PERIOD_S seconds
+async def stats_task():
+    """
+    Queues the summary record of every node for the gateway, periodically.
+    """
+    period = os.getenv("STATS_PERIOD_S", 3600)
+    while True:
+        await asyncio.sleep(period)
+        for line in link_stats.records():
+            queue_line(line)
+
+# Packets received but not handled yet, see settings.toml
+rx_queue = rxqueue.RingBuffer(os.getenv("RX_QUEUE_SLOTS", 16))
+
+# Pull received packets out of the radio as soon as they arrive
+async def receive_task():
+    """
+    Keeps the radio in continuous RX mode and moves every received packet to
+    `rx_queue` with its RSSI and SNR.
+
+    The RxDone line (DIO0) is watched when the board has it, otherwise the
+    IRQ flags register is polled. Handling the packets runs from the queue,
+    so a packet that arrives while another one is forwarded is not lost.
+    """
+    rfm9x.listen()
+    while True:
+        ready = DIO0.value if DIO0 is not None else rfm9x.rx_done()
+        if ready:
+            packet = rfm9x.receive(with_header=True, timeout=0)
+            if packet is not None:
+                if not rx_queue.put(packet, rfm9x.last_rssi, rfm9x.last_snr):
+                    print(f"Receive queue full, {rx_queue.dropped} packet(s) dropped")
+        await asyncio.sleep(0)
+
+# Handle the queued packets
+async def process_task():
+    """
+    Acknowledges and parses the packets queued by receive_task().
+    """
+    while True:
+        item = rx_queue.get()
+        if item is None:
+            await asyncio.sleep(0.005)
+            continue
+        handle_packet(*item)
+        await asyncio.sleep(0)
+
+# Watch the USB serial console
+async def serial_task():
+    """
+    Runs the commands typed on the USB serial console.
+
+    Only the bytes already received are read, and a command runs once its
+    line is complete, so a half-typed command never holds up the other tasks.
+    """
+    line = ""
+    while True:
+        available = supervisor.runtime.serial_bytes_available
+        if available:
+            line += sys.stdin.read(available)
+            while "\n" in line:
+                command, line = line.split("\n", 1)
+                handle_serial_command(command.rstrip("\r"))
+            if len(line) > 128:
+                print("Serial command too long, dropped")
+                line = ""
+        await asyncio.sleep(0.1)
+
+# Handle one received packet
+def handle_packet(packet, rssi, snr):
+    """
+    Acknowledges a packet, then parses it and queues its readings for the gateway.
+
+    Binary frames are acknowledged as soon as their header is valid, the
+    radio has already checked the CRC, so the sender does not keep its
+    radio on while the readings are decoded and forwarded.
+
+    Args:
+        packet (bytes): The packet, RFM9x header included.
+        rssi (float): The RSSI of the packet in dBm.
+        snr (float): The SNR of the packet in dB.
+    """
+    # Extract packet information
+    data = packet[4:]  # Exclude the first 4 bytes of the packet which are the header
+    sending_node = packet[1]  # The second byte in the header is the sender address
+    tx_power = packet[2]  # The third byte in the header is the sender TX power
+    flags = packet[3]  # The fourth byte in the header holds the flags
+
+    # After a window of frames, tell the sender which ones arrived
+    window_request = payload.decode_window_request(data)
+    if window_request is not None:
+        seqs = window_request[1]
+        received = [duplicate_filter.contains(sending_node, seq) for seq in seqs]
+        print(f"Window request from node {sending_node}: {received.count(True)}/{len(seqs)} frames received")
+        rfm9x.send(payload.encode_window_ack(sending_node, seqs, received), destination=sending_node,
+                   keep_listening=True)
+        return
+
+    binary = payload.is_frame(data)
+    if binary:
+        if data[0] not in payload.SCHEMAS:
+            print(f"Unknown frame version {data[0]} from node {sending_node}")
+            link_stats.packet(sending_node, None, rssi, snr, time.monotonic())
+            link_stats.error(sending_node)
+            return
+        seq = payload.frame_seq(data)
+        duplicate = duplicate_filter.seen(sending_node, seq)
+        link_stats.packet(sending_node, seq, rssi, snr, time.monotonic(), duplicate)
+    else:
+        link_stats.packet(sending_node, None, rssi, snr, time.monotonic())
+
+    # Send acknowledgement, echoing the sequence number of binary frames
+    # with the radio settings and transmit slot of the node and the time.
+    # Frames of a window are acknowledged together on the window request.
+    if binary:
+        profile = data_rate_advisor.update(sending_node, rssi, snr, tx_power)
+        if not flags & payload.WINDOW_FLAG:
+            ack = payload.encode_ack(sending_node, seq, profile, slot_scheduler.period,
+                                     slot_scheduler.slot(sending_node), time.time())
+            rfm9x.send(ack, destination=sending_node, keep_listening=True)
+    else:
+        rfm9x.send(bytes(f"Acknowledgement from node {rfm9x.node} to node {sending_node}", "UTF-8"),
+                   keep_listening=True)
+
+    try:
+        if binary and duplicate:
+            # The acknowledgement was lost, confirm again without forwarding
+            print(f"Duplicate frame {seq} from node {sending_node}")
+            records = []
+        else:
+            records = decoder.decode(data)
+            if binary:
+                print(f"Received {len(data)} byte frame {seq} with {len(records)} reading(s) from node {sending_node}")
+            else:
+                print(f"Received (raw payload) from node {sending_node}: {str(data, 'utf-8')}")
+        for fields in records:
+            queue_for_gateway(sending_node, fields)
+
+    except (ValueError, IndexError) as e:
+        print(f"Received packet format error: {e}")
+        link_stats.error(sending_node)
+
+    # Print the RSSI and SNR values
+    print(f"RSSI: {rssi} dB, SNR: {snr} dB")
+
+# Run the receive, processing, gateway, serial console and statistics tasks together
+async def main():
+    """
+    Runs the receiver tasks until the board is reset.
+    """
+    await asyncio.gather(
+        asyncio.create_task(receive_task()),
+        asyncio.create_task(process_task()),
+        asyncio.create_task(gateway_task()),
+        asyncio.create_task(serial_task()),
+        asyncio.create_task(stats_task()),
+    )
+
+asyncio.run(main())
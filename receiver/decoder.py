@@ -0,0 +1,99 @@
+import time
+import payload
+
+# Labels of the values in the text payloads of the older sender firmware,
+# "Dendro" is the single dendrometer of the first firmware
+TEXT_LABELS = {
+    "Dendro": "dendro0",
+    "Dendro0": "dendro0",
+    "Dendro1": "dendro1",
+    "Dendro2": "dendro2",
+    "Dendro3": "dendro3",
+    "Press": "pressure",
+    "Temp": "temperature",
+    "Hum": "humidity",
+    "Moisture": "moisture",
+}
+# Where the value of each label goes in a reading
+_TEXT_SLOTS = {label: payload.READING_FIELDS.index(name) for label, name in TEXT_LABELS.items()}
+
+
+# Read a date and time such as "2024/7/5 10:53:26"
+def _date_time(text, end):
+    numbers = []
+    start = 0
+    for separator in "// ::":
+        stop = text.find(separator, start, end)
+        if stop < 0:
+            raise ValueError(f"Invalid date and time: {text[:end]}")
+        numbers.append(int(text[start:stop]))
+        start = stop + 1
+    numbers.append(int(text[start:end]))
+    return tuple(numbers)
+
+
+# Decode a text payload
+def decode_text(text):
+    """
+    Decodes a text payload such as "2024/7/5 10:53:26,Dendro0: 5921.95,...,Moisture: 343"
+    in one pass over the text.
+
+    The values are found by their label, see TEXT_LABELS, so their order and
+    number do not matter. Unknown labels are skipped and missing values are
+    payload.MISSING.
+
+    Args:
+        text (str): The decoded payload.
+
+    Returns:
+        tuple: Date and time fields, followed by the values of payload.READING_FIELDS.
+
+    Raises:
+        ValueError: If the date and time or a value is invalid, or no value is found.
+    """
+    comma = text.find(",")
+    if comma < 0:
+        raise ValueError("No values in text payload")
+    date_time = _date_time(text, comma)
+    values = [payload.MISSING] * len(payload.READING_FIELDS)
+    found = 0
+    start = comma + 1
+    while start < len(text):
+        end = text.find(",", start)
+        if end < 0:
+            end = len(text)
+        colon = text.find(":", start, end)
+        if colon >= 0:
+            slot = _TEXT_SLOTS.get(text[start:colon].strip())
+            if slot is not None:
+                values[slot] = float(text[colon + 1:end])
+                found += 1
+        start = end + 1
+    if not found:
+        raise ValueError("No values in text payload")
+    return date_time + tuple(values)
+
+
+# Decode any payload
+def decode(data):
+    """
+    Decodes a payload of any sender firmware, a binary frame following the
+    schema of its version or an older text payload.
+
+    Args:
+        data (bytes): The payload, without the RFM9x header.
+
+    Returns:
+        list: One tuple per reading: date and time fields, followed by the
+            values of payload.READING_FIELDS.
+
+    Raises:
+        ValueError: If the payload cannot be decoded.
+    """
+    if not payload.is_frame(data):
+        return [decode_text(str(data, "utf-8"))]
+    records = []
+    for reading in payload.decode(data):
+        t = time.localtime(reading.epoch)
+        records.append((t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec) + tuple(reading[3:]))
+    return records
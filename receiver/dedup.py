@@ -0,0 +1,57 @@
+class DuplicateFilter:
+    """
+    Recently received sequence numbers of every node.
+
+    A sender that misses an acknowledgement sends the same frame again. The
+    last `size` sequence numbers of each node are kept, most recent last, so
+    a retransmission is recognized and can be acknowledged again without
+    being forwarded twice.
+
+    Args:
+        size (int, optional): The number of sequence numbers kept per node.
+            Default is 16.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.recent = {}
+        self.duplicates = 0
+
+    def contains(self, node, seq):
+        """
+        Tells whether a frame was received, without recording it.
+
+        Args:
+            node (int): The node that sent the frame.
+            seq (int): The sequence number of the frame.
+
+        Returns:
+            bool: True if the sequence number is in the recent ones of the node.
+        """
+        return seq in self.recent.get(node, ())
+
+    def seen(self, node, seq):
+        """
+        Records a frame and tells whether it was already received.
+
+        Args:
+            node (int): The node that sent the frame.
+            seq (int): The sequence number of the frame.
+
+        Returns:
+            bool: True if the frame is a duplicate.
+        """
+        recent = self.recent.get(node)
+        if recent is None:
+            recent = []
+            self.recent[node] = recent
+        if seq in recent:
+            # Keep the least recently used numbers first
+            recent.remove(seq)
+            recent.append(seq)
+            self.duplicates += 1
+            return True
+        recent.append(seq)
+        if len(recent) > self.size:
+            recent.pop(0)
+        return False
@@ -0,0 +1,151 @@
+import asyncio
+import struct
+
+# The Wire library of the gateway buffers 32 bytes per I2C write
+CHUNK_SIZE = 32
+# Chunk header: data length, transfer id, chunk index, chunk count
+_CHUNK_HEADER = "<BBBB"
+_CHUNK_HEADER_SIZE = struct.calcsize(_CHUNK_HEADER)
+# Data bytes per chunk, the CRC16 takes the last two bytes
+CHUNK_DATA_SIZE = CHUNK_SIZE - _CHUNK_HEADER_SIZE - 2
+# Largest transfer the gateway can reassemble, in bytes
+MAX_TRANSFER = 512
+
+# Status register of the gateway: status, transfer id, chunks received
+STATUS_SIZE = 3
+STATUS_IDLE = 0
+STATUS_RECEIVING = 1
+STATUS_COMPLETE = 2
+STATUS_CRC_ERROR = 3
+STATUS_SEQUENCE_ERROR = 4
+STATUS_BUSY = 5
+STATUS_OVERFLOW = 6
+
+
+# CRC16-CCITT of a chunk
+def crc16(data, crc=0xFFFF):
+    """
+    Computes the CRC16-CCITT (polynomial 0x1021) of some bytes.
+
+    Args:
+        data (bytes): The bytes.
+        crc (int, optional): The initial value. Default is 0xFFFF.
+
+    Returns:
+        int: The CRC.
+    """
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+    return crc
+
+
+# Cut a transfer into chunks
+def chunks(transfer_id, data):
+    """
+    Cuts a transfer into chunks of at most CHUNK_SIZE bytes, each one with
+    its length, the transfer id, its index, the chunk count and a CRC16.
+
+    Args:
+        transfer_id (int): The id of the transfer, 0 to 255.
+        data (bytes): The transfer.
+
+    Returns:
+        list: The chunks.
+
+    Raises:
+        ValueError: If the transfer is empty or larger than MAX_TRANSFER.
+    """
+    if not data or len(data) > MAX_TRANSFER:
+        raise ValueError(f"Transfer of {len(data)} bytes, 1 to {MAX_TRANSFER} allowed")
+    count = (len(data) + CHUNK_DATA_SIZE - 1) // CHUNK_DATA_SIZE
+    result = []
+    for index in range(count):
+        part = data[index * CHUNK_DATA_SIZE:(index + 1) * CHUNK_DATA_SIZE]
+        chunk = struct.pack(_CHUNK_HEADER, len(part), transfer_id, index, count) + part
+        result.append(chunk + struct.pack("<H", crc16(chunk)))
+    return result
+
+
+class GatewayLink:
+    """
+    Framed transfers to the gateway over I2C.
+
+    A transfer, several CSV lines separated by newlines, is cut into chunks
+    that fit the 32-byte Wire buffer of the gateway. The gateway reassembles
+    them, checks every CRC and the chunk order, and exposes the outcome in a
+    status register that is read back once the last chunk is written. A
+    transfer that is not complete is sent again, up to `retries` times.
+    The pause after every chunk yields to the event loop, so a transfer does
+    not hold up the radio.
+
+    Args:
+        i2c (busio.I2C): The I2C bus.
+        address (int): The I2C address of the gateway.
+        retries (int, optional): The attempts per transfer. Default is 3.
+        chunk_delay (float, optional): The pause between two chunks in
+            seconds, to let the gateway handle the previous one. Default is 0.002.
+    """
+
+    def __init__(self, i2c, address, retries=3, chunk_delay=0.002):
+        self.i2c = i2c
+        self.address = address
+        self.retries = retries
+        self.chunk_delay = chunk_delay
+        self.transfer_id = 0
+        self.status = bytearray(STATUS_SIZE)
+
+    def read_status(self):
+        """
+        Reads the status register of the gateway.
+
+        Returns:
+            tuple: The status, the id of the last transfer and its chunks received.
+        """
+        while not self.i2c.try_lock():
+            pass
+        try:
+            self.i2c.readfrom_into(self.address, self.status)
+        finally:
+            self.i2c.unlock()
+        return self.status[0], self.status[1], self.status[2]
+
+    def _write(self, chunk):
+        while not self.i2c.try_lock():
+            pass
+        try:
+            self.i2c.writeto(self.address, chunk)
+        finally:
+            self.i2c.unlock()
+
+    async def send(self, data):
+        """
+        Sends one transfer, as a coroutine.
+
+        Args:
+            data (bytes): The transfer, at most MAX_TRANSFER bytes.
+
+        Returns:
+            int: The last status read, STATUS_COMPLETE if the gateway has the transfer.
+
+        Raises:
+            OSError: If the gateway does not answer on the bus.
+            ValueError: If the transfer is empty or too large.
+        """
+        status = STATUS_IDLE
+        for _ in range(self.retries):
+            self.transfer_id = (self.transfer_id + 1) & 0xFF
+            for chunk in chunks(self.transfer_id, data):
+                self._write(chunk)
+                await asyncio.sleep(self.chunk_delay)
+            status, transfer_id, received = self.read_status()
+            if status == STATUS_COMPLETE and transfer_id == self.transfer_id:
+                return status
+            print(f"Gateway transfer {self.transfer_id} failed with status {status} after {received} chunk(s)")
+            if status == STATUS_BUSY:
+                break
+        return status
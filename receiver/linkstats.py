@@ -0,0 +1,148 @@
+from array import array
+
+# Marks a free slot of the table
+_FREE = -1
+
+
+class LinkStats:
+    """
+    Link and throughput statistics of every sender node.
+
+    The table is kept in fixed-size arrays, one slot per node, so it does not
+    grow with the traffic. It holds the packets received, duplicates, packets
+    that could not be decoded, mean and lowest RSSI and SNR, mean time
+    between packets, and the frames lost, estimated from the gaps in the
+    sequence numbers. Nodes beyond `size` are not tracked.
+
+    Args:
+        size (int, optional): The number of nodes tracked. Default is 16.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.nodes = array("h", [_FREE] * size)
+        self.packets = array("L", [0] * size)
+        self.duplicates = array("L", [0] * size)
+        self.errors = array("L", [0] * size)
+        self.lost = array("L", [0] * size)
+        self.last_seq = array("l", [-1] * size)
+        self.rssi_sum = array("f", [0] * size)
+        self.rssi_min = array("f", [0] * size)
+        self.snr_sum = array("f", [0] * size)
+        self.snr_min = array("f", [0] * size)
+        self.last_arrival = array("f", [0] * size)
+        self.interval_sum = array("f", [0] * size)
+        self.intervals = array("L", [0] * size)
+
+    def _slot(self, node):
+        for index in range(self.size):
+            if self.nodes[index] == node:
+                return index
+        for index in range(self.size):
+            if self.nodes[index] == _FREE:
+                self.nodes[index] = node
+                return index
+        return _FREE
+
+    def packet(self, node, seq, rssi, snr, now, duplicate=False):
+        """
+        Records a received packet.
+
+        Args:
+            node (int): The node that sent the packet.
+            seq (int): The sequence number of the frame, None for a text payload.
+            rssi (float): The RSSI of the packet in dBm.
+            snr (float): The SNR of the packet in dB.
+            now (float): The arrival time in seconds, e.g. time.monotonic().
+            duplicate (bool, optional): True if the frame was already received. Default is False.
+        """
+        index = self._slot(node)
+        if index == _FREE:
+            return
+        if self.packets[index]:
+            self.rssi_min[index] = min(self.rssi_min[index], rssi)
+            self.snr_min[index] = min(self.snr_min[index], snr)
+            self.interval_sum[index] += now - self.last_arrival[index]
+            self.intervals[index] += 1
+        else:
+            self.rssi_min[index] = rssi
+            self.snr_min[index] = snr
+        self.packets[index] += 1
+        self.rssi_sum[index] += rssi
+        self.snr_sum[index] += snr
+        self.last_arrival[index] = now
+        if duplicate:
+            self.duplicates[index] += 1
+        elif seq is not None:
+            # Sequence numbers wrap at 16 bits
+            ahead = (seq - self.last_seq[index]) & 0xFFFF
+            if self.last_seq[index] < 0:
+                self.last_seq[index] = seq
+            elif 0 < ahead < 0x8000:
+                self.lost[index] += ahead - 1
+                self.last_seq[index] = seq
+            elif self.lost[index]:
+                # A frame counted as lost was sent again and arrived late
+                self.lost[index] -= 1
+
+    def error(self, node):
+        """
+        Records a packet that could not be decoded.
+
+        Args:
+            node (int): The node that sent the packet.
+        """
+        index = self._slot(node)
+        if index != _FREE:
+            self.errors[index] += 1
+
+    def summary(self, index):
+        """
+        Summarizes the statistics of one slot.
+
+        Args:
+            index (int): The slot.
+
+        Returns:
+            tuple: The node, packets, duplicates, errors, frames lost, loss in
+                percent, mean and lowest RSSI, mean and lowest SNR, and mean
+                time between packets in seconds, None if the slot is free.
+        """
+        node = self.nodes[index]
+        packets = self.packets[index]
+        if node == _FREE or not packets:
+            return None
+        received = packets - self.duplicates[index]
+        lost = self.lost[index]
+        loss = 100 * lost / (received + lost) if received + lost else 0
+        interval = self.interval_sum[index] / self.intervals[index] if self.intervals[index] else 0
+        return (node, packets, self.duplicates[index], self.errors[index], lost, loss,
+                self.rssi_sum[index] / packets, self.rssi_min[index],
+                self.snr_sum[index] / packets, self.snr_min[index], interval)
+
+    def records(self):
+        """
+        Gives the compact summary record of every node, sent to the gateway.
+
+        Returns:
+            list: One CSV line per node, "S,node,packets,duplicates,errors,lost,
+                loss %,mean RSSI,min RSSI,mean SNR,min SNR,mean interval s".
+        """
+        lines = []
+        for index in range(self.size):
+            summary = self.summary(index)
+            if summary is not None:
+                node, packets, duplicates, errors, lost, loss, rssi, rssi_min, snr, snr_min, interval = summary
+                lines.append(f"S,{node},{packets},{duplicates},{errors},{lost},{loss:.1f},{rssi:.1f},{rssi_min:.1f},"
+                             f"{snr:.1f},{snr_min:.1f},{interval:.0f}")
+        return lines
+
+    def report(self):
+        """Prints the statistics of every node."""
+        print("Node  Packets  Dup  Err  Lost  Loss%  RSSI avg/min   SNR avg/min  Interval s")
+        for index in range(self.size):
+            summary = self.summary(index)
+            if summary is not None:
+                node, packets, duplicates, errors, lost, loss, rssi, rssi_min, snr, snr_min, interval = summary
+                print(f"{node:4d}  {packets:7d}  {duplicates:3d}  {errors:3d}  {lost:4d}  {loss:5.1f}  "
+                      f"{rssi:6.1f}/{rssi_min:6.1f}  {snr:5.1f}/{snr_min:5.1f}  {interval:10.0f}")
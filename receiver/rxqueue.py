@@ -0,0 +1,66 @@
+# Largest packet the RFM9x can receive, header included
+PACKET_SIZE = 256
+
+
+class RingBuffer:
+    """
+    Fixed-size queue of received packets with their signal quality.
+
+    The storage is allocated once and packets are copied into it, so a burst
+    does not grow the heap. When the queue is full the newest packet is
+    dropped and counted; its sender retries since it gets no ack.
+
+    Args:
+        slots (int): The number of packets the queue can hold.
+    """
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.storage = bytearray(slots * PACKET_SIZE)
+        self.lengths = [0] * slots
+        self.rssi = [0] * slots
+        self.snr = [0] * slots
+        self.head = 0
+        self.count = 0
+        self.dropped = 0
+
+    def put(self, packet, rssi, snr):
+        """
+        Queues a packet.
+
+        Args:
+            packet (bytes): The packet, header included.
+            rssi (float): The RSSI of the packet in dBm.
+            snr (float): The SNR of the packet in dB.
+
+        Returns:
+            bool: False if the queue was full and the packet was dropped.
+        """
+        if self.count == self.slots:
+            self.dropped += 1
+            return False
+        index = (self.head + self.count) % self.slots
+        start = index * PACKET_SIZE
+        length = min(len(packet), PACKET_SIZE)
+        self.storage[start:start + length] = packet[:length]
+        self.lengths[index] = length
+        self.rssi[index] = rssi
+        self.snr[index] = snr
+        self.count += 1
+        return True
+
+    def get(self):
+        """
+        Takes the oldest packet out of the queue.
+
+        Returns:
+            tuple: The packet, its RSSI and SNR, or None if the queue is empty.
+        """
+        if not self.count:
+            return None
+        index = self.head
+        start = index * PACKET_SIZE
+        packet = bytes(self.storage[start:start + self.lengths[index]])
+        self.head = (self.head + 1) % self.slots
+        self.count -= 1
+        return packet, self.rssi[index], self.snr[index]
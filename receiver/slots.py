@@ -0,0 +1,45 @@
+class SlotScheduler:
+    """
+    Transmit slots of the sender nodes inside the reporting period.
+
+    The period is cut into slots of `slot_length` seconds and every node gets
+    one of its own, so no two nodes wake up and transmit at the same time.
+    A node first asks for the slot of its address modulo the number of slots,
+    so assignments usually stay the same after a receiver restart, and takes
+    the next free slot if that one is taken. Once every slot is taken, slots
+    are shared.
+
+    Args:
+        period (int): The reporting period in seconds, the measurement
+            interval of the senders.
+        slot_length (int): The length of one slot in seconds, enough for a
+            measurement and its retries.
+    """
+
+    def __init__(self, period, slot_length):
+        self.period = period
+        self.slot_length = slot_length
+        self.count = max(1, period // slot_length)
+        self.slots = {}
+
+    def slot(self, node):
+        """
+        Gives the transmit slot of a node, assigning one on first contact.
+
+        Args:
+            node (int): The node address.
+
+        Returns:
+            int: The offset of the slot from the start of the period, in seconds.
+        """
+        index = self.slots.get(node)
+        if index is None:
+            taken = set(self.slots.values())
+            index = node % self.count
+            for _ in range(self.count):
+                if index not in taken:
+                    break
+                index = (index + 1) % self.count
+            self.slots[node] = index
+            print(f"Node {node} assigned slot {index} of {self.count}")
+        return index * self.slot_length
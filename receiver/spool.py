@@ -0,0 +1,187 @@
+import os
+import struct
+
+# Marks valid spool pointers in memory
+_MAGIC = b"SPL2"
+_FORMAT = "<4sII"
+POINTERS_SIZE = struct.calcsize(_FORMAT)
+
+
+class Spool:
+    """
+    Records waiting for the gateway, kept in a ring of fixed-size slots in a
+    file on flash.
+
+    Each slot holds a length byte, the lap of the ring it was written in and
+    the record, padded to `slot_size` bytes. The file grows one slot at a
+    time on the first pass around the ring and is reused afterwards. When
+    every slot is taken the oldest record is overwritten, so the spool never
+    grows past `slots` records.
+
+    The head (absolute index of the oldest record) is written to a
+    byte-addressable memory only every `flush_every` records and when the
+    spool empties. After a reset
+    the records queued after the saved head are found again from their lap
+    bytes, so none is lost, and at most `flush_every` records already
+    forwarded are sent to the gateway again. Records overwritten since are
+    told apart by their lap.
+
+    Args:
+        path (str): The spool file.
+        memory: The memory holding the head, e.g. microcontroller.nvm.
+        offset (int): Where the pointers start in memory.
+        slots (int): The number of records the spool can hold.
+        slot_size (int, optional): The size of a slot in bytes, at most 257.
+            Default is 192.
+        flush_every (int, optional): The number of records dropped between
+            two writes of the head to memory. Default is 16.
+    """
+
+    def __init__(self, path, memory, offset, slots, slot_size=192, flush_every=16):
+        self.path = path
+        self.memory = memory
+        self.offset = offset
+        self.slots = slots
+        self.slot_size = slot_size
+        self.flush_every = max(1, min(flush_every, slots))
+        self.head = 0
+        self.count = 0
+        self.overwritten = 0
+        self._flushed = 0
+
+    def load(self):
+        """
+        Loads the head from memory, then counts the records queued after it
+        in the file.
+
+        Returns:
+            bool: True if valid pointers were found, False otherwise.
+        """
+        raw = bytes(self.memory[self.offset:self.offset + POINTERS_SIZE])
+        magic, head, _ = struct.unpack(_FORMAT, raw)
+        valid = magic == _MAGIC
+        self.head = head if valid else 0
+        self.count = 0
+        self._flushed = self.head
+        try:
+            with open(self.path, "rb") as file:
+                # Skip the records overwritten in the next lap since the head was saved
+                for _ in range(self.slots):
+                    if self._read_slot(file, self.head + self.slots) is None:
+                        break
+                    self.head += 1
+                while self.count < self.slots and self._read_slot(file, self.head + self.count) is not None:
+                    self.count += 1
+        except OSError:
+            pass
+        return valid
+
+    def _save(self, flush=False):
+        if flush or self.head - self._flushed >= self.flush_every:
+            self.memory[self.offset:self.offset + POINTERS_SIZE] = struct.pack(_FORMAT, _MAGIC, self.head,
+                                                                               self.count)
+            self._flushed = self.head
+
+    def _lap(self, index):
+        return index // self.slots & 0xFF
+
+    def _read_slot(self, file, index):
+        # The record in the slot of an absolute index, None if it was not written in this lap
+        file.seek(index % self.slots * self.slot_size)
+        slot = file.read(self.slot_size)
+        if len(slot) != self.slot_size or slot[1] != self._lap(index) or slot[0] > self.slot_size - 2:
+            return None
+        return slot[2:2 + slot[0]]
+
+    def _file_size(self):
+        try:
+            return os.stat(self.path)[6]
+        except OSError:
+            return 0
+
+    def append(self, record):
+        """
+        Queues a record, overwriting the oldest one if the spool is full.
+
+        Args:
+            record (bytes): The record, at most `slot_size - 2` bytes.
+
+        Returns:
+            bool: False if the record is too long or the file cannot be written.
+        """
+        if len(record) > self.slot_size - 2:
+            print(f"Record of {len(record)} bytes too long for the spool")
+            return False
+        index = self.head + self.count
+        position = index % self.slots * self.slot_size
+        size = self._file_size()
+        if position > size:
+            # The file does not match the pointers, start over
+            print("Spool corrupted, clearing it")
+            self.clear()
+            index = position = size = 0
+        try:
+            with open(self.path, "r+b" if size else "wb") as file:
+                file.seek(position)
+                file.write(bytes((len(record), self._lap(index))) + record + bytes(self.slot_size - 2 - len(record)))
+        except OSError as e:
+            print(f"Error writing to spool: {e}")
+            return False
+        if self.count == self.slots:
+            self.head += 1
+            self.overwritten += 1
+        else:
+            self.count += 1
+        self._save()
+        return True
+
+    def peek(self, limit=1):
+        """
+        Reads the oldest queued records.
+
+        Args:
+            limit (int, optional): The largest number of records to read. Default is 1.
+
+        Returns:
+            list: The records, oldest first. Empty if the spool is empty or cannot be read.
+        """
+        records = []
+        if not self.count:
+            return records
+        try:
+            with open(self.path, "rb") as file:
+                for index in range(self.head, self.head + min(limit, self.count)):
+                    record = self._read_slot(file, index)
+                    if record is None:
+                        print("Spool corrupted, clearing it")
+                        self.clear()
+                        return []
+                    records.append(record)
+        except OSError as e:
+            print(f"Error reading spool: {e}")
+            return []
+        return records
+
+    def pop(self, count=1):
+        """
+        Drops the oldest queued records once the gateway has them.
+
+        Args:
+            count (int, optional): The number of records to drop. Default is 1.
+        """
+        count = min(count, self.count)
+        if not count:
+            return
+        self.head += count
+        self.count -= count
+        # The spool only fills up while the gateway is down, save the head once it is drained
+        self._save(not self.count)
+
+    def clear(self):
+        """Empties the spool and deletes the file."""
+        self.head = self.count = 0
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self._save(flush=True)
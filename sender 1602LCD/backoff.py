@@ -0,0 +1,109 @@
+import asyncio
+import random
+import time
+
+# RFM9x register holding the current channel RSSI
+_REG_RSSI_VALUE = 0x1B
+
+
+class RetryPolicy:
+    """
+    Randomized exponential backoff and listen-before-talk for the radio.
+
+    Before a retry the sender waits a random time between 0 and
+    `base * 2 ** attempt` seconds, capped at `cap`, so nodes whose frames
+    collided do not retry in lockstep. Before every transmission the channel
+    RSSI is checked, and the transmission is deferred while it is above
+    `rssi_threshold`, i.e. while another node is on air.
+
+    Counters are kept for diagnostics: transmissions, frames acknowledged and
+    given up, retries, channel busy deferrals, total backoff time, and
+    collisions, the retries of a transmission sent on a clear channel, which
+    were most likely hit by a node out of earshot.
+
+    Args:
+        rfm9x (RFM9x): The radio.
+        base (float, optional): The first backoff window in seconds. Default is 0.5.
+        cap (float, optional): The largest backoff window in seconds. Default is 16.
+        rssi_threshold (int, optional): The RSSI in dBm above which the channel
+            is busy. Default is -90.
+        max_defer (float, optional): The longest wait for a clear channel in
+            seconds, the frame is sent anyway after it. Default is 5.
+    """
+
+    def __init__(self, rfm9x, base=0.5, cap=16.0, rssi_threshold=-90, max_defer=5.0):
+        self.rfm9x = rfm9x
+        self.base = base
+        self.cap = cap
+        self.rssi_threshold = rssi_threshold
+        self.max_defer = max_defer
+        self.stats = {"sent": 0, "acked": 0, "failed": 0, "retries": 0, "deferrals": 0, "backoff_s": 0.0,
+                      "collisions": 0}
+        self._was_clear = False
+
+    def channel_rssi(self):
+        """
+        Reads the current RSSI of the channel.
+
+        Returns:
+            int: The RSSI in dBm.
+        """
+        raw = self.rfm9x._read_u8(_REG_RSSI_VALUE)
+        return raw - (164 if self.rfm9x.frequency_mhz < 525 else 157)
+
+    async def clear_channel(self):
+        """
+        Waits until no other node is on air, or `max_defer` seconds at most.
+
+        Returns:
+            bool: True if the channel was clear, False if the wait timed out.
+        """
+        self.rfm9x.listen()
+        deadline = time.monotonic() + self.max_defer
+        while True:
+            # Let the receiver settle and measure the channel
+            await asyncio.sleep(0.005)
+            if self.channel_rssi() < self.rssi_threshold:
+                return True
+            if time.monotonic() > deadline:
+                return False
+            self.stats["deferrals"] += 1
+            await asyncio.sleep(random.uniform(0.02, 0.1))
+
+    async def backoff(self, attempt):
+        """
+        Waits before a retry.
+
+        Args:
+            attempt (int): The number of the retry, from 1.
+        """
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+        self.stats["retries"] += 1
+        if self._was_clear:
+            self.stats["collisions"] += 1
+        self.stats["backoff_s"] += delay
+        print(f"Backing off {delay:.2f} s")
+        await asyncio.sleep(delay)
+
+    async def before_send(self, attempt):
+        """
+        Backs off if this is a retry, then waits for a clear channel.
+
+        Args:
+            attempt (int): The number of the attempt, from 0.
+        """
+        if attempt:
+            await self.backoff(attempt)
+        self._was_clear = await self.clear_channel()
+        if not self._was_clear:
+            print("Channel busy, sending anyway")
+        self.stats["sent"] += 1
+
+    def record(self, acked):
+        """
+        Counts the outcome of a frame once it is acknowledged or given up.
+
+        Args:
+            acked (bool): True if the frame was acknowledged.
+        """
+        self.stats["acked" if acked else "failed"] += 1
@@ -0,0 +1,88 @@
+import os
+
+import payload
+
+
+class Batch:
+    """
+    Readings waiting to be sent together in one LoRa frame.
+
+    Records are kept in memory and mirrored to a file, so a batch that is
+    still filling up survives deep sleep and resets. The batch is complete
+    when it holds `size` records, when its oldest record is `max_age` seconds
+    old, or when the next record might not fit in the frame any more.
+
+    Args:
+        path (str): The file mirroring the pending records.
+        size (int, optional): The number of records per frame, 1 sends every
+            reading on its own. Default is 1.
+        max_age (int, optional): The age in seconds of the oldest record at
+            which the batch is sent anyway, 0 for no limit. Default is 0.
+    """
+
+    def __init__(self, path, size=1, max_age=0):
+        self.path = path
+        self.size = max(1, min(size, payload.MAX_RECORDS))
+        self.max_age = max_age
+        self.records = []
+
+    def load(self):
+        """Reads back the records left in the file by a previous run."""
+        self.records = []
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except OSError:
+            return
+        for start in range(0, len(data) - payload.RECORD_SIZE + 1, payload.RECORD_SIZE):
+            self.records.append(data[start:start + payload.RECORD_SIZE])
+
+    def add(self, record):
+        """
+        Adds a record to the batch.
+
+        Args:
+            record (bytes): A record made by payload.pack_record().
+        """
+        self.records.append(record)
+        if self.size == 1:
+            return
+        try:
+            with open(self.path, "ab") as file:
+                file.write(record)
+        except OSError as e:
+            print(f"Error saving pending reading: {e}")
+
+    def ready(self, now):
+        """
+        Tells whether the batch should be sent.
+
+        Args:
+            now (int): The current epoch time.
+
+        Returns:
+            bool: True if the batch is complete.
+        """
+        if not self.records:
+            return False
+        if len(self.records) >= self.size:
+            return True
+        # Room for the largest possible delta of the next reading
+        if len(payload.encode_batch(0, 0, self.records)) + payload.MAX_DELTA_SIZE > payload.MAX_PAYLOAD:
+            return True
+        return bool(self.max_age) and now - payload.record_epoch(self.records[0]) >= self.max_age
+
+    def take(self):
+        """
+        Empties the batch.
+
+        Returns:
+            list: The records of the batch, oldest first.
+        """
+        records = self.records
+        self.records = []
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        return records
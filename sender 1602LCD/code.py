@@ -3,6 +3,8 @@
 
 
 import time
+import asyncio
+import alarm
 import board
 import busio
 import digitalio
@@ -15,11 +17,22 @@ from adafruit_display_text import label
 from adafruit_dps310.basic import DPS310
 from adafruit_sht4x import SHT4x
 from adafruit_rfm9x import RFM9x
-from adafruit_ads1x15.ads1115 import ADS1115
+import adafruit_ads1x15.ads1115 as ADS
 from adafruit_ads1x15.analog_in import AnalogIn
 from adafruit_seesaw.seesaw import Seesaw
 from lcd.lcd import LCD
 from lcd.i2c_pcf8574_interface import I2CPCF8574Interface
+import circuitpython_csv as csv
+import sampling
+import sensors
+import state
+import discovery
+import payload
+import batch
+import outbox
+import adr
+import backoff
+import clock
 
 
 
@@ -29,46 +42,26 @@ import ulab.numpy as np
 # Global variable to store the CSV filename
 csv_filename = None
 
-# Function to scan the I2C bus
-def i2c_scan(i2c):
-    """
-    Scans the I2C bus for connected devices.
-
-    Args:
-        i2c: The I2C bus object.
-
-    Returns:
-        A list of hexadecimal addresses representing the connected I2C devices.
-    """
-    print("Scanning I2C bus...")
-    devices = []
-    while not i2c.try_lock():
-        pass
-    try:
-        for address in range(0x08, 0x78):
-            try:
-                i2c.writeto(address, b'')
-                devices.append(hex(address))
-            except OSError:
-                pass
-    finally:
-        i2c.unlock()
-    if devices:
-        print("Found I2C device(s):", devices)
-    else:
-        print("No I2C devices found.")
-    return devices
-
 # Create I2C interfaces
 i2c0 = board.STEMMA_I2C()
 i2c1 = busio.I2C(scl=board.RX, sda=board.TX)
 
-# Scan I2C bus for devices
-i2c_devices = i2c_scan(i2c1)
-i2c_test = i2c_scan(i2c0)
+# I2C addresses of the expected devices
+LCD_ADDRESS = 0x27
+SEESAW_ADDRESS = 0x36
+DPS310_ADDRESS = 0x77
+SHT41_ADDRESS = 0x44
+ADS1115_ADDRESS = 0x48
+
+# Where the I2C device map is kept in NVM, after the measurement state
+DEVICE_MAP_OFFSET = 64
+# Where the outbox pointers are kept in NVM and sleep memory, after the I2C device map
+OUTBOX_OFFSET = 112
+# Where the clock discipline is kept in NVM and sleep memory, after the outbox pointers
+CLOCK_OFFSET = 128
 
 # Initialize LCD
-lcd = LCD(I2CPCF8574Interface(i2c1, 0x27), num_rows=2, num_cols=16)
+lcd = LCD(I2CPCF8574Interface(i2c1, LCD_ADDRESS), num_rows=2, num_cols=16)
 lcd.clear()
 
 # Configure buttons
@@ -88,9 +81,34 @@ b4 = digitalio.DigitalInOut(board.D10)
 b4.direction = digitalio.Direction.INPUT
 b4.pull = digitalio.Pull.DOWN
 
+# Measurement state, kept across deep sleep in sleep memory and across resets in NVM
+cycle_state = state.CycleState(microcontroller.nvm, cache=alarm.sleep_memory)
+
+# Resume measurements right away after a reset or a deep sleep wake-up,
+# holding B1, B2 or B3 at power-up stops them and shows the menu instead
+resume_measurements = cycle_state.load() and cycle_state.active
+if resume_measurements and (b1.value or b2.value or b3.value):
+    print("Button held at power-up, measurement mode stopped.")
+    cycle_state.clear()
+    resume_measurements = False
+
+# Check the expected I2C devices against the map saved at the last boot,
+# the buses are only fully scanned when something changed
+i2c_map = discovery.DeviceMap(microcontroller.nvm, DEVICE_MAP_OFFSET, ("i2c1", "i2c0"))
+i2c_map.discover_all({
+    "i2c1": (i2c1, (LCD_ADDRESS,)),
+    "i2c0": (i2c0, (SEESAW_ADDRESS, DPS310_ADDRESS, SHT41_ADDRESS, ADS1115_ADDRESS)),
+})
+
 # Initialize RTC
 rtc_instance = rtc.RTC()
 
+# Keeps the RTC on the receiver time carried by the acks, and the schedule
+# on the RTC when the RTC was not set
+clock_discipline = clock.ClockDiscipline(rtc_instance, microcontroller.nvm, CLOCK_OFFSET, cache=alarm.sleep_memory,
+                                         schedule=cycle_state)
+clock_discipline.load()
+
 # Time variables
 hours = 0
 minutes = 0
@@ -104,11 +122,19 @@ RADIO_FREQ_MHZ = 915.0
 CS = digitalio.DigitalInOut(RFM_CS)  # Replace RFM_CS with the correct pin
 RESET = digitalio.DigitalInOut(RFM_RST)  # Replace RFM_RST with the correct pin
 spi = busio.SPI(board.SCK, MOSI=board.MOSI, MISO=board.MISO)
+# Radio profile used at boot and after lost acks, see settings.toml
+default_radio_profile = adr.Profile(os.getenv("LORA_SPREADING_FACTOR", 7), os.getenv("LORA_BANDWIDTH", 125000),
+                                    os.getenv("LORA_TX_POWER", 23))
 try:
     rfm9x = RFM9x(spi, CS, RESET, RADIO_FREQ_MHZ)
-    rfm9x.tx_power = 23
+    rfm9x.enable_crc = True  # The receiver acknowledges only frames with a valid CRC
     rfm9x.node = 2
     rfm9x.destination = 1
+    data_rate = adr.DataRateController(rfm9x, default_radio_profile, os.getenv("ADR_HYSTERESIS_DB", 2),
+                                       os.getenv("ADR_FALLBACK_FAILURES", 3))
+    data_rate.set_profile(default_radio_profile)
+    retry_policy = backoff.RetryPolicy(rfm9x, os.getenv("BACKOFF_BASE_MS", 500) / 1000,
+                                       os.getenv("BACKOFF_MAX_MS", 16000) / 1000, os.getenv("LBT_RSSI_THRESHOLD", -90))
 except Exception as e:
     print(f"Error initializing RFM9x: {e}")
 
@@ -239,263 +265,42 @@ def set_time_mode():
                 time.sleep(0.2)  # Debounce delay
                 break
 
-# Initialize soil moisture sensor
-try:
-    ss = Seesaw(i2c0, addr=0x36)
-except Exception as e:
-    print(f"Error initializing soil moisture sensor: {e}")
-    ss = None
-
-def read_moisture():
-    """
-    Reads the soil moisture level.
-
-    Returns:
-        int: The soil moisture level.
-    """
-    if ss:
-        try:
-            return ss.moisture_read()
-        except Exception as e:
-            print(f"Error reading soil moisture: {e}")
-            return 0
-    else:
-        return 0
+# Environmental sensors, each driver is created once and cached
+sensor_registry = sensors.SensorRegistry()
+sensor_registry.register("moisture", lambda: Seesaw(i2c0, addr=SEESAW_ADDRESS), lambda ss: ss.moisture_read(), 0,
+                         i2c_map.present("i2c0", SEESAW_ADDRESS))
+sensor_registry.register("dps310", lambda: DPS310(i2c0), lambda dps: (dps.temperature, dps.pressure), (0, 0),
+                         i2c_map.present("i2c0", DPS310_ADDRESS))
+sensor_registry.register("sht41", lambda: SHT4x(i2c0), lambda sht: sht.measurements, (0, 0),
+                         i2c_map.present("i2c0", SHT41_ADDRESS))
 
-def read_dps310():
-    """
-    Reads the temperature and pressure from the DPS310 sensor.
-
-    Returns:
-        temperature (float): The temperature in degrees Celsius.
-        pressure (float): The pressure in Pascal.
-    """
+# Initialize ADS1115 for ADC readings
+ads = None
+adc_channels = [None, None, None, None]
+if i2c_map.present("i2c0", ADS1115_ADDRESS):
     try:
-        dps310 = DPS310(i2c0)
-        return dps310.temperature, dps310.pressure
+        ads = ADS.ADS1115(i2c0, address=ADS1115_ADDRESS)
+        adc_channels = [AnalogIn(ads, ADS.P0), AnalogIn(ads, ADS.P1), AnalogIn(ads, ADS.P2), AnalogIn(ads, ADS.P3)]
     except Exception as e:
-        print(f"Error reading DPS310: {e}")
-        return 0, 0  # Return 0 in case of error
-
-def read_sht41():
-    """
-    Reads the measurements from the SHT41 sensor.
-
-    Returns:
-        tuple: A tuple containing the temperature and humidity measurements.
-               If an error occurs during reading, (0, 0) is returned.
-    """
+        print(f"Error initializing ADS1115: {e}")
+        ads = None
+        adc_channels = [None, None, None, None]
+else:
+    print("ADS1115 not found, dendrometers disabled.")
+
+# Dendrometer sampling window, see settings.toml
+adc_samples = os.getenv("ADC_SAMPLES", sampling.DEFAULT_SAMPLES)
+adc_sample_delay = os.getenv("ADC_SAMPLE_DELAY_MS", 100) / 1000
+adc_buffer = sampling.SampleBuffer(len(adc_channels), adc_samples, os.getenv("ADC_TRIM_PERCENT", 10) / 100,
+                                   gain=ads.gain if ads else 1)
+
+# Read conversions as soon as the ADS1115 finishes them in "paced" mode
+adc_sampler = None
+if ads and os.getenv("ADC_MODE", "delay") == "paced":
     try:
-        sht = SHT4x(i2c0)
-        return sht.measurements
+        adc_sampler = sampling.PacedSampler(ads, os.getenv("ADC_DATA_RATE", 860), os.getenv("ADS_ALERT_PIN"))
     except Exception as e:
-        print(f"Error reading SHT41: {e}")
-        return 0, 0  # Return 0 in case of error
-
-# Initialize ADS1115 for ADC readings
-try:
-    ads = ADS.ADS1115(i2c0)
-    adc0 = AnalogIn(ads, ADS.P0)
-    adc1 = AnalogIn(ads, ADS.P1)
-    adc2 = AnalogIn(ads, ADS.P2)
-    adc3 = AnalogIn(ads, ADS.P3)
-except Exception as e:
-    print(f"Error initializing ADS1115: {e}")
-    ads = None
-    adc0 = None
-    adc1 = None
-    adc2 = None
-    adc3 = None
-
-# Read ADC values
-def read_adc0():
-    """
-    Reads the value from ADC0 and calculates the corresponding voltage and microns.
-
-    Returns:
-        voltage (float): The voltage value read from ADC0.
-        microns (float): The corresponding value in microns calculated from the voltage.
-
-    Raises:
-        Exception: If there is an error reading the ADC.
-    """
-    if adc0:
-        try:
-            adc_value = adc0.value
-            if adc_value < 0:
-                adc_value = 0
-            voltage = ((adc_value) / 65535.0) * (3.3)
-            microns = voltage / (3.3) * 25400
-            return voltage, microns
-        except Exception as e:
-            print(f"Error reading ADC: {e}")
-            return 0, 0
-    else:
-        return 0, 0
-
-def read_adc1():
-    """
-    Reads the value from ADC1 and calculates the corresponding voltage and microns.
-
-    Returns:
-        voltage (float): The voltage value read from ADC1.
-        microns (float): The corresponding value in microns calculated from the voltage.
-
-    Raises:
-        Exception: If there is an error reading the ADC.
-    """
-    if adc1:
-        try:
-            adc_value = adc1.value
-            if adc_value < 0:
-                adc_value = 0
-            voltage = ((adc_value) / 65535.0) * (3.3)
-            microns = voltage / (3.3) * 25400
-            return voltage, microns
-        except Exception as e:
-            print(f"Error reading ADC: {e}")
-            return 0, 0
-    else:
-        return 0, 0
-        
-
-def read_adc2():
-    """
-    Reads the value from ADC2 and calculates the corresponding voltage and microns.
-
-    Returns:
-        voltage (float): The voltage value read from ADC2.
-        microns (float): The corresponding value in microns calculated from the voltage.
-
-    Raises:
-        Exception: If there is an error reading the ADC.
-
-    """
-    if adc2:
-        try:
-            adc_value = adc2.value
-            if adc_value < 0:
-                adc_value = 0
-            voltage = ((adc_value) / 65535.0) * (3.3)
-            microns = voltage / (3.3) * 25400
-            return voltage, microns
-        except Exception as e:
-            print(f"Error reading ADC: {e}")
-            return 0, 0
-    else:
-        return 0, 0
-        
-
-def read_adc3():
-    """
-    Reads the value from ADC3 and calculates the corresponding voltage and microns.
-
-    Returns:
-        voltage (float): The voltage value read from ADC3.
-        microns (float): The corresponding value in microns calculated from the voltage.
-
-    Raises:
-        Exception: If there is an error reading the ADC.
-
-    """
-    if adc3:
-        try:
-            adc_value = adc3.value
-            if adc_value < 0:
-                adc_value = 0
-            voltage = ((adc_value) / 65535.0) * (3.3)
-            microns = voltage / (3.3) * 25400
-            return voltage, microns
-        except Exception as e:
-            print(f"Error reading ADC: {e}")
-            return 0, 0
-    else:
-        return 0, 0
-
-# Calculate moving average of ADC values over 100 readings
-def mean_adc0():
-    """
-    Calculate the mean values of microns and voltages obtained from ADC0.
-
-    Returns:
-        Tuple[float, float]: A tuple containing the mean value of microns and the mean value of voltages.
-            If no valid values are obtained, (0, 0) is returned.
-    """
-    microns_values0 = []
-    voltages_values0 = []
-    for i in range(100):
-        voltage0, microns0 = read_adc0()
-        if voltage0 is not None and microns0 is not None:
-            microns_values0.append(microns0)
-            voltages_values0.append(voltage0)
-        time.sleep(0.1)  # Adjust this delay based on measurement speed
-    if microns_values0 and voltages_values0:
-        return sum(microns_values0) / len(microns_values0), sum(voltages_values0) / len(voltages_values0)
-    else:
-        return 0, 0
-
-def mean_adc1():
-    """
-    Calculate the mean values of microns and voltages obtained from ADC1.
-
-    Returns:
-        Tuple[float, float]: A tuple containing the mean value of microns and the mean value of voltages.
-            If no valid values are obtained, (0, 0) is returned.
-    """
-    microns_values1 = []
-    voltages_values1 = []
-    for i in range(100):
-        voltage1, microns1 = read_adc1()
-        if voltage1 is not None and microns1 is not None:
-            microns_values1.append(microns1)
-            voltages_values1.append(voltage1)
-        time.sleep(0.1)  # Adjust this delay based on measurement speed
-    if microns_values1 and voltages_values1:
-        return sum(microns_values1) / len(microns_values1), sum(voltages_values1) / len(voltages_values1)
-    else:
-        return 0, 0
-
-def mean_adc2():
-    """
-    Calculate the mean values of microns and voltages obtained from ADC2.
-
-    Returns:
-        Tuple[float, float]: A tuple containing the mean value of microns and the mean value of voltages.
-            If no valid values are obtained, (0, 0) is returned.
-    """
-    microns_values2 = []
-    voltages_values2 = []
-    for i in range(100):
-        voltage2, microns2 = read_adc2()
-        if voltage2 is not None and microns2 is not None:
-            microns_values2.append(microns2)
-            voltages_values2.append(voltage2)
-        time.sleep(0.1)  # Adjust this delay based on measurement speed
-    if microns_values2 and voltages_values2:
-        return sum(microns_values2) / len(microns_values2), sum(voltages_values2) / len(voltages_values2)
-    else:
-        return 0, 0
-
-def mean_adc3():
-    """
-    Calculate the mean values of microns and voltages obtained from ADC3.
-
-    Returns:
-        Tuple[float, float]: A tuple containing the mean value of microns and the mean value of voltages.
-            If no valid values are obtained, (0, 0) is returned.
-    """
-    microns_values3 = []
-    voltages_values3 = []
-    for i in range(100):
-        voltage3, microns3 = read_adc3()
-        if voltage3 is not None and microns3 is not None:
-            microns_values3.append(microns3)
-            voltages_values3.append(voltage3)
-        time.sleep(0.1)  # Adjust this delay based on measurement speed
-    if microns_values3 and voltages_values3:
-        return sum(microns_values3) / len(microns_values3), sum(voltages_values3) / len(voltages_values3)
-    else:
-        return 0, 0
+        print(f"Error initializing paced ADC sampling: {e}")
 
 # Send data without waiting for acknowledgement
 def send_data_without_ack(data):
@@ -517,11 +322,57 @@ def send_data_without_ack(data):
     except Exception as e:
         print(f"Error sending data: {e}")
 
+# Wait for an acknowledgement without blocking the other tasks
+async def wait_for_ack(seq, timeout=2.0):
+    """
+    Waits for the acknowledgement of a frame while letting the other asyncio tasks run.
+
+    Packets that are not the acknowledgement of this node and sequence
+    number, such as traffic from other nodes, are ignored.
+
+    Args:
+        seq (int): The sequence number of the frame.
+        timeout (float, optional): The time to wait in seconds. Default is 2.0.
+
+    Returns:
+        payload.Ack: The acknowledgement, or None if it did not arrive in time.
+    """
+    rfm9x.listen()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if rfm9x.rx_done():
+            ack = payload.decode_ack(rfm9x.receive(timeout=0))
+            if ack is not None and ack.node == rfm9x.node and ack.seq == seq:
+                return ack
+        await asyncio.sleep(0.01)
+    return None
+
+# Follow the time and transmit slot given by the receiver
+def apply_slot(ack):
+    """
+    Sets the clock from the receiver time carried by an ack, then moves the
+    measurement schedule to the transmit slot it carries.
+
+    Args:
+        ack (payload.Ack): The acknowledgement.
+    """
+    if ack.epoch is not None:
+        clock_discipline.sync(ack.epoch)
+    if ack.slot is None:
+        return
+    if ack.period != cycle_state.interval:
+        print(f"Receiver period {ack.period} s does not match the interval {cycle_state.interval} s")
+    elif cycle_state.active and cycle_state.align(ack.slot):
+        print(f"Transmit slot at {ack.slot} s, next measurement in {cycle_state.next_epoch - time.time()} s")
+
 # Send data with retry and acknowledgement
-def send_data_with_retry(data, retries=5):
+async def send_data_with_retry(data, retries=5):
     """
     Sends data using the rfm9x module with retry mechanism.
 
+    Every attempt waits for a clear channel, and retries back off for a
+    random, exponentially growing time, see backoff.RetryPolicy.
+
     Args:
         data: The data to be sent.
         retries (optional): The number of retries in case of failure. Default is 5.
@@ -529,24 +380,99 @@ def send_data_with_retry(data, retries=5):
     Returns:
         True if the data was successfully sent and acknowledged, False otherwise.
     """
+    seq = payload.frame_seq(data)
     for attempt in range(retries):
         try:
-            rfm9x.send(data)
-            print("Data sent, waiting for acknowledgement...")
+            await retry_policy.before_send(attempt)
+            # The identifier byte of the header reports the TX power to the receiver
+            rfm9x.send(data, identifier=data_rate.profile.tx_power)
+            print(f"Frame {seq} sent, waiting for acknowledgement...")
 
             # Wait for acknowledgement for a certain time (e.g., 2 seconds)
-            ack = rfm9x.receive(timeout=2.0)
+            ack = await wait_for_ack(seq, 2.0)
             if ack is not None:
                 print("Acknowledgement received.")
+                data_rate.ack_received(ack)
+                apply_slot(ack)
+                retry_policy.record(True)
                 return True
             else:
                 print(f"No acknowledgement received. Retry {attempt + 1}/{retries}")
+                data_rate.ack_missed()
         except Exception as e:
             print(f"Error sending data on attempt {attempt + 1}/{retries}: {e}")
 
     print("Failed to send data after maximum retries.")
+    retry_policy.record(False)
+    print("radio stats =" + str(retry_policy.stats))
     return False
 
+# Wait for the acknowledgement of a window without blocking the other tasks
+async def wait_for_window_ack(first_seq, timeout=2.0):
+    """
+    Waits for the acknowledgement of a window of frames.
+
+    Args:
+        first_seq (int): The sequence number of the first frame of the window.
+        timeout (float, optional): The time to wait in seconds. Default is 2.0.
+
+    Returns:
+        tuple: The number of frames received in a row from the first one and the
+            bitmap of missing frames, or None if nothing arrived in time.
+    """
+    rfm9x.listen()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if rfm9x.rx_done():
+            ack = payload.decode_window_ack(rfm9x.receive(timeout=0))
+            if ack is not None and ack[0] == rfm9x.node and ack[1] == first_seq:
+                return ack[2], ack[3]
+        await asyncio.sleep(0.01)
+    return None
+
+# Send a window of frames, retransmitting only the missing ones
+async def send_window(frames, retries=5):
+    """
+    Sends frames back to back, then asks the receiver which ones arrived and
+    sends again only those that were missed (selective repeat).
+
+    Args:
+        frames (list): Up to payload.MAX_WINDOW frames.
+        retries (optional): The number of rounds. Default is 5.
+
+    Returns:
+        int: The number of frames acknowledged in a row from the first one.
+    """
+    seqs = [payload.frame_seq(frame) for frame in frames]
+    request = payload.encode_window_request(rfm9x.node, seqs)
+    missing = (1 << len(frames)) - 1
+    received = 0
+    for attempt in range(retries):
+        try:
+            await retry_policy.before_send(attempt)
+            for index in range(len(frames)):
+                if missing & (1 << index):
+                    rfm9x.send(frames[index], identifier=data_rate.profile.tx_power, flags=payload.WINDOW_FLAG)
+                    await asyncio.sleep(0)
+            rfm9x.send(request)
+            result = await wait_for_window_ack(seqs[0], 2.0)
+            if result is None:
+                print(f"No window acknowledgement received. Retry {attempt + 1}/{retries}")
+                data_rate.ack_missed()
+                continue
+            data_rate.ack_received(None)
+            received, missing = result
+            if not missing:
+                print(f"Window of {len(frames)} frames acknowledged.")
+                retry_policy.record(True)
+                return len(frames)
+            print(f"{received}/{len(frames)} frames received in a row, resending the missing ones")
+        except Exception as e:
+            print(f"Error sending window on attempt {attempt + 1}/{retries}: {e}")
+    retry_policy.record(False)
+    print("radio stats =" + str(retry_policy.stats))
+    return received
+
 # Set CSV filename based on current date and time
 def set_csv_filename():
     """
@@ -610,103 +536,391 @@ def save_to_csv(data):
                 writer.writerow([
                     "Year", "Month", "Day", "Hour", "Minute", "Second",
                     "Dendrometer 0(uM)", "Dendrometer 1(uM)", "Dendrometer 2(uM)", "Dendrometer 3(uM)", "Pressure(hPa)", "Temp SHT41(C)",
-                    "Humidity(%)", "Moisture Level"
+                    "Humidity(%)", "Moisture Level",
+                    "Dendrometer 0 SD(uM)", "Dendrometer 1 SD(uM)", "Dendrometer 2 SD(uM)", "Dendrometer 3 SD(uM)"
                 ])
             writer.writerow(data)
     except Exception as e:
         print(f"Error writing to CSV: {e}")
 
-# Main function to start measurement mode
-def start_mes_mode():
+# Readings waiting to be written to the CSV file
+csv_queue = []
+
+# Frames waiting to be acknowledged by the receiver, see settings.toml. The
+# pointers are kept in sleep memory and only written to NVM now and then.
+radio_outbox = outbox.Outbox("/outbox.bin", microcontroller.nvm, OUTBOX_OFFSET, os.getenv("OUTBOX_MAX_KB", 512) * 1024,
+                             alarm.sleep_memory)
+radio_outbox.load()
+outbox_drain_delay = os.getenv("OUTBOX_DRAIN_DELAY_MS", 2000) / 1000
+outbox_drain_burst = os.getenv("OUTBOX_DRAIN_BURST", 20)
+outbox_window = min(os.getenv("OUTBOX_WINDOW", 8), payload.MAX_WINDOW)
+# Frames the outbox could not take, sent once by the next drain_outbox()
+unqueued_frames = []
+
+# Queue a frame for the radio
+def queue_packet(packet):
     """
-    Starts the measurement mode and performs measurements at regular intervals.
+    Queues a frame in the outbox. Its sequence number is already used, so a
+    frame the outbox cannot take, because it is full or cannot be written,
+    is kept in memory and sent once by the next drain_outbox() instead.
 
-    This function runs an infinite loop and performs measurements every 30 minutes.
-    It collects data from various sensors, saves the data to a CSV file, and sends the data.
+    Args:
+        packet (bytes): The frame returned by batch_record().
+    """
+    if not radio_outbox.append(packet):
+        print(f"Outbox cannot take frame {payload.frame_seq(packet)}, sending it directly")
+        unqueued_frames.append(packet)
+
+# Send the queued frames in order
+async def drain_outbox():
+    """
+    Sends the frames of the outbox, oldest first, until one is not acknowledged.
+
+    A backlog is sent in windows of `outbox_window` frames with selective
+    repeat, a single frame with stop-and-wait. At most `outbox_drain_burst`
+    frames are sent per call, with `outbox_drain_delay` seconds between
+    windows, so a backlog left by a receiver outage is caught up over the
+    following cycles without hogging the channel.
+
+    Frames the outbox could not take go first, with one stop-and-wait
+    attempt each.
 
     Returns:
-        int: Returns 0 if the measurement mode is stopped.
+        bool: True if the outbox was emptied, False otherwise.
+    """
+    while unqueued_frames:
+        frame = unqueued_frames.pop(0)
+        if not await send_data_with_retry(frame):
+            print(f"Frame {payload.frame_seq(frame)} dropped")
+    sent = 0
+    while radio_outbox.count:
+        if sent >= outbox_drain_burst:
+            return False
+        if sent:
+            await asyncio.sleep(outbox_drain_delay)
+        frames = radio_outbox.peek(min(outbox_window, outbox_drain_burst - sent))
+        if not frames:
+            break
+        if len(frames) > 1:
+            acked = await send_window(frames)
+        else:
+            acked = 1 if await send_data_with_retry(frames[0]) else 0
+        radio_outbox.pop(acked)
+        sent += len(frames)
+        if acked < len(frames):
+            print(f"{radio_outbox.count} frame(s) left in the outbox")
+            return False
+    return True
+
+# Sample the dendrometers without blocking the other tasks
+async def sample_dendrometers():
+    """
+    Samples the four dendrometer channels.
 
+    Returns:
+        list: One sampling.ChannelStats per channel.
+    """
+    if adc_sampler:
+        adc_stats = await adc_sampler.sample_async(adc_buffer)
+    else:
+        adc_stats = await sampling.sample_adcs_async(adc_channels, adc_buffer, adc_sample_delay)
+    for index, stats in enumerate(adc_stats):
+        print(f"microns{index}: mean={stats.mean} median={stats.median} std={stats.std} trimmed={stats.trimmed_mean}")
+    return adc_stats
+
+# Read the environmental sensors
+async def read_environment():
+    """
+    Reads the pressure, temperature, humidity and soil moisture sensors.
+
+    Returns:
+        tuple: Pressure, SHT41 temperature, humidity and moisture level.
+    """
+    temperature_dps310, pressure = sensor_registry.read("dps310")
+    print('temperature_dps310=' + str(temperature_dps310))
+    print('pressure=' + str(pressure))
+    await asyncio.sleep(0)
+
+    temperature_sht41, humidity = sensor_registry.read("sht41")
+    print('temperature_sht41=' + str(temperature_sht41))
+    print('humidity=' + str(humidity))
+    await asyncio.sleep(0)
+
+    moisture = sensor_registry.read("moisture")
+    print("moisture =" + str(moisture))
+    print("sensor errors =" + str(sensor_registry.errors))
+    return pressure, temperature_sht41, humidity, moisture
+
+# Take one set of measurements
+async def measure_once():
+    """
+    Reads every sensor once, the dendrometers and the environmental sensors concurrently.
+
+    Returns:
+        tuple: The row for the CSV file and the record for the radio.
+    """
+    clock_discipline.correct()
+    adc_stats, environment = await asyncio.gather(sample_dendrometers(), read_environment())
+    mean_microns0, mean_microns1, mean_microns2, mean_microns3 = [stats.trimmed_mean for stats in adc_stats]
+    pressure, temperature_sht41, humidity, moisture = environment
+
+    # Update and display current time
+    now = time.time()
+    current_time_struct = time.localtime(now)
+    hours = current_time_struct.tm_hour
+    minutes = current_time_struct.tm_min
+    seconds = current_time_struct.tm_sec
+
+    year = current_time_struct.tm_year
+    month = current_time_struct.tm_mon
+    day = current_time_struct.tm_mday
+
+    row = [year, month, day, hours, minutes, seconds, mean_microns0, mean_microns1, mean_microns2, mean_microns3, pressure, temperature_sht41, humidity, moisture]
+    row.extend([stats.std for stats in adc_stats])
+
+    record = payload.pack_record(now, (mean_microns0, mean_microns1, mean_microns2, mean_microns3),
+                                 pressure, temperature_sht41, humidity, moisture)
+    return row, record
+
+# Readings batched into one LoRa frame, see settings.toml
+pending_batch = batch.Batch("/pending.bin", os.getenv("BATCH_SIZE", 1), os.getenv("BATCH_MAX_AGE", 0))
+pending_batch.load()
+
+# Add a reading to the pending batch
+def batch_record(record):
+    """
+    Adds a reading to the pending batch and builds the frame once the batch is complete.
+
+    Args:
+        record (bytes): The record made by measure_once().
+
+    Returns:
+        bytes: The frame to send, or None while the batch is still filling up.
+    """
+    pending_batch.add(record)
+    if not pending_batch.ready(time.time()):
+        return None
+    return payload.encode_batch(rfm9x.node, cycle_state.next_seq(), pending_batch.take())
+
+# Take one set of measurements every interval
+async def measurement_task(csv_ready, radio_ready):
+    """
+    Performs measurements on the schedule kept in `cycle_state` and hands them
+    to the CSV and radio tasks.
+
+    Args:
+        csv_ready (asyncio.Event): Set when a row is queued for the CSV file.
+        radio_ready (asyncio.Event): Set when a packet is queued for the radio.
+    """
+    while True:
+        # The schedule can move to a new transmit slot while waiting
+        while time.time() < cycle_state.next_epoch:
+            await asyncio.sleep(1)
+
+        row, record = await measure_once()
+        cycle_state.advance(time.time())
+        csv_queue.append(row)
+        csv_ready.set()
+        packet = batch_record(record)
+        if packet:
+            queue_packet(packet)
+        if radio_outbox.count or unqueued_frames:
+            radio_ready.set()
+
+# Write queued readings to the CSV file
+async def csv_task(csv_ready):
+    """
+    Saves the readings queued by the measurement task to the CSV file.
+
+    Args:
+        csv_ready (asyncio.Event): Set when a row is queued for the CSV file.
     """
-    global csv_filename
-    start_time = time.monotonic()
-    interval = 1800  # 30 minutes
     while True:
-        current_time = time.monotonic()
-
-        # If 30-minute interval has passed
-        if current_time - start_time >= interval:
-            mean_microns0, mean_voltages0 = mean_adc0()
-            mean_microns1, mean_voltages1 = mean_adc1()
-            mean_microns2, mean_voltages2 = mean_adc2()
-            mean_microns3, mean_voltages3 = mean_adc3()
-            print('mean microns0=' + str(mean_microns0))
-            print('mean microns1=' + str(mean_microns1))
-            print('mean microns2=' + str(mean_microns2))
-            print('mean microns3=' + str(mean_microns3))
-
-            temperature_dps310, pressure = read_dps310()
-            print('temperature_dps310=' + str(temperature_dps310))
-            print('pressure=' + str(pressure))
-
-            temperature_sht41, humidity = read_dps310()
-            print('temperature_sht41=' + str(temperature_sht41))
-            print('humidity=' + str(humidity))
-
-            moisture = read_moisture()
-            print("moisture =" + str(moisture))
-
-            # Update and display current time
-            current_time_struct = time.localtime()
-            hours = current_time_struct.tm_hour
-            minutes = current_time_struct.tm_min
-            seconds = current_time_struct.tm_sec
-
-            year = current_time_struct.tm_year
-            month = current_time_struct.tm_mon
-            day = current_time_struct.tm_mday
-
-            data = [year, month, day, hours, minutes, seconds, mean_microns0, mean_microns1, mean_microns2, mean_microns3, pressure, temperature_sht41, humidity, moisture]
-            save_to_csv(data)  # Save data to CSV file
-
-            data = f"{year}/{month}/{day} {hours}:{minutes}:{seconds},Dendro0: {mean_microns0},Dendro1: {mean_microns1},Dendro2: {mean_microns2},Dendro3: {mean_microns3}, Press: {pressure}, Temp: {temperature_sht41}, Hum: {humidity}, Moisture: {moisture}"
-            #send_data_without_ack(bytes(data, "UTF-8"))
-            send_data_with_retry(bytes(data, "UTF-8"))
-
-            # Reset start time for next 30-minute period
-            start_time = current_time
-
-        # Check for stop measurement mode
+        await csv_ready.wait()
+        csv_ready.clear()
+        while csv_queue:
+            save_to_csv(csv_queue.pop(0))  # Save data to CSV file
+            await asyncio.sleep(0)
+
+# Send queued readings over LoRa
+async def radio_task(radio_ready):
+    """
+    Sends the frames of the outbox each time the measurement task queues one.
+
+    Args:
+        radio_ready (asyncio.Event): Set when a packet is queued for the radio.
+    """
+    while True:
+        await radio_ready.wait()
+        radio_ready.clear()
+        await drain_outbox()
+
+# Stop measurement mode
+def stop_mes_mode():
+    """
+    Stops measurement mode and resets the board.
+
+    The saved measurement state is cleared and boot.py is renamed so the drive is
+    writable from USB again after the reset.
+    """
+    cycle_state.clear()
+    os.rename('/boot.py', '/boot.bak')
+    microcontroller.reset()
+
+# Ask for confirmation before stopping the measurements
+async def confirm_stop():
+    """
+    Asks for confirmation after B4 was pressed.
+
+    Pressing B4 again within 20 seconds stops the measurements and resets the
+    board, pressing B1 or waiting continues them.
+    """
+    lcd.clear()
+    lcd.set_cursor_pos(0,0)
+    lcd.set_backlight(1)
+    lcd.print("B4 to stop meas")
+    await asyncio.sleep(1)
+
+    # Wait for confirmation
+    confirmation_time = time.monotonic()
+    while time.monotonic() - confirmation_time < 20:
         if b4.value:
+            # Stop measurements
             lcd.clear()
-            lcd.set_cursor_pos(0,0)
-            lcd.set_backlight(1)
-            lcd.print("B4 to stop meas")
-            time.sleep(1)
-
-            # Wait for confirmation
-            confirmation_time = time.monotonic()
-            while time.monotonic() - confirmation_time < 20:
-                if b4.value:
-                    # Stop measurements
-                    lcd.clear()
-                    lcd.set_backlight(0)
-                    os.rename('/boot.py', '/boot.bak')
-                    microcontroller.reset()
-                    return 0
-                if b1.value:
-                    # Continue measurements
-                    display.sleep()
-                    clear_display()
-                    break
-                time.sleep(0.1)
-            lcd.clear()
+            lcd.set_backlight(0)
+            stop_mes_mode()
+        if b1.value:
+            # Continue measurements
+            break
+        await asyncio.sleep(0.1)
+    lcd.clear()
+    lcd.set_backlight(0)
 
-        # Wait a short period before next check
-        time.sleep(1)
+# Watch B4 to stop the measurements
+async def stop_button_task():
+    """
+    Watches B4 and asks for confirmation before stopping the measurements.
+    """
+    while True:
+        if b4.value:
+            await confirm_stop()
+        await asyncio.sleep(0.1)
+
+# Run the measurement tasks together
+async def run_measurement_tasks():
+    """
+    Runs the measurement, CSV, radio and stop button tasks until the board is reset.
+    """
+    csv_ready = asyncio.Event()
+    radio_ready = asyncio.Event()
+    await asyncio.gather(
+        asyncio.create_task(measurement_task(csv_ready, radio_ready)),
+        asyncio.create_task(csv_task(csv_ready)),
+        asyncio.create_task(radio_task(radio_ready)),
+        asyncio.create_task(stop_button_task()),
+    )
+
+# Measurement schedule, see settings.toml
+measurement_mode = os.getenv("MEASUREMENT_MODE", "asyncio")
+measurement_interval = os.getenv("MEASUREMENT_INTERVAL", 1800)
+
+# Deep sleep until the next measurement or until B4 is pressed
+def deep_sleep_until_next_cycle():
+    """
+    Puts the board into deep sleep until the next measurement.
+
+    The board wakes up at `cycle_state.next_epoch` through a time alarm, or
+    earlier through a pin alarm on B4. Either way code.py restarts from the top.
+    """
+    try:
+        rfm9x.sleep()
+    except Exception as e:
+        print(f"Error putting RFM9x to sleep: {e}")
+    remaining = max(1, cycle_state.next_epoch - time.time())
+    print(f"Deep sleep for {remaining} s")
+    time_alarm = alarm.time.TimeAlarm(monotonic_time=time.monotonic() + remaining)
+    b4.deinit()
+    pin_alarm = alarm.pin.PinAlarm(pin=board.D10, value=True, pull=True)
+    alarm.exit_and_deep_sleep_until_alarms(time_alarm, pin_alarm)
+
+# Measure once, save and send, used on each deep sleep wake-up
+async def single_cycle():
+    """
+    Takes one measurement, saves it to the CSV file and queues the pending batch
+    once it is complete, then drains the outbox.
+    """
+    row, record = await measure_once()
+    cycle_state.advance(time.time())
+    save_to_csv(row)  # Save data to CSV file
+    packet = batch_record(record)
+    if packet:
+        queue_packet(packet)
+    await drain_outbox()
+
+# Run measurement mode with the current cycle state
+def run_mes_mode():
+    """
+    Runs the measurement mode selected in settings.toml.
+
+    In "asyncio" mode, measurements run as asyncio tasks: sampling, CSV writing,
+    radio transmission and the stop button are handled concurrently, so the
+    buttons stay responsive during a measurement cycle. In "deep_sleep" mode,
+    the board deep sleeps between measurements.
+    """
+    if measurement_mode == "deep_sleep":
+        deep_sleep_until_next_cycle()
+    asyncio.run(run_measurement_tasks())
+
+# Resume measurement mode after a reset or a deep sleep wake-up
+def resume_mes_mode():
+    """
+    Resumes measurement mode from the state saved in NVM, without the menu.
+
+    The clock is restored from the saved schedule if it was lost. After a time
+    alarm in deep sleep mode one measurement is taken before sleeping again,
+    and a B4 pin alarm asks for confirmation to stop the measurements.
+    """
+    global csv_filename
+    csv_filename = cycle_state.csv_filename
+
+    # The clock is reset with the board, the schedule is the best estimate
+    if isinstance(alarm.wake_alarm, alarm.time.TimeAlarm):
+        if time.time() < cycle_state.next_epoch - 5:
+            rtc_instance.datetime = time.localtime(cycle_state.next_epoch)
+    elif time.time() < cycle_state.last_epoch:
+        rtc_instance.datetime = time.localtime(cycle_state.last_epoch)
+    print(f"Resuming measurement mode, cycle {cycle_state.cycle}")
+
+    if measurement_mode == "deep_sleep":
+        if isinstance(alarm.wake_alarm, alarm.pin.PinAlarm):
+            asyncio.run(confirm_stop())
+        elif time.time() >= cycle_state.next_epoch - 5:
+            asyncio.run(single_cycle())
+    run_mes_mode()
+
+# Main function to start measurement mode
+def start_mes_mode():
+    """
+    Starts the measurement mode and performs measurements at regular intervals.
+
+    The schedule and the CSV filename are saved in NVM first, so measurement
+    mode resumes by itself after a reset.
+
+    Returns:
+        int: Returns 0 if the measurement mode is stopped.
+
+    """
+    set_csv_filename()
+    cycle_state.start(measurement_interval, time.time(), csv_filename)
+    run_mes_mode()
+    return 0
 
 # Place the rest of the code needed to initialize sensors, display, LoRa, etc.
 
+# Skip the menu when measurement mode was active before the reset
+if resume_measurements:
+    resume_mes_mode()
+
 # Global variables for initial configuration
 first_start = time.monotonic()
 timeout_menu = False
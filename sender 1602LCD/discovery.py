@@ -0,0 +1,180 @@
+# Marks a valid device map in memory
+_MAGIC = b"I2CM"
+# One bit per 7-bit address for each bus
+_BITMAP_SIZE = 16
+
+
+# Probe a single I2C address
+def i2c_probe(i2c, address):
+    """
+    Checks whether a device answers at an I2C address.
+
+    Args:
+        i2c: The I2C bus object.
+        address (int): The 7-bit address to probe.
+
+    Returns:
+        bool: True if the device acknowledged, False otherwise.
+    """
+    while not i2c.try_lock():
+        pass
+    try:
+        i2c.writeto(address, b'')
+        return True
+    except OSError:
+        return False
+    finally:
+        i2c.unlock()
+
+
+# Function to scan the I2C bus
+def i2c_scan(i2c):
+    """
+    Scans the I2C bus for connected devices.
+
+    Args:
+        i2c: The I2C bus object.
+
+    Returns:
+        A list of addresses of the connected I2C devices.
+    """
+    print("Scanning I2C bus...")
+    devices = []
+    while not i2c.try_lock():
+        pass
+    try:
+        for address in range(0x08, 0x78):
+            try:
+                i2c.writeto(address, b'')
+                devices.append(address)
+            except OSError:
+                pass
+    finally:
+        i2c.unlock()
+    if devices:
+        print("Found I2C device(s):", [hex(address) for address in devices])
+    else:
+        print("No I2C devices found.")
+    return devices
+
+
+class DeviceMap:
+    """
+    Last known I2C address map of every bus, cached in a byte-addressable memory.
+
+    At boot only the expected addresses are probed. If they all match the
+    cached map, the map is used as is; otherwise the bus is fully scanned and
+    the new map is saved.
+
+    Args:
+        memory: The memory holding the map, e.g. microcontroller.nvm.
+        offset (int): Where the map starts in memory.
+        buses (tuple): The bus names, in the order they are stored.
+    """
+
+    def __init__(self, memory, offset, buses):
+        self.memory = memory
+        self.offset = offset
+        self.buses = buses
+        self.size = len(_MAGIC) + _BITMAP_SIZE * len(buses)
+        self.bitmaps = {bus: bytearray(_BITMAP_SIZE) for bus in buses}
+        self.valid = False
+
+    def load(self):
+        """
+        Loads the cached map from memory.
+
+        Returns:
+            bool: True if a valid map was found, False otherwise.
+        """
+        raw = bytes(self.memory[self.offset:self.offset + self.size])
+        if raw[:len(_MAGIC)] != _MAGIC:
+            return False
+        start = len(_MAGIC)
+        for bus in self.buses:
+            self.bitmaps[bus][:] = raw[start:start + _BITMAP_SIZE]
+            start += _BITMAP_SIZE
+        self.valid = True
+        return True
+
+    def save(self):
+        """Writes the map to memory."""
+        raw = bytearray(_MAGIC)
+        for bus in self.buses:
+            raw.extend(self.bitmaps[bus])
+        self.memory[self.offset:self.offset + self.size] = raw
+        self.valid = True
+
+    def present(self, bus, address):
+        """
+        Tells whether a device was found at an address.
+
+        Args:
+            bus (str): The bus name.
+            address (int): The 7-bit address.
+
+        Returns:
+            bool: True if the device is in the map.
+        """
+        return bool(self.bitmaps[bus][address >> 3] & (1 << (address & 7)))
+
+    def addresses(self, bus):
+        """
+        Lists the addresses in the map for a bus.
+
+        Args:
+            bus (str): The bus name.
+
+        Returns:
+            list: The 7-bit addresses of the devices found.
+        """
+        return [address for address in range(0x80) if self.present(bus, address)]
+
+    def _add(self, bus, address):
+        self.bitmaps[bus][address >> 3] |= 1 << (address & 7)
+
+    def discover(self, bus, i2c, expected):
+        """
+        Updates the map of a bus, probing only the expected addresses when possible.
+
+        Args:
+            bus (str): The bus name.
+            i2c: The I2C bus object.
+            expected (tuple): The addresses of the devices that should be connected.
+
+        Returns:
+            bool: True if the cached map was confirmed, False if the bus was scanned.
+        """
+        if self.valid:
+            matches = True
+            for address in expected:
+                if i2c_probe(i2c, address) != self.present(bus, address):
+                    matches = False
+                    break
+            if matches:
+                return True
+        print(f"I2C map of {bus} changed, scanning.")
+        bitmap = self.bitmaps[bus]
+        for index in range(_BITMAP_SIZE):
+            bitmap[index] = 0
+        for address in i2c_scan(i2c):
+            self._add(bus, address)
+        return False
+
+    def discover_all(self, buses):
+        """
+        Discovers every bus and saves the map if any of them changed.
+
+        Args:
+            buses (dict): Bus name to (I2C bus object, expected addresses).
+        """
+        self.load()
+        changed = False
+        for bus in self.buses:
+            i2c, expected = buses[bus]
+            if not self.discover(bus, i2c, expected):
+                changed = True
+        if changed:
+            self.save()
+        for bus in self.buses:
+            print(f"I2C devices on {bus}:", [hex(address) for address in self.addresses(bus)])
@@ -0,0 +1,186 @@
+import struct
+
+# Marks a valid state record in memory
+_MAGIC = b"DLS3"
+_FORMAT = "<4sIIIII32sI"
+STATE_SIZE = struct.calcsize(_FORMAT)
+
+# Sequence numbers taken between two writes to memory. A record read back
+# from memory after the cache was lost skips as many, so none is reused.
+SEQ_BLOCK = 64
+# Completed cycles between two writes of the schedule to memory
+FLUSH_CYCLES = 8
+
+
+class CycleState:
+    """
+    Measurement schedule and per-cycle state kept in a byte-addressable memory.
+
+    The record is packed with struct so it fits in alarm.sleep_memory, which
+    survives deep sleep, or microcontroller.nvm, which also survives resets
+    and power loss.
+
+    With a cache, every change goes to the cache and `memory` is only written
+    when measurement mode starts or stops, when the schedule moves, every
+    FLUSH_CYCLES cycles and every SEQ_BLOCK sequence numbers, since each NVM
+    write erases a flash sector.
+
+    Args:
+        memory: The memory holding the record, e.g. microcontroller.nvm.
+        offset (int, optional): Where the record starts in memory, and in cache. Default is 0.
+        cache (optional): The memory kept up to date on every change, e.g.
+            alarm.sleep_memory. Default is None.
+    """
+
+    def __init__(self, memory, offset=0, cache=None):
+        self.memory = memory
+        self.offset = offset
+        self.cache = cache
+        self.active = False
+        self.interval = 1800
+        self.cycle = 0
+        self.next_epoch = 0
+        self.last_epoch = 0
+        self.csv_filename = None
+        self.seq = 0
+
+    def _read(self, memory):
+        raw = bytes(memory[self.offset:self.offset + STATE_SIZE])
+        record = struct.unpack(_FORMAT, raw)
+        return record if record[0] == _MAGIC else None
+
+    def load(self):
+        """
+        Loads the record from the cache, or from memory if the cache holds none.
+
+        Returns:
+            bool: True if a valid record was found, False otherwise.
+        """
+        record = self._read(self.cache) if self.cache is not None else None
+        from_memory = record is None
+        if from_memory:
+            record = self._read(self.memory)
+            if record is None:
+                return False
+        _, active, interval, cycle, next_epoch, last_epoch, filename, seq = record
+        self.active = bool(active)
+        self.interval = interval
+        self.cycle = cycle
+        self.next_epoch = next_epoch
+        self.last_epoch = last_epoch
+        filename = filename.rstrip(b"\x00")
+        self.csv_filename = str(filename, "utf-8") if filename else None
+        self.seq = seq
+        if from_memory and self.cache is not None:
+            # The numbers taken since the last write to memory were lost with the cache
+            self.seq = (self.seq + SEQ_BLOCK) & 0xFFFF
+            self.save()
+        return True
+
+    def save(self, flush=True):
+        """
+        Writes the record to the cache and to memory.
+
+        Args:
+            flush (bool, optional): False to only write the cache, if there is
+                one. Default is True.
+        """
+        filename = bytes(self.csv_filename or "", "utf-8")
+        raw = struct.pack(_FORMAT, _MAGIC, int(self.active), self.interval, self.cycle, self.next_epoch,
+                          self.last_epoch, filename, self.seq)
+        if self.cache is not None:
+            self.cache[self.offset:self.offset + STATE_SIZE] = raw
+        if flush or self.cache is None:
+            self.memory[self.offset:self.offset + STATE_SIZE] = raw
+
+    def start(self, interval, now, csv_filename):
+        """
+        Marks measurement mode as active and writes the record to memory.
+
+        Args:
+            interval (int): The time between measurements in seconds.
+            now (int): The current epoch time.
+            csv_filename (str): The CSV file receiving the measurements.
+        """
+        self.active = True
+        self.interval = interval
+        self.cycle = 0
+        self.last_epoch = now
+        self.next_epoch = now + interval
+        self.csv_filename = csv_filename
+        self.save()
+
+    def advance(self, now):
+        """
+        Records a completed measurement cycle and schedules the next one.
+
+        Cycles missed while the board was off are skipped rather than caught
+        up, keeping the schedule on the same slot of the interval.
+
+        Args:
+            now (int): The epoch time of the completed cycle.
+        """
+        self.cycle += 1
+        self.last_epoch = now
+        self.next_epoch += self.interval
+        if self.next_epoch <= now:
+            self.next_epoch += (now - self.next_epoch) // self.interval * self.interval + self.interval
+        self.save(self.cycle % FLUSH_CYCLES == 0)
+
+    def align(self, slot):
+        """
+        Moves the schedule so measurements start `slot` seconds into each interval.
+
+        The next measurement stays at least half an interval after the last
+        one. The record is only written if the schedule changed.
+
+        Args:
+            slot (int): The offset from the start of the interval, in seconds.
+
+        Returns:
+            bool: True if the schedule changed.
+        """
+        start = self.last_epoch - self.last_epoch % self.interval + slot % self.interval
+        while start < self.last_epoch + self.interval // 2:
+            start += self.interval
+        if start == self.next_epoch:
+            return False
+        self.next_epoch = start
+        self.save()
+        return True
+
+    def shift(self, seconds):
+        """
+        Moves the schedule along with a step of the clock, so the time left
+        until the next measurement stays the same.
+
+        Args:
+            seconds (int): The step of the clock, negative for a step back.
+        """
+        if not self.active or not seconds:
+            return
+        self.next_epoch += seconds
+        self.last_epoch += seconds
+        self.save()
+
+    def next_seq(self):
+        """
+        Takes the next frame sequence number and writes the record.
+
+        Unlike the cycle counter, it is not reset when measurement mode
+        restarts, so the receiver never mistakes a new frame for a retry.
+
+        Returns:
+            int: The sequence number, wrapped to 16 bits.
+        """
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.save(self.seq % SEQ_BLOCK == 0)
+        return self.seq
+
+    def clear(self):
+        """Marks measurement mode as stopped and writes the record to memory."""
+        self.active = False
+        self.cycle = 0
+        self.next_epoch = 0
+        self.csv_filename = None
+        self.save()
@@ -0,0 +1,150 @@
+from collections import namedtuple
+
+# Radio settings of one link
+Profile = namedtuple("Profile", ("spreading_factor", "bandwidth", "tx_power"))
+
+# TX power range of the RFM9x high power amplifier, in dB
+MIN_TX_POWER = 5
+MAX_TX_POWER = 23
+
+# Lowest SNR the RFM9x can demodulate at each spreading factor, in dB
+_SNR_FLOOR = {6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+
+
+class DataRateAdvisor:
+    """
+    Recommends radio settings for every node from the quality of its frames.
+
+    Senders report their TX power with every frame, so the SNR of each node is
+    smoothed as the SNR it would get at 0 dB. The recommended power keeps the
+    link `target_margin` dB above the demodulation floor of the spreading
+    factor, and moves by at most `max_step` dB from the reported power per
+    frame. A single RFM9x receiver listens on one spreading factor and
+    bandwidth only, so those are always its own.
+
+    Args:
+        spreading_factor (int): The spreading factor the receiver listens on.
+        bandwidth (int): The bandwidth the receiver listens on, in Hz.
+        target_margin (float, optional): The wanted SNR margin in dB. Default is 10.
+        max_step (int, optional): The largest power change per frame in dB. Default is 3.
+        smoothing (float, optional): The weight of a new SNR sample. Default is 0.25.
+    """
+
+    def __init__(self, spreading_factor, bandwidth, target_margin=10, max_step=3, smoothing=0.25):
+        self.spreading_factor = spreading_factor
+        self.bandwidth = bandwidth
+        self.target_margin = target_margin
+        self.max_step = max_step
+        self.smoothing = smoothing
+        self.snr = {}
+        self.rssi = {}
+        self.tx_power = {}
+
+    def update(self, node, rssi, snr, tx_power=0):
+        """
+        Records the quality of a frame and recommends settings for its node.
+
+        Args:
+            node (int): The node that sent the frame.
+            rssi (float): The RSSI of the frame in dBm.
+            snr (float): The SNR of the frame in dB.
+            tx_power (int, optional): The TX power the frame was sent with, in
+                dB. Senders that do not report it send 0, the last
+                recommended power is assumed then. Default is 0.
+
+        Returns:
+            Profile: The recommended settings.
+        """
+        if not MIN_TX_POWER <= tx_power <= MAX_TX_POWER:
+            tx_power = self.tx_power.get(node, MAX_TX_POWER)
+        normalized = snr - tx_power
+        if node in self.snr:
+            self.snr[node] += self.smoothing * (normalized - self.snr[node])
+        else:
+            self.snr[node] = normalized
+        self.rssi[node] = rssi
+
+        floor = _SNR_FLOOR.get(self.spreading_factor, -7.5)
+        power = int(round(floor + self.target_margin - self.snr[node]))
+        power = max(tx_power - self.max_step, min(tx_power + self.max_step, power))
+        power = max(MIN_TX_POWER, min(MAX_TX_POWER, power))
+        self.tx_power[node] = power
+        return Profile(self.spreading_factor, self.bandwidth, power)
+
+
+class DataRateController:
+    """
+    Applies the settings recommended by the receiver to the local radio.
+
+    The TX power only changes when the recommendation differs by at least
+    `hysteresis` dB, and the spreading factor and bandwidth only when two acks
+    in a row recommend the same new values. After `fallback_failures`
+    transmissions in a row without an ack, the radio goes back to the default
+    profile, which the receiver can always hear.
+
+    The applied settings are kept in `profile` and never read back from the
+    radio: adafruit_rfm9x reads 20 dB back after 23 dB were set with PA_BOOST.
+
+    Args:
+        rfm9x (RFM9x): The radio.
+        default (Profile): The settings from settings.toml.
+        hysteresis (int, optional): The smallest power change applied in dB. Default is 2.
+        fallback_failures (int, optional): The missed acks before falling back. Default is 3.
+    """
+
+    def __init__(self, rfm9x, default, hysteresis=2, fallback_failures=3):
+        self.rfm9x = rfm9x
+        self.default = default
+        self.hysteresis = hysteresis
+        self.fallback_failures = fallback_failures
+        self.failures = 0
+        self.fallbacks = 0
+        self.profile = None
+        self._pending = None
+
+    def set_profile(self, profile):
+        """
+        Applies radio settings.
+
+        Args:
+            profile (Profile): The settings.
+        """
+        self.rfm9x.spreading_factor = profile.spreading_factor
+        self.rfm9x.signal_bandwidth = profile.bandwidth
+        self.rfm9x.tx_power = profile.tx_power
+        self.profile = profile
+
+    def ack_received(self, recommended):
+        """
+        Takes the recommendation carried by an ack into account.
+
+        Args:
+            recommended (Profile): The recommended settings, None if the ack
+                carried none.
+        """
+        self.failures = 0
+        if recommended is None or recommended.tx_power is None:
+            return
+        if abs(recommended.tx_power - self.profile.tx_power) >= self.hysteresis:
+            print(f"TX power {self.profile.tx_power} -> {recommended.tx_power} dB")
+            self.set_profile(self.profile._replace(tx_power=recommended.tx_power))
+        rate = (recommended.spreading_factor, recommended.bandwidth)
+        if rate == self.profile[:2]:
+            self._pending = None
+        elif rate == self._pending:
+            print(f"Spreading factor {rate[0]}, bandwidth {rate[1]} Hz")
+            self.set_profile(Profile(rate[0], rate[1], self.profile.tx_power))
+            self._pending = None
+        else:
+            self._pending = rate
+
+    def ack_missed(self):
+        """Counts a transmission without ack and falls back to the default profile if needed."""
+        self.failures += 1
+        if self.failures >= self.fallback_failures:
+            if self.profile != self.default:
+                print("No acknowledgements, back to the default radio profile")
+                self.set_profile(self.default)
+                self.fallbacks += 1
+            self.failures = 0
+            self._pending = None
@@ -0,0 +1,154 @@
+import struct
+import time
+
+# Marks a valid clock record in memory
+_MAGIC = b"CLK1"
+_FORMAT = "<4siIi"
+CLOCK_SIZE = struct.calcsize(_FORMAT)
+
+# Reference times before this are from an unset clock, 2024-01-01
+MIN_VALID_EPOCH = 1704067200
+# Larger drift rates come from a clock reset, not from the crystal, in ppb
+MAX_RATE_PPB = 10000000
+# Larger errors come from a clock that was not set, not from drift, in seconds
+MAX_DRIFT = 60
+
+
+# Integer division rounding toward zero
+def _divide(dividend, divisor):
+    # // rounds toward minus infinity, which would turn any slow drift into a -1 s step
+    if dividend < 0:
+        return -(-dividend // divisor)
+    return dividend // divisor
+
+
+class ClockDiscipline:
+    """
+    Keeps the RTC on the receiver time carried by the acks.
+
+    Every reference time steps the RTC when it is off by a second or more,
+    and measures the drift since the previous reference. The drift rate is
+    smoothed, and between references correct() steps the RTC by the drift
+    predicted so far, so the clock stays within a second even when acks are
+    hours apart. The rate and the last reference are kept in a
+    byte-addressable memory, so they survive resets and deep sleep.
+
+    An error of more than MAX_DRIFT seconds comes from a clock that was not
+    set, e.g. restored from the schedule after a reset. It is not used as a
+    rate measurement, and the measurement schedule is moved with the step so
+    the next measurement is not put off or brought forward by it.
+
+    With a cache, the record goes to `memory` only on the first sync and
+    when a reference steps the clock.
+
+    Args:
+        rtc: The rtc.RTC object.
+        memory: The memory holding the record, e.g. microcontroller.nvm.
+        offset (int): Where the record starts in memory, and in cache.
+        gain (float, optional): The weight of a new rate measurement. Default is 0.5.
+        min_interval (int, optional): The shortest time in seconds between
+            two references for a rate measurement. Default is 600.
+        cache (optional): The memory kept up to date on every change, e.g.
+            alarm.sleep_memory. Default is None.
+        schedule (state.CycleState, optional): The measurement schedule moved
+            with the steps of a clock that was not set. Default is None.
+    """
+
+    def __init__(self, rtc, memory, offset, gain=0.5, min_interval=600, cache=None, schedule=None):
+        self.rtc = rtc
+        self.memory = memory
+        self.offset = offset
+        self.gain = gain
+        self.min_interval = min_interval
+        self.cache = cache
+        self.schedule = schedule
+        self.rate_ppb = 0
+        self.sync_epoch = 0
+        self.corrected = 0
+
+    def _read(self, memory):
+        raw = bytes(memory[self.offset:self.offset + CLOCK_SIZE])
+        record = struct.unpack(_FORMAT, raw)
+        return record if record[0] == _MAGIC else None
+
+    def load(self):
+        """
+        Loads the record from the cache, or from memory if the cache holds none.
+
+        Returns:
+            bool: True if a valid record was found, False otherwise.
+        """
+        record = self._read(self.cache) if self.cache is not None else None
+        if record is None:
+            record = self._read(self.memory)
+            if record is None:
+                return False
+        _, rate_ppb, sync_epoch, corrected = record
+        self.rate_ppb = rate_ppb
+        self.sync_epoch = sync_epoch
+        self.corrected = corrected
+        return True
+
+    def _save(self, flush=True):
+        raw = struct.pack(_FORMAT, _MAGIC, self.rate_ppb, self.sync_epoch, self.corrected)
+        if self.cache is not None:
+            self.cache[self.offset:self.offset + CLOCK_SIZE] = raw
+        if flush or self.cache is None:
+            self.memory[self.offset:self.offset + CLOCK_SIZE] = raw
+
+    def _step(self, seconds):
+        self.rtc.datetime = time.localtime(time.time() + seconds)
+        if self.schedule is not None and abs(seconds) > MAX_DRIFT:
+            self.schedule.shift(seconds)
+
+    def sync(self, reference):
+        """
+        Disciplines the clock with a reference time.
+
+        Args:
+            reference (int): The receiver epoch time, 0 if its clock is not set.
+
+        Returns:
+            int: The error of the clock in seconds, 0 if the reference was ignored.
+        """
+        if reference < MIN_VALID_EPOCH:
+            return 0
+        error = reference - time.time()
+        elapsed = reference - self.sync_epoch
+        rate_ppb = self.rate_ppb
+        if self.sync_epoch and self.min_interval <= elapsed and abs(error) <= MAX_DRIFT:
+            # Drift since the last reference, including what correct() already stepped
+            measured = _divide((error + self.corrected) * 1000000000, elapsed)
+            if abs(measured) <= MAX_RATE_PPB:
+                rate_ppb += int(self.gain * (measured - rate_ppb))
+        if self.sync_epoch and not error and not self.corrected and rate_ppb == self.rate_ppb:
+            # Nothing changed, the last reference stays the base of the next measurement
+            return 0
+        # Memory only gets the record when the clock is stepped or first synced
+        flush = bool(error) or not self.sync_epoch
+        self.rate_ppb = rate_ppb
+        if error:
+            print(f"Clock off by {error} s, rate {self.rate_ppb / 1000} ppm")
+            self._step(error)
+        self.sync_epoch = reference
+        self.corrected = 0
+        self._save(flush)
+        return error
+
+    def correct(self):
+        """
+        Steps the clock by the drift predicted since the last reference.
+
+        Returns:
+            int: The step in seconds.
+        """
+        if not self.sync_epoch or not self.rate_ppb:
+            return 0
+        predicted = _divide((time.time() - self.sync_epoch) * self.rate_ppb, 1000000000)
+        step = predicted - self.corrected
+        if not step:
+            return 0
+        self._step(step)
+        self.corrected += step
+        self._save()
+        return step
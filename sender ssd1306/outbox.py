@@ -0,0 +1,201 @@
+import os
+import struct
+
+# Marks valid outbox pointers in memory
+_MAGIC = b"OBX2"
+_FORMAT = "<4sII"
+POINTERS_SIZE = struct.calcsize(_FORMAT)
+
+# A slot holds a length byte, a lap byte and a frame of up to MAX_FRAME bytes
+SLOT_SIZE = 256
+MAX_FRAME = SLOT_SIZE - 2
+
+
+class Outbox:
+    """
+    Frames waiting for an acknowledgement, queued in a ring of fixed-size
+    slots in a file on flash.
+
+    Each slot holds a length byte, the lap of the ring it was written in and
+    the frame, padded to SLOT_SIZE bytes. The file grows one slot at a time
+    on the first pass around the ring and is reused afterwards, so it never
+    needs to be compacted or rewritten, even when the backlog never fully
+    drains.
+
+    The head (absolute index of the oldest frame) and the number of frames
+    are kept up to date in `cache`, while `memory` only gets the head every
+    `flush_every` frames. After a power loss the head read back from
+    `memory` may be a few frames behind, those frames are sent again and
+    dropped as retries by the receiver. The frames queued after it are found
+    again from their lap bytes.
+
+    Args:
+        path (str): The queue file.
+        memory: The memory holding the head, e.g. microcontroller.nvm.
+        offset (int): Where the pointers start in memory, and in cache.
+        capacity (int): The largest size of the queue file in bytes.
+        cache (optional): The memory kept up to date on every change, e.g.
+            alarm.sleep_memory. Default is None.
+        flush_every (int, optional): The number of frames dropped between two
+            writes of the head to memory. Default is 16.
+    """
+
+    def __init__(self, path, memory, offset, capacity, cache=None, flush_every=16):
+        self.path = path
+        self.memory = memory
+        self.offset = offset
+        self.cache = cache
+        self.slots = max(1, capacity // SLOT_SIZE)
+        self.flush_every = max(1, min(flush_every, self.slots))
+        self.head = 0
+        self.count = 0
+        self._flushed = 0
+
+    def _read_pointers(self, memory):
+        raw = bytes(memory[self.offset:self.offset + POINTERS_SIZE])
+        magic, head, count = struct.unpack(_FORMAT, raw)
+        if magic != _MAGIC or count > self.slots:
+            return None
+        return head, count
+
+    def load(self):
+        """
+        Loads the pointers from memory, then counts the frames queued after
+        them in the file.
+
+        Returns:
+            bool: True if valid pointers were found, False otherwise.
+        """
+        saved = self._read_pointers(self.memory)
+        cached = self._read_pointers(self.cache) if self.cache is not None else None
+        self.head = self.count = 0
+        if saved:
+            # The count in memory may be stale, the file tells the rest
+            self.head = saved[0]
+        if cached and cached[0] >= self.head:
+            self.head, self.count = cached
+        self._flushed = saved[0] if saved else self.head
+        try:
+            with open(self.path, "rb") as file:
+                while self.count < self.slots and self._read_slot(file, self.head + self.count) is not None:
+                    self.count += 1
+        except OSError:
+            pass
+        return saved is not None or cached is not None
+
+    def _save(self, flush=False):
+        raw = struct.pack(_FORMAT, _MAGIC, self.head, self.count)
+        if self.cache is not None:
+            self.cache[self.offset:self.offset + POINTERS_SIZE] = raw
+        if flush or self.head - self._flushed >= self.flush_every:
+            self.memory[self.offset:self.offset + POINTERS_SIZE] = raw
+            self._flushed = self.head
+
+    def _lap(self, index):
+        return index // self.slots & 0xFF
+
+    def _read_slot(self, file, index):
+        # The frame in the slot of an absolute index, None if it was not written in this lap
+        file.seek(index % self.slots * SLOT_SIZE)
+        header = file.read(2)
+        if len(header) != 2 or header[1] != self._lap(index) or header[0] > MAX_FRAME:
+            return None
+        frame = file.read(header[0])
+        if len(frame) != header[0]:
+            return None
+        return frame
+
+    def _file_size(self):
+        try:
+            return os.stat(self.path)[6]
+        except OSError:
+            return 0
+
+    def append(self, frame):
+        """
+        Queues a frame.
+
+        Args:
+            frame (bytes): The frame, at most MAX_FRAME bytes.
+
+        Returns:
+            bool: False if the queue is full or the file cannot be written.
+        """
+        if len(frame) > MAX_FRAME:
+            print(f"Frame of {len(frame)} bytes too long for the outbox")
+            return False
+        if self.count >= self.slots:
+            print("Outbox full, frame dropped")
+            return False
+        index = self.head + self.count
+        if index - self._flushed >= self.slots:
+            # The slot is still the head saved in memory, move that head first
+            self._save(flush=True)
+        position = index % self.slots * SLOT_SIZE
+        size = self._file_size()
+        if position > size:
+            # The file does not match the pointers, start over
+            print("Outbox corrupted, clearing it")
+            self.clear()
+            index = position = size = 0
+        try:
+            with open(self.path, "r+b" if size else "wb") as file:
+                file.seek(position)
+                file.write(bytes((len(frame), self._lap(index))) + frame + bytes(MAX_FRAME - len(frame)))
+        except OSError as e:
+            print(f"Error writing to outbox: {e}")
+            return False
+        self.count += 1
+        self._save()
+        return True
+
+    def peek(self, limit=1):
+        """
+        Reads the oldest queued frames.
+
+        Args:
+            limit (int, optional): The largest number of frames to read. Default is 1.
+
+        Returns:
+            list: The frames, oldest first. Empty if the queue is empty or cannot be read.
+        """
+        frames = []
+        if not self.count:
+            return frames
+        try:
+            with open(self.path, "rb") as file:
+                for index in range(self.head, self.head + min(limit, self.count)):
+                    frame = self._read_slot(file, index)
+                    if frame is None:
+                        # The file does not match the pointers, start over
+                        print("Outbox corrupted, clearing it")
+                        self.clear()
+                        return []
+                    frames.append(frame)
+        except OSError as e:
+            print(f"Error reading outbox: {e}")
+            return []
+        return frames
+
+    def pop(self, count=1):
+        """
+        Drops the oldest queued frames once they have been acknowledged.
+
+        Args:
+            count (int, optional): The number of frames to drop. Default is 1.
+        """
+        count = min(count, self.count)
+        if not count:
+            return
+        self.head += count
+        self.count -= count
+        self._save()
+
+    def clear(self):
+        """Empties the queue and deletes the file."""
+        self.head = self.count = 0
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self._save(flush=True)
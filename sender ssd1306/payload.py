@@ -0,0 +1,498 @@
+import struct
+from collections import namedtuple
+
+# Binary LoRa payload shared by the sender and receiver nodes.
+#
+# A single reading frame is a header followed by fixed-point sensor fields,
+# little endian:
+#   version (B), node (B), sequence number (H), epoch timestamp (I)
+#   dendrometers 0-3 (i, 0.01 um), pressure (I, 0.001 hPa),
+#   temperature (h, 0.01 C), humidity (H, 0.01 %), moisture (H)
+# A batch frame is a header with the epoch of its first reading and a record
+# count (B), followed by one record per reading: epoch (I) and the same fields.
+# A delta frame has the same header, then the fields of its first reading, then
+# for every later reading the change of each value, epoch included, since the
+# previous reading as zig-zag varints.
+# Versions are kept below 0x20 so a frame never starts like a text payload.
+# The sensor fields of every version are listed in SCHEMAS below.
+VERSION = 1
+BATCH_VERSION = 2
+DELTA_VERSION = 3
+HEADER_FORMAT = "<BBHI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+BATCH_HEADER_FORMAT = "<BBHIB"
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_HEADER_FORMAT)
+
+# Fixed-point scales of the sensor fields
+DENDRO_SCALE = 100
+PRESSURE_SCALE = 1000
+TEMPERATURE_SCALE = 100
+HUMIDITY_SCALE = 100
+
+# One sensor field of a frame: its name in Reading, struct type and
+# fixed-point scale, a scale of 1 keeps the integer
+Field = namedtuple("Field", ("name", "type", "scale"))
+
+# Sensor fields of the frames sent by this firmware, in frame order
+_FIELDS = (
+    Field("dendro0", "i", DENDRO_SCALE),
+    Field("dendro1", "i", DENDRO_SCALE),
+    Field("dendro2", "i", DENDRO_SCALE),
+    Field("dendro3", "i", DENDRO_SCALE),
+    Field("pressure", "I", PRESSURE_SCALE),
+    Field("temperature", "h", TEMPERATURE_SCALE),
+    Field("humidity", "H", HUMIDITY_SCALE),
+    Field("moisture", "H", 1),
+)
+FIELDS_FORMAT = "<" + "".join(field.type for field in _FIELDS)
+FIELDS_SIZE = struct.calcsize(FIELDS_FORMAT)
+FRAME_SIZE = HEADER_SIZE + FIELDS_SIZE
+RECORD_FORMAT = "<I" + FIELDS_FORMAT[1:]
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Layout and sensor fields of every frame version. A firmware that changes
+# its fields, e.g. its number of dendrometers, gets new versions here, so one
+# receiver keeps decoding every sender whatever firmware it runs.
+SINGLE_LAYOUT = 0
+BATCH_LAYOUT = 1
+DELTA_LAYOUT = 2
+Schema = namedtuple("Schema", ("layout", "fields"))
+SCHEMAS = {
+    VERSION: Schema(SINGLE_LAYOUT, _FIELDS),
+    BATCH_VERSION: Schema(BATCH_LAYOUT, _FIELDS),
+    DELTA_VERSION: Schema(DELTA_LAYOUT, _FIELDS),
+}
+
+# Value of a Reading field the frame version does not carry
+MISSING = float("nan")
+
+# Acknowledgement sent back by the receiver: type (B), then the node (B) and
+# sequence number (H) of the frame it confirms, then the recommended spreading
+# factor (B), bandwidth in Hz (I) and TX power in dB (B), then the reporting
+# period (I) and the offset of the node transmit slot in it (H), in seconds,
+# then the receiver epoch time (I). Older acks end early, the missing fields
+# decode as None.
+ACK_VERSION = 0x10
+ACK_FORMAT = "<BBH"
+ACK_SIZE = struct.calcsize(ACK_FORMAT)
+ACK_PROFILE_FORMAT = "<BIB"
+ACK_PROFILE_SIZE = struct.calcsize(ACK_PROFILE_FORMAT)
+ACK_SLOT_FORMAT = "<IH"
+ACK_SLOT_SIZE = struct.calcsize(ACK_SLOT_FORMAT)
+ACK_CLOCK_FORMAT = "<I"
+ACK_CLOCK_SIZE = struct.calcsize(ACK_CLOCK_FORMAT)
+
+# Bulk transfer of a window of frames sent back to back. The frames carry
+# WINDOW_FLAG in the RFM9x header flags and are not acknowledged one by one.
+# The sender then asks which of them arrived:
+#   window request: type (B), node (B), count (B), then each sequence number (H)
+# and the receiver answers with one acknowledgement for the whole window:
+#   window ack: type (B), node (B), first sequence number (H), number of frames
+#   received in a row from the start (B), bitmap of missing frames (I)
+WINDOW_FLAG = 0x01
+WINDOW_REQUEST_VERSION = 0x11
+WINDOW_REQUEST_FORMAT = "<BBB"
+WINDOW_ACK_VERSION = 0x12
+WINDOW_ACK_FORMAT = "<BBHBI"
+WINDOW_ACK_SIZE = struct.calcsize(WINDOW_ACK_FORMAT)
+MAX_WINDOW = 16
+
+# Largest RFM9x payload, largest batch and largest delta of one reading
+MAX_PAYLOAD = 252
+MAX_RECORDS = 64
+MAX_DELTA_SIZE = 5 * len(RECORD_FORMAT[1:])
+
+# One decoded acknowledgement, the radio settings are None if it carries none
+_ACK_FIELDS = ("node", "seq", "spreading_factor", "bandwidth", "tx_power", "period", "slot", "epoch")
+Ack = namedtuple("Ack", _ACK_FIELDS)
+
+# One decoded sensor reading
+READING_FIELDS = ("dendro0", "dendro1", "dendro2", "dendro3", "pressure", "temperature", "humidity", "moisture")
+Reading = namedtuple("Reading", ("node", "seq", "epoch") + READING_FIELDS)
+
+# Decoding plans of the frame versions, built from SCHEMAS on first use
+_plans = {}
+
+
+# Convert a value to a clamped fixed-point integer
+def _fixed(value, scale, low, high):
+    value = int(round(value * scale))
+    if value < low:
+        return low
+    if value > high:
+        return high
+    return value
+
+
+# Check whether a payload is a binary frame
+def is_frame(data):
+    """
+    Tells binary frames apart from the older text payloads.
+
+    Args:
+        data (bytes): The payload, without the RFM9x header.
+
+    Returns:
+        bool: True if the payload starts with a binary frame header.
+    """
+    return len(data) >= HEADER_SIZE and data[0] < 0x20
+
+
+# Pack one reading into a fixed-point record
+def pack_record(epoch, dendros, pressure, temperature, humidity, moisture):
+    """
+    Packs one sensor reading into a record, ready to be batched.
+
+    Args:
+        epoch (int): The measurement time in seconds since 1970.
+        dendros (list): The four dendrometer values in microns.
+        pressure (float): The pressure in hPa.
+        temperature (float): The temperature in degrees Celsius.
+        humidity (float): The relative humidity in percent.
+        moisture (int): The soil moisture level.
+
+    Returns:
+        bytes: The RECORD_SIZE byte record.
+    """
+    return struct.pack(
+        RECORD_FORMAT,
+        _fixed(epoch, 1, 0, 0xFFFFFFFF),
+        _fixed(dendros[0], DENDRO_SCALE, -0x80000000, 0x7FFFFFFF),
+        _fixed(dendros[1], DENDRO_SCALE, -0x80000000, 0x7FFFFFFF),
+        _fixed(dendros[2], DENDRO_SCALE, -0x80000000, 0x7FFFFFFF),
+        _fixed(dendros[3], DENDRO_SCALE, -0x80000000, 0x7FFFFFFF),
+        _fixed(pressure, PRESSURE_SCALE, 0, 0xFFFFFFFF),
+        _fixed(temperature, TEMPERATURE_SCALE, -0x8000, 0x7FFF),
+        _fixed(humidity, HUMIDITY_SCALE, 0, 0xFFFF),
+        _fixed(moisture, 1, 0, 0xFFFF),
+    )
+
+
+# Get the measurement time of a record
+def record_epoch(record):
+    """
+    Reads the measurement time of a record.
+
+    Args:
+        record (bytes): A record made by pack_record().
+
+    Returns:
+        int: The measurement time in seconds since 1970.
+    """
+    return struct.unpack_from("<I", record, 0)[0]
+
+
+# Get the sequence number of a frame
+def frame_seq(data):
+    """
+    Reads the sequence number from a frame header.
+
+    Args:
+        data (bytes): A frame of any version.
+
+    Returns:
+        int: The sequence number.
+    """
+    return struct.unpack_from("<H", data, 2)[0]
+
+
+# Encode an acknowledgement
+def encode_ack(node, seq, profile=None, period=None, slot=None, epoch=None):
+    """
+    Packs the acknowledgement of a frame.
+
+    Args:
+        node (int): The node that sent the frame.
+        seq (int): The sequence number of the frame.
+        profile (Profile, optional): The radio settings recommended to the
+            node, see adr.py. Default is None.
+        period (int, optional): The reporting period in seconds, only sent
+            with a profile. Default is None.
+        slot (int, optional): The offset of the node transmit slot in the
+            period, in seconds. Default is None.
+        epoch (int, optional): The receiver time in seconds since 1970, only
+            sent with a slot. Default is None.
+
+    Returns:
+        bytes: The acknowledgement.
+    """
+    ack = struct.pack(ACK_FORMAT, ACK_VERSION, node, seq & 0xFFFF)
+    if profile is not None:
+        ack += struct.pack(ACK_PROFILE_FORMAT, profile.spreading_factor, profile.bandwidth, profile.tx_power)
+        if slot is not None:
+            ack += struct.pack(ACK_SLOT_FORMAT, period, slot)
+            if epoch is not None:
+                ack += struct.pack(ACK_CLOCK_FORMAT, epoch)
+    return ack
+
+
+# Decode an acknowledgement
+def decode_ack(data):
+    """
+    Unpacks an acknowledgement.
+
+    Args:
+        data (bytes): The received payload.
+
+    Returns:
+        Ack: The acknowledgement, or None if the payload is not one.
+    """
+    if data is None or len(data) < ACK_SIZE or data[0] != ACK_VERSION:
+        return None
+    _, node, seq = struct.unpack_from(ACK_FORMAT, data, 0)
+    fields = [node, seq]
+    position = ACK_SIZE
+    for tail_format, tail_size in ((ACK_PROFILE_FORMAT, ACK_PROFILE_SIZE), (ACK_SLOT_FORMAT, ACK_SLOT_SIZE),
+                                     (ACK_CLOCK_FORMAT, ACK_CLOCK_SIZE)):
+        if len(data) >= position + tail_size:
+            fields.extend(struct.unpack_from(tail_format, data, position))
+        position += tail_size
+    while len(fields) < len(_ACK_FIELDS):
+        fields.append(None)
+    return Ack(*fields)
+
+
+# Encode a window request
+def encode_window_request(node, seqs):
+    """
+    Packs the question sent after a window of frames.
+
+    Args:
+        node (int): The node that sent the window.
+        seqs (list): The sequence numbers of the window, in sending order.
+
+    Returns:
+        bytes: The window request.
+    """
+    if not 0 < len(seqs) <= MAX_WINDOW:
+        raise ValueError(f"Cannot request a window of {len(seqs)} frames")
+    return struct.pack(WINDOW_REQUEST_FORMAT, WINDOW_REQUEST_VERSION, node, len(seqs)) + struct.pack(
+        "<" + "H" * len(seqs), *seqs)
+
+
+# Decode a window request
+def decode_window_request(data):
+    """
+    Unpacks a window request.
+
+    Args:
+        data (bytes): The received payload.
+
+    Returns:
+        tuple: The node and the list of sequence numbers, or None if the
+            payload is not a window request.
+    """
+    if len(data) < 3 or data[0] != WINDOW_REQUEST_VERSION or len(data) < 3 + 2 * data[2]:
+        return None
+    _, node, count = struct.unpack_from(WINDOW_REQUEST_FORMAT, data, 0)
+    return node, list(struct.unpack_from("<" + "H" * count, data, 3))
+
+
+# Encode a window acknowledgement
+def encode_window_ack(node, seqs, received):
+    """
+    Packs the acknowledgement of a window.
+
+    Args:
+        node (int): The node that sent the window.
+        seqs (list): The sequence numbers of the window, in sending order.
+        received (list): One bool per frame of the window.
+
+    Returns:
+        bytes: The window acknowledgement.
+    """
+    cumulative = 0
+    while cumulative < len(received) and received[cumulative]:
+        cumulative += 1
+    missing = 0
+    for index in range(len(received)):
+        if not received[index]:
+            missing |= 1 << index
+    return struct.pack(WINDOW_ACK_FORMAT, WINDOW_ACK_VERSION, node, seqs[0], cumulative, missing)
+
+
+# Decode a window acknowledgement
+def decode_window_ack(data):
+    """
+    Unpacks a window acknowledgement.
+
+    Args:
+        data (bytes): The received payload.
+
+    Returns:
+        tuple: The node, the first sequence number of the window, the number
+            of frames received in a row from the start and the bitmap of
+            missing frames, or None if the payload is not a window ack.
+    """
+    if data is None or len(data) < WINDOW_ACK_SIZE or data[0] != WINDOW_ACK_VERSION:
+        return None
+    _, node, first, cumulative, missing = struct.unpack_from(WINDOW_ACK_FORMAT, data, 0)
+    return node, first, cumulative, missing
+
+
+# Append a signed integer as a zig-zag varint
+def _put_varint(out, value):
+    value = value << 1 if value >= 0 else (-value << 1) - 1
+    while value > 0x7F:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    out.append(value)
+
+
+# Read a zig-zag varint, returning the value and the next position
+def _get_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    if value & 1:
+        return -((value + 1) >> 1), position
+    return value >> 1, position
+
+
+# Encode records into one binary frame
+def encode_batch(node, seq, records):
+    """
+    Packs records into one frame.
+
+    A single record is sent as a single reading frame. Several records are
+    sent as a delta frame: the first record in full, then only the changes
+    from one record to the next, which are a few bytes for slow-changing data.
+
+    Args:
+        node (int): The sender node address.
+        seq (int): The sequence number, wrapped to 16 bits.
+        records (list): Between 1 and MAX_RECORDS records made by pack_record().
+
+    Returns:
+        bytes: The encoded frame.
+
+    Raises:
+        ValueError: If there are no records or they do not fit in one frame.
+    """
+    if not 0 < len(records) <= MAX_RECORDS:
+        raise ValueError(f"Cannot pack {len(records)} records in one frame")
+    epoch = record_epoch(records[0])
+    if len(records) == 1:
+        return struct.pack(HEADER_FORMAT, VERSION, node, seq & 0xFFFF, epoch) + records[0][4:]
+    frame = bytearray(struct.pack(BATCH_HEADER_FORMAT, DELTA_VERSION, node, seq & 0xFFFF, epoch, len(records)))
+    frame.extend(records[0][4:])
+    previous = struct.unpack(RECORD_FORMAT, records[0])
+    for record in records[1:]:
+        fields = struct.unpack(RECORD_FORMAT, record)
+        for index in range(len(fields)):
+            _put_varint(frame, fields[index] - previous[index])
+        previous = fields
+    if len(frame) > MAX_PAYLOAD:
+        raise ValueError(f"Frame of {len(frame)} bytes exceeds {MAX_PAYLOAD} bytes")
+    return bytes(frame)
+
+
+# Encode one reading into a binary frame
+def encode(node, seq, epoch, dendros, pressure, temperature, humidity, moisture):
+    """
+    Packs one sensor reading into a binary frame.
+
+    Args:
+        node (int): The sender node address.
+        seq (int): The sequence number, wrapped to 16 bits.
+        epoch (int): The measurement time in seconds since 1970.
+        dendros (list): The four dendrometer values in microns.
+        pressure (float): The pressure in hPa.
+        temperature (float): The temperature in degrees Celsius.
+        humidity (float): The relative humidity in percent.
+        moisture (int): The soil moisture level.
+
+    Returns:
+        bytes: The encoded frame.
+    """
+    return encode_batch(node, seq, [pack_record(epoch, dendros, pressure, temperature, humidity, moisture)])
+
+
+# Build the decoding plan of a frame version
+def _plan(version):
+    plan = _plans.get(version)
+    if plan is None:
+        schema = SCHEMAS.get(version)
+        if schema is None:
+            raise ValueError(f"Unknown frame version: {version}")
+        fields_format = "<" + "".join(field.type for field in schema.fields)
+        # Where each frame field goes in the reading, and its scale
+        slots = tuple(READING_FIELDS.index(field.name) for field in schema.fields)
+        scales = tuple(field.scale for field in schema.fields)
+        plan = (schema.layout, fields_format, struct.calcsize(fields_format), slots, scales)
+        _plans[version] = plan
+    return plan
+
+
+# Unpack the fields of one reading
+def _reading(node, seq, epoch, values, plan):
+    result = [MISSING] * len(READING_FIELDS)
+    slots = plan[3]
+    scales = plan[4]
+    for index in range(len(values)):
+        scale = scales[index]
+        result[slots[index]] = values[index] / scale if scale != 1 else values[index]
+    return Reading(node, seq, epoch, *result)
+
+
+# Decode a binary frame into readings
+def decode(data):
+    """
+    Unpacks a single reading, batch or delta frame in one pass, following
+    the schema of its version.
+
+    Args:
+        data (bytes): The payload, without the RFM9x header.
+
+    Returns:
+        list: The decoded Readings, oldest first.
+
+    Raises:
+        ValueError: If the frame is truncated or has an unknown version.
+    """
+    if len(data) < HEADER_SIZE:
+        raise ValueError(f"Frame too short: {len(data)} bytes")
+    version = data[0]
+    plan = _plan(version)
+    layout, fields_format, fields_size = plan[0], plan[1], plan[2]
+    if layout == SINGLE_LAYOUT:
+        if len(data) < HEADER_SIZE + fields_size:
+            raise ValueError(f"Frame too short: {len(data)} bytes")
+        _, node, seq, epoch = struct.unpack_from(HEADER_FORMAT, data, 0)
+        return [_reading(node, seq, epoch, struct.unpack_from(fields_format, data, HEADER_SIZE), plan)]
+    if len(data) < BATCH_HEADER_SIZE:
+        raise ValueError(f"Frame too short: {len(data)} bytes")
+    _, node, seq, epoch, count = struct.unpack_from(BATCH_HEADER_FORMAT, data, 0)
+    if layout == BATCH_LAYOUT:
+        record_size = 4 + fields_size
+        if len(data) < BATCH_HEADER_SIZE + count * record_size:
+            raise ValueError(f"Batch of {count} records truncated to {len(data)} bytes")
+        readings = []
+        for index in range(count):
+            position = BATCH_HEADER_SIZE + index * record_size
+            epoch = struct.unpack_from("<I", data, position)[0]
+            readings.append(_reading(node, seq, epoch, struct.unpack_from(fields_format, data, position + 4), plan))
+        return readings
+    # Delta frame: the first reading in full, then the changes of the epoch
+    # and of every field from one reading to the next
+    if len(data) < BATCH_HEADER_SIZE + fields_size:
+        raise ValueError(f"Frame too short: {len(data)} bytes")
+    values = list(struct.unpack_from(fields_format, data, BATCH_HEADER_SIZE))
+    readings = [_reading(node, seq, epoch, values, plan)]
+    position = BATCH_HEADER_SIZE + fields_size
+    for _ in range(count - 1):
+        delta, position = _get_varint(data, position)
+        epoch += delta
+        for index in range(len(values)):
+            delta, position = _get_varint(data, position)
+            values[index] += delta
+        readings.append(_reading(node, seq, epoch, values, plan))
+    return readings
@@ -0,0 +1,379 @@
+import asyncio
+import os
+import time
+from collections import namedtuple
+
+import board
+import countio
+import ulab.numpy as np
+
+# Conversion constants for the ADS1115 raw counts, as in AnalogIn.voltage:
+# a count of ADC_FULL_SCALE is the PGA range of the configured gain, in volts
+ADC_FULL_SCALE = 32767
+ADC_PGA_RANGE = {2 / 3: 6.144, 1: 4.096, 2: 2.048, 4: 1.024, 8: 0.512, 16: 0.256}
+
+# Default dendrometer calibration. At gain 1, 8192 mV over the travel is the
+# count / 65535 * travel scale of the former firmware, so readings stay
+# continuous with the existing logs.
+DENDRO_FULL_SCALE_MV = 8192
+DENDRO_TRAVEL_UM = 25400
+DENDRO_OFFSET_UM = 0
+
+# ADS1115 registers and configuration bits
+_ADS_REG_CONVERSION = 0x00
+_ADS_REG_CONFIG = 0x01
+_ADS_REG_LO_THRESH = 0x02
+_ADS_REG_HI_THRESH = 0x03
+_ADS_CONFIG_OS_SINGLE = 0x8000
+_ADS_CONFIG_MODE_CONTINUOUS = 0x0000
+_ADS_CONFIG_MODE_SINGLE = 0x0100
+_ADS_CONFIG_COMP_QUE_ONE = 0x0000
+_ADS_CONFIG_COMP_QUE_DISABLE = 0x0003
+_ADS_CONFIG_MUX_SINGLE = (0x4000, 0x5000, 0x6000, 0x7000)
+_ADS_CONFIG_GAIN = {2 / 3: 0x0000, 1: 0x0200, 2: 0x0400, 4: 0x0600, 8: 0x0800, 16: 0x0A00}
+_ADS_CONFIG_DATA_RATE = {8: 0x0000, 16: 0x0020, 32: 0x0040, 64: 0x0060, 128: 0x0080, 250: 0x00A0, 475: 0x00C0, 860: 0x00E0}
+
+# Default sampling window
+DEFAULT_SAMPLES = 100
+DEFAULT_DELAY = 0.1
+DEFAULT_TRIM = 0.1
+
+# Statistics of one channel over a sampling window, all in microns
+ChannelStats = namedtuple("ChannelStats", ("mean", "median", "std", "trimmed_mean", "count"))
+EMPTY_STATS = ChannelStats(0, 0, 0, 0, 0)
+
+# Calibration of one dendrometer channel
+Calibration = namedtuple("Calibration", ("full_scale_voltage", "travel", "offset"))
+
+
+# Load the per-channel calibration table from settings.toml
+def load_calibration(channels):
+    """
+    Loads the calibration of every dendrometer channel from settings.toml.
+
+    Channel N uses the DENDRON_FULL_SCALE_MV, DENDRON_TRAVEL_UM and
+    DENDRON_OFFSET_UM keys. Missing keys fall back to the defaults of a
+    25.4 mm dendrometer on the scale of the former firmware.
+
+    Args:
+        channels (int): The number of ADC channels.
+
+    Returns:
+        list: One Calibration per channel.
+    """
+    table = []
+    for channel in range(channels):
+        prefix = f"DENDRO{channel}_"
+        table.append(Calibration(
+            os.getenv(prefix + "FULL_SCALE_MV", DENDRO_FULL_SCALE_MV) / 1000,
+            os.getenv(prefix + "TRAVEL_UM", DENDRO_TRAVEL_UM),
+            os.getenv(prefix + "OFFSET_UM", DENDRO_OFFSET_UM),
+        ))
+    return table
+
+
+class SampleBuffer:
+    """
+    Preallocated ulab storage for one sampling window of every channel.
+
+    The array is allocated once and reused for every measurement cycle, so
+    sampling does not grow Python lists or leave floats behind for the
+    garbage collector. Samples are kept as raw ADC counts and only the
+    statistics are converted to microns, once per window.
+
+    Args:
+        channels (int): The number of ADC channels.
+        samples (int): The number of samples kept per channel.
+        trim (float, optional): The fraction cut from each end of the sorted
+            samples for the trimmed mean. Default is 0.1.
+        calibration (list, optional): One Calibration per channel. Default is
+            the table loaded from settings.toml.
+        gain (float, optional): The ADS1115 gain the counts were read with,
+            which sets the voltage of one count. Default is 1.
+    """
+
+    def __init__(self, channels, samples, trim=DEFAULT_TRIM, calibration=None, gain=1):
+        self.channels = channels
+        self.samples = samples
+        self.trim = trim
+        self.volts_per_count = ADC_PGA_RANGE[gain] / ADC_FULL_SCALE
+        self.calibration = calibration or load_calibration(channels)
+        self.values = np.zeros((channels, samples), dtype=np.int16)
+        self.counts = [0] * channels
+
+    def reset(self):
+        """Forgets the samples of the previous window."""
+        for channel in range(self.channels):
+            self.counts[channel] = 0
+
+    def append(self, channel, value):
+        """
+        Stores one sample for a channel.
+
+        Args:
+            channel (int): The channel index.
+            value (int): The raw ADC count, negative values are clamped to 0.
+
+        Returns:
+            bool: False if the channel window is already full, True otherwise.
+        """
+        count = self.counts[channel]
+        if count >= self.samples:
+            return False
+        if value < 0:
+            value = 0
+        self.values[channel, count] = value
+        self.counts[channel] = count + 1
+        return True
+
+    def statistics(self, channel):
+        """
+        Computes the statistics of a channel over the current window.
+
+        Args:
+            channel (int): The channel index.
+
+        Returns:
+            ChannelStats: Mean, median, standard deviation and trimmed mean in
+                microns, plus the number of samples. EMPTY_STATS is returned if
+                the channel has no samples.
+        """
+        count = self.counts[channel]
+        if count == 0:
+            return EMPTY_STATS
+        ordered = np.sort(self.values[channel, :count])
+        middle = count // 2
+        if count % 2:
+            median = ordered[middle]
+        else:
+            median = (ordered[middle - 1] + ordered[middle]) / 2
+        cut = int(count * self.trim)
+        if count - 2 * cut <= 0:
+            cut = 0
+
+        # Single conversion from counts to microns for the whole window
+        calibration = self.calibration[channel]
+        scale = self.volts_per_count / calibration.full_scale_voltage * calibration.travel
+        offset = calibration.offset
+        return ChannelStats(
+            np.mean(ordered) * scale + offset,
+            median * scale + offset,
+            np.std(ordered) * scale,
+            np.mean(ordered[cut:count - cut]) * scale + offset,
+            count,
+        )
+
+
+# Read every channel once per pass, yielding after each pass
+def _adc_passes(channels, buffer):
+    buffer.reset()
+    count = len(channels)
+    for _ in range(buffer.samples):
+        for index in range(count):
+            adc = channels[index]
+            if adc is None:
+                continue
+            try:
+                buffer.append(index, adc.value)
+            except Exception as e:
+                print(f"Error reading ADC{index}: {e}")
+        yield
+
+
+# Sample every dendrometer channel in a single interleaved pass
+def sample_adcs(channels, buffer, delay=DEFAULT_DELAY):
+    """
+    Fills the sample buffer with one interleaved window of every ADC channel.
+
+    Each pass reads all channels back to back and then waits `delay` seconds,
+    so the whole window lasts about `buffer.samples * delay` seconds instead of
+    that much per channel.
+
+    Args:
+        channels (list): AnalogIn objects, None for channels that are not available.
+        buffer (SampleBuffer): The buffer receiving the samples, one row per channel.
+        delay (float, optional): The delay between passes in seconds. Default is 0.1.
+
+    Returns:
+        list: One ChannelStats per channel.
+    """
+    for _ in _adc_passes(channels, buffer):
+        if delay:
+            time.sleep(delay)  # Adjust this delay based on measurement speed
+    return [buffer.statistics(index) for index in range(len(channels))]
+
+
+# Same as sample_adcs, for use from an asyncio task
+async def sample_adcs_async(channels, buffer, delay=DEFAULT_DELAY):
+    """
+    Fills the sample buffer like sample_adcs(), but lets the other asyncio
+    tasks run during the delay between passes.
+
+    Args:
+        channels (list): AnalogIn objects, None for channels that are not available.
+        buffer (SampleBuffer): The buffer receiving the samples, one row per channel.
+        delay (float, optional): The delay between passes in seconds. Default is 0.1.
+
+    Returns:
+        list: One ChannelStats per channel.
+    """
+    for _ in _adc_passes(channels, buffer):
+        await asyncio.sleep(delay)
+    return [buffer.statistics(index) for index in range(len(channels))]
+
+
+class PacedSampler:
+    """
+    Reads the ADS1115 exactly when each conversion finishes.
+
+    With an ALERT/RDY pin, the ADC runs in continuous-conversion mode and the
+    comparator is set up to pulse the pin at the end of every conversion; the
+    pulses are counted in the background with countio. Without the pin, every
+    sample is a single-shot conversion paced by the conversion-ready (OS) bit
+    of the config register, and the ADC powers down in between.
+
+    A high data rate gives short bursts, a low one gives slower and quieter
+    readings since the ADS1115 averages internally over a longer conversion.
+    While a conversion runs the sampler sleeps for its expected duration and
+    then polls, so at low data rates the CPU idles instead of spinning.
+
+    Args:
+        ads (ADS1115): The ADS1115 driver, used for its I2C device and gain.
+        data_rate (int, optional): Samples per second, one of 8, 16, 32, 64, 128,
+            250, 475 or 860. Default is 860.
+        alert_pin (str, optional): The board pin name wired to ALERT/RDY. It
+            must be a PWM channel B pin to be usable by countio. Default is None.
+    """
+
+    def __init__(self, ads, data_rate=860, alert_pin=None):
+        if data_rate not in _ADS_CONFIG_DATA_RATE:
+            raise ValueError(f"Unsupported ADS1115 data rate: {data_rate}")
+        self.device = ads.i2c_device
+        self.data_rate = data_rate
+        self.base_config = _ADS_CONFIG_GAIN[ads.gain] | _ADS_CONFIG_DATA_RATE[data_rate]
+        # Duration of one conversion, and three of them before giving up on it
+        self.period_ns = 1000000000 // data_rate
+        self.timeout_ns = 3 * self.period_ns + 10000000
+        self._pulse_ns = 0
+        self.alert = None
+        if alert_pin:
+            self.alert = countio.Counter(getattr(board, alert_pin), edge=countio.Edge.FALL)
+        self._out = bytearray(3)
+        self._in = bytearray(2)
+
+    def _write_register(self, register, value):
+        self._out[0] = register
+        self._out[1] = (value >> 8) & 0xFF
+        self._out[2] = value & 0xFF
+        with self.device as device:
+            device.write(self._out)
+
+    def _read_register(self, register):
+        self._out[0] = register
+        with self.device as device:
+            device.write_then_readinto(self._out, self._in, out_end=1)
+        return (self._in[0] << 8) | self._in[1]
+
+    def _read_conversion(self):
+        value = self._read_register(_ADS_REG_CONVERSION)
+        if value & 0x8000:
+            value -= 0x10000
+        return value
+
+    # Yields the seconds to sleep until the next ALERT/RDY pulse, then 0 while polling for it
+    def _wait_alert(self, last):
+        now = time.monotonic_ns()
+        deadline = now + self.timeout_ns
+        remaining = self._pulse_ns + self.period_ns - now
+        if remaining > 0:
+            yield remaining / 1000000000
+        while self.alert.count == last:
+            if time.monotonic_ns() > deadline:
+                raise OSError("No ALERT/RDY pulse from ADS1115")
+            yield 0
+        self._pulse_ns = time.monotonic_ns()
+        return self.alert.count
+
+    def _sample_continuous(self, buffer):
+        # Comparator thresholds with opposite MSBs turn ALERT into a ready signal
+        self._write_register(_ADS_REG_LO_THRESH, 0x0000)
+        self._write_register(_ADS_REG_HI_THRESH, 0x8000)
+        for channel in range(buffer.channels):
+            self._write_register(_ADS_REG_CONFIG, self.base_config | _ADS_CONFIG_MUX_SINGLE[channel]
+                                 | _ADS_CONFIG_MODE_CONTINUOUS | _ADS_CONFIG_COMP_QUE_ONE)
+            # Drop the conversion that was running when the input was switched
+            self._pulse_ns = 0
+            last = yield from self._wait_alert(self.alert.count)
+            for _ in range(buffer.samples):
+                last = yield from self._wait_alert(last)
+                buffer.append(channel, self._read_conversion())
+
+    def _sample_single(self, buffer):
+        for _ in range(buffer.samples):
+            for channel in range(buffer.channels):
+                self._write_register(_ADS_REG_CONFIG, self.base_config | _ADS_CONFIG_MUX_SINGLE[channel]
+                                     | _ADS_CONFIG_OS_SINGLE | _ADS_CONFIG_MODE_SINGLE | _ADS_CONFIG_COMP_QUE_DISABLE)
+                deadline = time.monotonic_ns() + self.timeout_ns
+                yield self.period_ns / 1000000000
+                while not self._read_register(_ADS_REG_CONFIG) & _ADS_CONFIG_OS_SINGLE:
+                    if time.monotonic_ns() > deadline:
+                        raise OSError("ADS1115 conversion timed out")
+                    yield 0
+                buffer.append(channel, self._read_conversion())
+
+    # Yields the seconds to sleep before the next step, 0 to only let other work run
+    def _steps(self, buffer):
+        buffer.reset()
+        try:
+            if self.alert:
+                try:
+                    yield from self._sample_continuous(buffer)
+                except OSError as e:
+                    print(f"Error reading ADC in continuous mode: {e}")
+                    self.alert.deinit()
+                    self.alert = None
+                    buffer.reset()
+            if not self.alert:
+                yield from self._sample_single(buffer)
+        except OSError as e:
+            print(f"Error reading ADC: {e}")
+        finally:
+            # Leave the ADC powered down until the next window
+            try:
+                self._write_register(_ADS_REG_CONFIG, self.base_config | _ADS_CONFIG_MODE_SINGLE
+                                     | _ADS_CONFIG_COMP_QUE_DISABLE)
+            except OSError:
+                pass
+
+    def sample(self, buffer):
+        """
+        Fills the sample buffer with one window of every ADC channel.
+
+        If the ALERT/RDY pin stops pulsing, the sampler switches to the
+        conversion-ready bit for this and the following windows.
+
+        Args:
+            buffer (SampleBuffer): The buffer receiving the samples, one row per channel.
+
+        Returns:
+            list: One ChannelStats per channel.
+        """
+        for delay in self._steps(buffer):
+            if delay:
+                time.sleep(delay)
+        return [buffer.statistics(channel) for channel in range(buffer.channels)]
+
+    async def sample_async(self, buffer):
+        """
+        Fills the sample buffer like sample(), but lets the other asyncio
+        tasks run while each conversion is in progress.
+
+        Args:
+            buffer (SampleBuffer): The buffer receiving the samples, one row per channel.
+
+        Returns:
+            list: One ChannelStats per channel.
+        """
+        for delay in self._steps(buffer):
+            await asyncio.sleep(delay)
+        return [buffer.statistics(channel) for channel in range(buffer.channels)]
@@ -0,0 +1,89 @@
+class SensorRegistry:
+    """
+    Creates each sensor driver once and caches it between measurement cycles.
+
+    Drivers are built lazily on the first read. If a read raises an OSError,
+    the device is considered gone: only that driver is dropped and rebuilt,
+    and the read is tried once more. Every failure is counted per sensor.
+    """
+
+    def __init__(self):
+        self._sensors = {}
+        self._drivers = {}
+        self.errors = {}
+        self.reinits = {}
+
+    def register(self, name, factory, reader, default, present=True):
+        """
+        Registers a sensor.
+
+        Args:
+            name (str): The sensor name used by read().
+            factory (callable): Builds the driver, e.g. lambda: SHT4x(i2c0).
+            reader (callable): Takes the driver and returns the reading.
+            default: The reading returned when the sensor cannot be read.
+            present (bool, optional): False if the sensor was not found on the
+                bus, its reads then return the default without touching the
+                bus. Default is True.
+        """
+        self._sensors[name] = (factory if present else None, reader, default)
+        self._drivers[name] = None
+        self.errors[name] = 0
+        self.reinits[name] = 0
+
+    def driver(self, name):
+        """
+        Returns the cached driver of a sensor, creating it if needed.
+
+        Args:
+            name (str): The sensor name.
+
+        Returns:
+            The driver object.
+
+        Raises:
+            Exception: If the driver cannot be created.
+        """
+        driver = self._drivers[name]
+        if driver is None:
+            driver = self._sensors[name][0]()
+            self._drivers[name] = driver
+        return driver
+
+    def reset(self, name):
+        """
+        Drops the cached driver of a sensor so the next read re-initializes it.
+
+        Args:
+            name (str): The sensor name.
+        """
+        if self._drivers[name] is not None:
+            self.reinits[name] += 1
+        self._drivers[name] = None
+
+    def read(self, name):
+        """
+        Reads a sensor through its cached driver.
+
+        Args:
+            name (str): The sensor name.
+
+        Returns:
+            The reading, or the sensor default if it could not be read.
+        """
+        factory, reader, default = self._sensors[name]
+        if factory is None:
+            return default
+        for attempt in range(2):
+            try:
+                return reader(self.driver(name))
+            except OSError as e:
+                # The device went away, rebuild only this driver
+                self.errors[name] += 1
+                print(f"Error reading {name} (attempt {attempt + 1}/2): {e}")
+                self.reset(name)
+            except Exception as e:
+                self.errors[name] += 1
+                print(f"Error reading {name}: {e}")
+                return default
+        return default
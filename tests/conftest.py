@@ -0,0 +1,40 @@
+"""
+Shared setup of the host tests.
+
+The board modules are imported from their directories, after the standard
+library since code.py would hide its code module. adr.py and payload.py are
+the same file on the senders and the receiver, so the order of the
+directories does not matter.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [os.path.join(ROOT, "sender 1602LCD"), os.path.join(ROOT, "receiver")]
+
+# Large enough for any record kept in NVM or sleep memory
+MEMORY_SIZE = 64
+
+
+class CountingMemory(bytearray):
+    """A bytearray counting the writes, like NVM sector erases."""
+
+    writes = 0
+
+    def __setitem__(self, key, value):
+        self.writes += 1
+        super().__setitem__(key, value)
+
+
+@pytest.fixture
+def nvm():
+    """Stands for microcontroller.nvm."""
+    return CountingMemory(MEMORY_SIZE)
+
+
+@pytest.fixture
+def sleep_memory():
+    """Stands for alarm.sleep_memory."""
+    return CountingMemory(MEMORY_SIZE)
@@ -0,0 +1,64 @@
+"""
+Sender data rate controller on the host, against a radio that reads the TX
+power back like adafruit_rfm9x.
+"""
+import adr
+
+DEFAULT = adr.Profile(7, 125000, 23)
+
+
+class FakeRadio:
+    """The RFM9x settings, reading 20 dB back above 20 dB."""
+
+    def __init__(self):
+        self.spreading_factor = 7
+        self.signal_bandwidth = 125000
+        self._tx_power = 13
+        self.power_writes = 0
+
+    @property
+    def tx_power(self):
+        return min(self._tx_power, 20)
+
+    @tx_power.setter
+    def tx_power(self, value):
+        self._tx_power = value
+        self.power_writes += 1
+
+
+def make():
+    radio = FakeRadio()
+    controller = adr.DataRateController(radio, DEFAULT)
+    controller.set_profile(DEFAULT)
+    return radio, controller
+
+
+def test_same_recommendation_is_not_applied_again():
+    radio, controller = make()
+    for _ in range(5):
+        controller.ack_received(DEFAULT)
+    assert radio.power_writes == 1
+    assert controller.profile.tx_power == 23
+
+
+def test_fallback_only_when_the_profile_changed():
+    radio, controller = make()
+    for _ in range(3 * controller.fallback_failures):
+        controller.ack_missed()
+    assert controller.fallbacks == 0
+    controller.ack_received(adr.Profile(7, 125000, 17))
+    assert controller.profile.tx_power == 17
+    for _ in range(controller.fallback_failures):
+        controller.ack_missed()
+    assert controller.fallbacks == 1
+    assert controller.profile == DEFAULT
+
+
+def test_rate_changes_after_two_acks():
+    radio, controller = make()
+    recommended = adr.Profile(9, 125000, 23)
+    controller.ack_received(recommended)
+    assert controller.profile.spreading_factor == 7
+    controller.ack_received(recommended)
+    assert controller.profile == recommended
+    assert radio.spreading_factor == 9
@@ -0,0 +1,119 @@
+"""
+Sender clock discipline on the host, with a fake RTC.
+"""
+import pytest
+
+import clock
+import state
+
+TRUE_NOW = 1720000000
+YEAR = 365 * 86400
+
+
+class FakeRTC:
+    """Stands for both rtc.RTC and the time module, in epoch seconds."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def localtime(self, seconds):
+        return seconds
+
+    @property
+    def datetime(self):
+        return self.now
+
+    @datetime.setter
+    def datetime(self, value):
+        self.now = value
+
+
+@pytest.fixture
+def rtc(monkeypatch):
+    fake = FakeRTC(TRUE_NOW)
+    monkeypatch.setattr(clock, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def make(rtc, nvm, sleep_memory):
+    def make(schedule=None):
+        return clock.ClockDiscipline(rtc, nvm, 0, cache=sleep_memory, schedule=schedule)
+    return make
+
+
+def test_backward_step_moves_the_schedule(rtc, make):
+    # Measurements started while the clock was a year ahead
+    rtc.now = TRUE_NOW + YEAR
+    schedule = state.CycleState(bytearray(state.STATE_SIZE), cache=bytearray(state.STATE_SIZE))
+    schedule.start(1800, rtc.now, "/data_log.csv")
+    rtc.now += 600
+    discipline = make(schedule=schedule)
+
+    assert discipline.sync(TRUE_NOW + 600) == -YEAR
+    assert rtc.now == TRUE_NOW + 600
+    # The next measurement is still 20 minutes away, not a year
+    assert schedule.next_epoch - rtc.now == 1200
+    assert schedule.last_epoch == TRUE_NOW
+    # The slot given in the same ack can be applied right away
+    assert schedule.align(300)
+    assert 0 < schedule.next_epoch - rtc.now <= schedule.interval
+    # A step from an unset clock is not a drift measurement
+    assert discipline.rate_ppb == 0
+
+
+def test_drift_step_keeps_the_schedule_on_the_slot(rtc, make):
+    schedule = state.CycleState(bytearray(state.STATE_SIZE), cache=bytearray(state.STATE_SIZE))
+    schedule.start(1800, rtc.now, "/data_log.csv")
+    next_epoch = schedule.next_epoch
+    discipline = make(schedule=schedule)
+    discipline.sync(rtc.now)
+    rtc.now += 3600
+    assert discipline.sync(rtc.now + 2) == 2
+    assert schedule.next_epoch == next_epoch
+    assert discipline.rate_ppb > 0
+
+
+def test_sync_without_change_does_not_write(rtc, make, nvm, sleep_memory):
+    discipline = make()
+    discipline.sync(rtc.now)
+    assert nvm.writes == 1
+    for _ in range(10):
+        rtc.now += 60
+        assert discipline.sync(rtc.now) == 0
+    assert (nvm.writes, sleep_memory.writes) == (1, 1)
+
+
+def test_rate_updates_stay_in_the_cache(rtc, make, nvm):
+    discipline = make()
+    discipline.sync(rtc.now)
+    # The clock runs 100 ppm slow, the first step measures it
+    rtc.now += 36000
+    discipline.sync(rtc.now + 4)
+    rtc.now += 4
+    writes = nvm.writes
+    for _ in range(3):
+        rtc.now += 600
+        discipline.sync(rtc.now)
+    assert nvm.writes == writes
+    resumed = make()
+    assert resumed.load()
+    assert resumed.rate_ppb == discipline.rate_ppb
+    assert resumed.sync_epoch == discipline.sync_epoch
+
+
+def test_negative_rate_steps_only_whole_seconds(rtc, make):
+    discipline = make()
+    discipline.sync(rtc.now)
+    discipline.rate_ppb = -50
+    rtc.now += 10
+    assert discipline.correct() == 0
+    # 50 ppb fast drifts one second in 2e7 seconds
+    rtc.now = discipline.sync_epoch + 20000000 - 1
+    assert discipline.correct() == 0
+    rtc.now += 1
+    assert discipline.correct() == -1
+    assert discipline.corrected == -1
@@ -0,0 +1,228 @@
+"""
+Receiver to gateway I2C transfers on the host, against a simulated I2C target
+that reassembles the chunks like receiveEvent() and requestEvent() in
+"4G board ThingSpeak/save_inSD_andSendThingSpeak.ino".
+"""
+import asyncio
+
+import pytest
+
+import gateway
+
+ADDRESS = 0x08
+RECORDS = (
+    b"2,2024,7,5,10,53,26,22.3564,57.4871,986.305,5921.95,0.0,0.0,0.0,343\n"
+    b"2,2024,7,5,11,23,27,22.3243,56.6955,986.193,5921.8,0.0,0.0,0.0,347\n"
+    b"3,2024,7,5,11,23,41,21.9071,58.1022,986.201,4410.27,4398.5,0.0,0.0,512"
+)
+
+
+class FakeGateway:
+    """
+    The gateway end of the bus: the Arduino chunk reassembly and status register.
+
+    Args:
+        faults (dict, optional): Chunk writes to tamper with, by their number
+            counted from 0: "corrupt" flips a data bit, "drop" loses the chunk
+            and "swap" delivers it after the next one. Default is None.
+    """
+
+    def __init__(self, faults=None):
+        self.faults = faults or {}
+        self.writes = 0
+        self.held = None
+        self.buffer = bytearray()
+        self.status = [gateway.STATUS_IDLE, 0, 0]
+        self.data_received = False
+        self.transfers = []
+        self.locked = False
+
+    # busio.I2C
+    def try_lock(self):
+        if self.locked:
+            return False
+        self.locked = True
+        return True
+
+    def unlock(self):
+        self.locked = False
+
+    def writeto(self, address, chunk):
+        assert address == ADDRESS
+        assert len(chunk) <= gateway.CHUNK_SIZE, "larger than the Wire buffer"
+        fault = self.faults.get(self.writes)
+        self.writes += 1
+        if fault == "corrupt":
+            chunk = bytes(chunk[:5]) + bytes((chunk[5] ^ 0x01,)) + bytes(chunk[6:])
+        elif fault == "drop":
+            return
+        elif fault == "swap":
+            self.held = bytes(chunk)
+            return
+        self.receive_event(bytes(chunk))
+        if self.held is not None:
+            held, self.held = self.held, None
+            self.receive_event(held)
+
+    def readfrom_into(self, address, buffer):
+        assert address == ADDRESS
+        buffer[:] = bytes(self.status)
+
+    # Wire.onReceive(receiveEvent)
+    def receive_event(self, chunk):
+        header = 4
+        if len(chunk) < header + 2 or len(chunk) != header + chunk[0] + 2:
+            self.status[0] = gateway.STATUS_CRC_ERROR
+            return
+        if gateway.crc16(chunk[:-2]) != chunk[-2] | chunk[-1] << 8:
+            self.status[0] = gateway.STATUS_CRC_ERROR
+            return
+        length, transfer_id, index, count = chunk[:header]
+        if self.data_received:
+            self.status[0] = gateway.STATUS_BUSY
+            return
+        if index == 0:
+            self.buffer = bytearray()
+            self.status[1] = transfer_id
+            self.status[2] = 0
+        elif transfer_id != self.status[1] or index != self.status[2]:
+            self.status[0] = gateway.STATUS_SEQUENCE_ERROR
+            return
+        if len(self.buffer) + length > gateway.MAX_TRANSFER:
+            self.status[0] = gateway.STATUS_OVERFLOW
+            return
+        self.buffer += chunk[header:header + length]
+        self.status[2] = index + 1
+        if index + 1 == count:
+            self.status[0] = gateway.STATUS_COMPLETE
+            self.data_received = True
+        else:
+            self.status[0] = gateway.STATUS_RECEIVING
+
+    # loop()
+    def take(self):
+        self.transfers.append(bytes(self.buffer))
+        self.data_received = False
+
+
+def link(bus, retries=3):
+    return gateway.GatewayLink(bus, ADDRESS, retries, chunk_delay=0)
+
+
+def send(gateway_link, data):
+    return asyncio.run(gateway_link.send(data))
+
+
+def chunk_count(data):
+    return len(gateway.chunks(0, data))
+
+
+def test_crc16_ccitt():
+    assert gateway.crc16(b"123456789") == 0x29B1
+
+
+def test_chunks_fit_the_wire_buffer():
+    for size in (1, gateway.CHUNK_DATA_SIZE, gateway.CHUNK_DATA_SIZE + 1, gateway.MAX_TRANSFER):
+        parts = gateway.chunks(7, bytes(size))
+        assert all(len(part) <= gateway.CHUNK_SIZE for part in parts)
+        assert sum(part[0] for part in parts) == size
+
+
+def test_batch_of_records_is_reassembled():
+    bus = FakeGateway()
+    assert send(link(bus), RECORDS) == gateway.STATUS_COMPLETE
+    bus.take()
+    assert bus.transfers == [RECORDS]
+    assert bus.writes == chunk_count(RECORDS)
+
+
+def test_transfer_yields_to_other_tasks():
+    ticks = []
+
+    async def radio():
+        while True:
+            ticks.append(len(ticks))
+            await asyncio.sleep(0)
+
+    async def main():
+        task = asyncio.create_task(radio())
+        status = await link(FakeGateway()).send(RECORDS)
+        task.cancel()
+        return status
+
+    assert asyncio.run(main()) == gateway.STATUS_COMPLETE
+    # The radio task ran between the chunks
+    assert len(ticks) >= chunk_count(RECORDS) - 1
+
+
+def test_status_readback():
+    bus = FakeGateway()
+    gateway_link = link(bus)
+    assert gateway_link.read_status() == (gateway.STATUS_IDLE, 0, 0)
+    send(gateway_link, RECORDS)
+    assert gateway_link.read_status() == (gateway.STATUS_COMPLETE, gateway_link.transfer_id, chunk_count(RECORDS))
+    assert not bus.locked
+
+
+def test_crc_mismatch_is_sent_again():
+    bus = FakeGateway({1: "corrupt"})
+    assert send(link(bus), RECORDS) == gateway.STATUS_COMPLETE
+    bus.take()
+    assert bus.transfers == [RECORDS]
+    assert bus.writes == 2 * chunk_count(RECORDS)
+
+
+def test_dropped_chunk_is_sent_again():
+    bus = FakeGateway({2: "drop"})
+    assert send(link(bus), RECORDS) == gateway.STATUS_COMPLETE
+    bus.take()
+    assert bus.transfers == [RECORDS]
+
+
+def test_last_chunk_dropped_is_sent_again():
+    count = chunk_count(RECORDS)
+    bus = FakeGateway({count - 1: "drop"})
+    assert send(link(bus), RECORDS) == gateway.STATUS_COMPLETE
+    bus.take()
+    assert bus.transfers == [RECORDS]
+
+
+def test_out_of_order_chunks_are_sent_again():
+    bus = FakeGateway({1: "swap"})
+    assert send(link(bus), RECORDS) == gateway.STATUS_COMPLETE
+    bus.take()
+    assert bus.transfers == [RECORDS]
+
+
+def test_failure_is_reported_after_the_last_retry():
+    count = chunk_count(RECORDS)
+    bus = FakeGateway({1: "corrupt", count + 1: "corrupt", 2 * count + 1: "corrupt"})
+    assert send(link(bus), RECORDS) == gateway.STATUS_SEQUENCE_ERROR
+    assert not bus.data_received
+
+
+def test_busy_gateway_is_not_retried():
+    bus = FakeGateway()
+    gateway_link = link(bus)
+    send(gateway_link, RECORDS)
+    # The gateway is still handling the first transfer
+    assert send(gateway_link, RECORDS) == gateway.STATUS_BUSY
+    assert bus.writes == 2 * chunk_count(RECORDS)
+    bus.take()
+    assert send(gateway_link, RECORDS) == gateway.STATUS_COMPLETE
+
+
+def test_transfer_larger_than_max_transfer(monkeypatch):
+    too_large = bytes(gateway.MAX_TRANSFER + 1)
+    with pytest.raises(ValueError):
+        gateway.chunks(1, too_large)
+    # A sender with a larger limit overflows the gateway buffer
+    bus = FakeGateway()
+    monkeypatch.setattr(gateway, "MAX_TRANSFER", 2 * gateway.MAX_TRANSFER)
+    parts = gateway.chunks(1, too_large)
+    monkeypatch.undo()
+    for part in parts:
+        bus.writeto(ADDRESS, part)
+    assert bus.status[0] == gateway.STATUS_OVERFLOW
+    assert not bus.data_received
+    assert len(bus.buffer) <= gateway.MAX_TRANSFER
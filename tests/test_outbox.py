@@ -0,0 +1,89 @@
+"""
+Sender outbox on the host.
+"""
+import os
+
+import pytest
+
+import outbox
+
+
+@pytest.fixture
+def make(tmp_path, nvm, sleep_memory):
+    def make(cache=sleep_memory, slots=8, flush_every=4):
+        box = outbox.Outbox(str(tmp_path / "outbox.bin"), nvm, 0, slots * outbox.SLOT_SIZE, cache, flush_every)
+        box.load()
+        return box
+    return make
+
+
+def frame(number):
+    return bytes((number & 0xFF,)) * (1 + number % 40)
+
+
+def test_backlog_that_never_drains_keeps_queueing(make):
+    box = make()
+    sent = 0
+    for number in range(100):
+        assert box.append(frame(number))
+        if number % 2:
+            # Fewer frames are drained than queued, but never all of them
+            assert box.peek(1) == [frame(sent)]
+            box.pop(1)
+            sent += 1
+        if box.count == box.slots:
+            box.pop(3)
+            sent += 3
+    assert box.peek(box.count) == [frame(number) for number in range(sent, 100)]
+    assert os.stat(box.path)[6] <= box.slots * outbox.SLOT_SIZE
+
+
+def test_full_outbox_drops_new_frames(make):
+    box = make()
+    for number in range(box.slots):
+        assert box.append(frame(number))
+    assert not box.append(frame(99))
+    assert box.peek(box.slots) == [frame(number) for number in range(box.slots)]
+
+
+def test_nvm_is_written_only_every_few_frames(make, nvm):
+    box = make(slots=64, flush_every=16)
+    for number in range(200):
+        box.append(frame(number))
+        box.pop(1)
+    assert nvm.writes == 200 // 16
+
+
+def test_deep_sleep_resumes_from_sleep_memory(make):
+    box = make()
+    for number in range(6):
+        box.append(frame(number))
+    box.pop(3)
+    box = make()
+    assert (box.head, box.count) == (3, 3)
+    assert box.peek(3) == [frame(3), frame(4), frame(5)]
+
+
+def test_power_loss_recovers_frames_from_the_file(make):
+    box = make()
+    for number in range(20):
+        box.append(frame(number))
+        if number < 14:
+            box.pop(1)
+    # Sleep memory lost: the head saved in NVM is behind, the frames after it
+    # are sent again, none of the queued ones is lost
+    box = make(cache=bytearray(16))
+    assert box.head == 12
+    assert box.peek(box.count) == [frame(number) for number in range(12, 20)]
+    box.pop(4)
+    for number in range(20, 24):
+        assert box.append(frame(number))
+    assert box.peek(box.count) == [frame(number) for number in range(16, 24)]
+
+
+def test_clear_deletes_the_file(make):
+    box = make()
+    box.append(frame(1))
+    box.clear()
+    assert not os.path.exists(box.path)
+    assert make().count == 0
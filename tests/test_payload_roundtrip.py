@@ -0,0 +1,165 @@
+"""
+Round trip of the sender CSV logs through the binary LoRa payload.
+
+Every row of the data_log_*.csv files is packed by the sender codec, batched
+like the sender firmware does, and decoded by the receiver. Runs on the host:
+
+    python -m pytest -s tests/test_payload_roundtrip.py
+"""
+import calendar
+import csv
+import glob
+import os
+import time
+
+import pytest
+
+import batch
+import decoder
+import payload
+
+SENDER = os.path.dirname(batch.__file__)
+RECEIVER = os.path.dirname(decoder.__file__)
+
+# CSV column of every reading field, the logged firmware had one dendrometer
+COLUMNS = {
+    "dendro0": "Dendrometer(uM)",
+    "pressure": "Pressure(hPa)",
+    "temperature": "Temp SHT41(C)",
+    "humidity": "Humidity(%)",
+    "moisture": "Moisture Level",
+}
+# Largest rounding error of every reading field
+RESOLUTION = {
+    "dendro0": 0.5 / payload.DENDRO_SCALE,
+    "pressure": 0.5 / payload.PRESSURE_SCALE,
+    "temperature": 0.5 / payload.TEMPERATURE_SCALE,
+    "humidity": 0.5 / payload.HUMIDITY_SCALE,
+    "moisture": 0,
+}
+
+
+@pytest.fixture(autouse=True)
+def utc(monkeypatch):
+    # decoder.decode() turns epochs into local dates, the logs are read as UTC
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def load_logs():
+    """
+    Reads every CSV log of the sender.
+
+    Rows from a clock set before 1970, such as the year 22 log, have no epoch
+    time and are left out.
+
+    Returns:
+        list: One list of (epoch, row) per file, in file order.
+    """
+    logs = []
+    for path in sorted(glob.glob(os.path.join(SENDER, "data_log_*.csv"))):
+        with open(path, newline="") as file:
+            rows = []
+            for row in csv.DictReader(file):
+                date_time = tuple(int(row[key]) for key in ("Year", "Month", "Day", "Hour", "Minute", "Second"))
+                if date_time[0] < 1970:
+                    continue
+                rows.append((calendar.timegm(date_time + (0, 0, 0)), row))
+        if rows:
+            logs.append(rows)
+    return logs
+
+
+def pack(epoch, row):
+    return payload.pack_record(epoch, (float(row[COLUMNS["dendro0"]]), 0, 0, 0), float(row[COLUMNS["pressure"]]),
+                               float(row[COLUMNS["temperature"]]), float(row[COLUMNS["humidity"]]),
+                               int(row[COLUMNS["moisture"]]))
+
+
+def text_payload(row):
+    # Text payload of the baseline sender firmware, one reading per frame
+    return (f"{row['Year']}/{row['Month']}/{row['Day']} {row['Hour']}:{row['Minute']}:{row['Second']},"
+            f"Dendro0: {row[COLUMNS['dendro0']]},Dendro1: 0.0,Dendro2: 0.0,Dendro3: 0.0,"
+            f" Press: {row[COLUMNS['pressure']]}, Temp: {row[COLUMNS['temperature']]},"
+            f" Hum: {row[COLUMNS['humidity']]}, Moisture: {row[COLUMNS['moisture']]}").encode()
+
+
+def frames(rows, size, tmp_path):
+    """
+    Batches rows the way batch_record() does in the sender code.py.
+
+    Returns:
+        list: The frames with the rows they carry.
+    """
+    pending = batch.Batch(str(tmp_path / "pending.bin"), size)
+    result = []
+    carried = []
+    seq = 0
+    for epoch, row in rows:
+        pending.add(pack(epoch, row))
+        carried.append((epoch, row))
+        if pending.ready(epoch):
+            seq += 1
+            result.append((payload.encode_batch(2, seq, pending.take()), carried))
+            carried = []
+    if pending.records:
+        seq += 1
+        result.append((payload.encode_batch(2, seq, pending.take()), carried))
+    return result
+
+
+def check(record, epoch, row):
+    assert record[:6] == time.gmtime(epoch)[:6]
+    values = dict(zip(payload.READING_FIELDS, record[6:]))
+    for name, column in COLUMNS.items():
+        assert values[name] == pytest.approx(float(row[column]), abs=RESOLUTION[name] + 1e-9), name
+    for name in ("dendro1", "dendro2", "dendro3"):
+        assert values[name] == 0
+
+
+def test_codec_is_shared():
+    with open(os.path.join(SENDER, "payload.py"), "rb") as sender_file:
+        with open(os.path.join(RECEIVER, "payload.py"), "rb") as receiver_file:
+            assert sender_file.read() == receiver_file.read()
+
+
+def test_logs_are_loaded():
+    assert sum(len(rows) for rows in load_logs()) > 300
+
+
+@pytest.mark.parametrize("size", [1, 8, payload.MAX_RECORDS])
+def test_round_trip(size, tmp_path):
+    text_bytes = 0
+    frame_bytes = 0
+    readings = 0
+    for rows in load_logs():
+        for frame, carried in frames(rows, size, tmp_path):
+            assert len(frame) <= payload.MAX_PAYLOAD
+            records = decoder.decode(frame)
+            assert len(records) == len(carried)
+            for record, (epoch, row) in zip(records, carried):
+                check(record, epoch, row)
+                text_bytes += len(text_payload(row))
+            frame_bytes += len(frame)
+            readings += len(carried)
+    ratio = text_bytes / frame_bytes
+    print(f"\nbatch size {size}: {readings} readings, {frame_bytes / readings:.1f} bytes per reading, "
+          f"text {text_bytes / readings:.1f} bytes per reading, compression ratio {ratio:.1f}")
+    assert ratio > 1
+
+
+def test_text_payload_still_decodes():
+    epoch, row = load_logs()[-1][0]
+    check(decoder.decode(text_payload(row))[0], epoch, row)
+
+
+def test_zigzag_varint_extremes():
+    for value in (0, 1, -1, 63, -64, 64, -65, 0x7FFFFFFF, -0x80000000, 0xFFFFFFFF, -0xFFFFFFFF):
+        out = bytearray()
+        payload._put_varint(out, value)
+        assert payload._get_varint(out, 0) == (value, len(out))
+    with pytest.raises(ValueError):
+        payload._get_varint(b"\x80", 0)
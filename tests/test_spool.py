@@ -0,0 +1,83 @@
+"""
+Receiver spool on the host.
+"""
+import pytest
+
+import spool
+
+
+@pytest.fixture
+def make(tmp_path, nvm):
+    def make(slots=8, flush_every=4):
+        queue = spool.Spool(str(tmp_path / "spool.bin"), nvm, 0, slots, slot_size=32, flush_every=flush_every)
+        queue.load()
+        return queue
+    return make
+
+
+def record(number):
+    return b"%d,reading" % number
+
+
+def test_records_come_back_in_order(make):
+    queue = make()
+    for number in range(5):
+        assert queue.append(record(number))
+    assert queue.peek(2) == [record(0), record(1)]
+    queue.pop(2)
+    assert queue.peek(10) == [record(2), record(3), record(4)]
+
+
+def test_full_spool_overwrites_the_oldest(make):
+    queue = make()
+    for number in range(20):
+        assert queue.append(record(number))
+    assert queue.count == queue.slots
+    assert queue.overwritten == 20 - queue.slots
+    assert queue.peek(queue.slots) == [record(number) for number in range(12, 20)]
+
+
+def test_nvm_is_written_only_every_few_records(make, nvm):
+    queue = make(slots=64, flush_every=16)
+    for number in range(200):
+        queue.append(record(number))
+    # Spooling while the gateway is down writes the head only as it is overwritten
+    assert nvm.writes == (200 - 64) // 16
+    writes = nvm.writes
+    while queue.count:
+        queue.pop(4)
+    # and while draining every few records, and once it is empty
+    assert nvm.writes <= writes + 64 // 16 + 1
+
+
+def test_reset_recovers_records_after_the_saved_head(make):
+    queue = make()
+    for number in range(6):
+        queue.append(record(number))
+    queue.pop(3)
+    # The head in NVM is behind, the forwarded records are sent again, none is lost
+    queue = make()
+    assert queue.head == 0
+    assert queue.peek(queue.count) == [record(number) for number in range(6)]
+
+
+def test_reset_skips_records_overwritten_since_the_saved_head(make):
+    queue = make()
+    for number in range(14):
+        queue.append(record(number))
+    queue = make()
+    assert queue.peek(queue.count) == [record(number) for number in range(6, 14)]
+
+
+def test_drained_spool_stays_empty_after_a_reset(make):
+    queue = make()
+    for number in range(5):
+        queue.append(record(number))
+    queue.pop(5)
+    assert make().count == 0
+
+
+def test_record_too_long_is_refused(make):
+    queue = make()
+    assert not queue.append(bytes(31))
+    assert queue.count == 0
@@ -0,0 +1,54 @@
+"""
+Sender measurement state on the host.
+"""
+import state
+
+
+def run_cycles(cycle_state, cycles, now):
+    for _ in range(cycles):
+        now += cycle_state.interval
+        cycle_state.advance(now)
+        cycle_state.next_seq()
+    return now
+
+
+def test_cycles_rarely_write_nvm(nvm, sleep_memory):
+    cycle_state = state.CycleState(nvm, cache=sleep_memory)
+    cycle_state.start(1800, 1720000000, "/data_log.csv")
+    run_cycles(cycle_state, 64, 1720000000)
+    assert nvm.writes == 1 + 64 // state.FLUSH_CYCLES + 64 // state.SEQ_BLOCK
+
+
+def test_deep_sleep_resumes_from_the_cache(nvm, sleep_memory):
+    cycle_state = state.CycleState(nvm, cache=sleep_memory)
+    cycle_state.start(1800, 1720000000, "/data_log.csv")
+    now = run_cycles(cycle_state, 5, 1720000000)
+    resumed = state.CycleState(nvm, cache=sleep_memory)
+    assert resumed.load() and resumed.active
+    assert (resumed.cycle, resumed.last_epoch, resumed.seq) == (5, now, 5)
+    assert resumed.csv_filename == "/data_log.csv"
+
+
+def test_sequence_numbers_are_not_reused_after_power_loss(nvm, sleep_memory):
+    cycle_state = state.CycleState(nvm, cache=sleep_memory)
+    cycle_state.start(1800, 1720000000, "/data_log.csv")
+    used = set()
+    now = 1720000000
+    for cycles in (3, 63, 64, 65, 130):
+        for _ in range(cycles):
+            now += 1800
+            cycle_state.advance(now)
+            seq = cycle_state.next_seq()
+            assert seq not in used
+            used.add(seq)
+        # Power loss: the sleep memory is gone, only NVM is left
+        cycle_state = state.CycleState(nvm, cache=bytearray(state.STATE_SIZE))
+        assert cycle_state.load() and cycle_state.active
+        assert cycle_state.seq >= max(used)
+
+
+def test_without_cache_every_change_is_written(nvm):
+    cycle_state = state.CycleState(nvm)
+    cycle_state.start(1800, 1720000000, "/data_log.csv")
+    run_cycles(cycle_state, 3, 1720000000)
+    assert nvm.writes == 7